@@ -0,0 +1,133 @@
+from time import time
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import router
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+
+from store.cache import is_shared_cache
+
+'''
+Claims based authentication
+Access tokens issued by ClaimsTokenObtainPairSerializer carry what the
+store needs about the user (customer_id, membership, is_staff,
+is_superuser), so a request is authenticated without loading the user
+row: request.user is a User instance built from the claims, its other
+fields are deferred and load on first access. Tokens without the claims
+(issued before) are authenticated the usual way.
+The token claims are never trusted alone, a deactivated or demoted user
+must lose access right away. The current claims and is_active come from
+one query on the user and customer rows. With a cache shared by the
+workers (CORE_CLAIMS_CACHE) they are cached for CORE_CLAIMS_CACHE_TTL
+seconds and dropped when the user or customer changes (core.signals,
+store.signals), and revoke_tokens() rejects every token a user got so
+far. With a per process cache (LocMemCache) neither would reach the
+other workers, so the claims are read from the database per request.
+iat is in whole seconds, so the tokens also carry the exact time they
+were issued (ISSUED_AT_CLAIM): a token issued in the same second as a
+revocation, but after it, stays valid.
+'''
+CLAIMS_KEY = 'auth:claims:{user_id}'
+REVOKED_KEY = 'auth:revoked:{user_id}'
+ISSUED_AT_CLAIM = 'issued_at'
+# User fields filled from the claims, the rest stay deferred
+USER_FIELDS = ['id', 'is_active', 'is_staff', 'is_superuser']
+
+
+def token_claims(user):
+    customer = getattr(user, 'customer', None)
+    return {
+        'customer_id': customer.id if customer is not None else None,
+        'membership': customer.membership if customer is not None else None,
+        'is_staff': user.is_staff,
+        'is_superuser': user.is_superuser,
+    }
+
+
+def issued_at(token):
+    # Tokens issued before the claim existed only have iat
+    return token.get(ISSUED_AT_CLAIM, token.get('iat', 0))
+
+
+def load_claims(user_id):
+    row = get_user_model().objects.filter(pk=user_id) \
+        .values('is_active', 'is_staff', 'is_superuser', 'customer__id', 'customer__membership').first()
+    if row is None:
+        return {'is_active': False}
+    return {
+        'is_active': row['is_active'],
+        'is_staff': row['is_staff'],
+        'is_superuser': row['is_superuser'],
+        'customer_id': row['customer__id'],
+        'membership': row['customer__membership'],
+    }
+
+
+def get_claims_cache():
+    return caches[getattr(settings, 'CORE_CLAIMS_CACHE', 'default')]
+
+
+def forget_claims(user_id):
+    get_claims_cache().delete(CLAIMS_KEY.format(user_id=user_id))
+
+
+def revoke_tokens(user_id):
+    # Rejects the tokens issued up to now, until the longest of them expires
+    lifetime = jwt_settings.REFRESH_TOKEN_LIFETIME.total_seconds()
+    get_claims_cache().set(REVOKED_KEY.format(user_id=user_id), time(), timeout=lifetime)
+    forget_claims(user_id)
+
+
+def is_revoked(token):
+    revoked = get_claims_cache().get(REVOKED_KEY.format(user_id=token.get(jwt_settings.USER_ID_CLAIM)))
+    return revoked is not None and issued_at(token) < revoked
+
+
+def current_claims(user_id, issued):
+    '''
+    Claims and is_active as they are now, cached when the cache is
+    shared. Raises AuthenticationFailed for tokens issued before a
+    revocation (issued: the token's issued_at())
+    '''
+    cache = get_claims_cache()
+    ttl = getattr(settings, 'CORE_CLAIMS_CACHE_TTL', 60)
+    if not ttl or not is_shared_cache(cache):
+        return load_claims(user_id)
+    claims_key = CLAIMS_KEY.format(user_id=user_id)
+    revoked_key = REVOKED_KEY.format(user_id=user_id)
+    cached = cache.get_many([claims_key, revoked_key])
+    revoked = cached.get(revoked_key)
+    if revoked is not None and issued < revoked:
+        raise AuthenticationFailed('Token has been revoked', code='token_revoked')
+    claims = cached.get(claims_key)
+    if claims is None:
+        claims = load_claims(user_id)
+        cache.set(claims_key, claims, timeout=ttl)
+    return claims
+
+
+def make_user(user_id, claims):
+    User = get_user_model()
+    values = dict(claims, id=user_id, is_active=claims.get('is_active', True))
+    names = [field.attname for field in User._meta.concrete_fields if field.attname in USER_FIELDS]
+    user = User.from_db(router.db_for_read(User), names, [values[name] for name in names])
+    user.customer_id = claims.get('customer_id')
+    user.membership = claims.get('membership')
+    return user
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    def get_user(self, validated_token):
+        if 'customer_id' not in validated_token:
+            return super().get_user(validated_token)
+        try:
+            user_id = validated_token[jwt_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise AuthenticationFailed('Token contained no recognizable user identification')
+
+        claims = current_claims(user_id, issued_at(validated_token))
+        if not claims['is_active']:
+            raise AuthenticationFailed('User is inactive', code='user_inactive')
+        return make_user(user_id, claims)
@@ -0,0 +1,45 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from core.serializers import ClaimsTokenObtainPairSerializer
+from store.models import Customer, Order
+
+ENDPOINTS = ['/store/orders/', '/store/orders/{order_id}/', '/store/customers/me/', '/store/reports/daily-products/']
+
+
+class Command(BaseCommand):
+    help = ('Count the queries per store endpoint for a plain access token (user loaded '
+            'from the database) and for a token with the customer claims')
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('--endpoint', action='append', help='Path to request, default: a few store endpoints')
+
+    def handle(self, *args, **options):
+        user = get_user_model().objects.filter(username=options['username']).first()
+        if user is None:
+            raise CommandError('No such user')
+        customer_id = Customer.objects.values_list('id', flat=True).filter(user=user).first()
+        order_id = Order.objects.filter(customer_id=customer_id).values_list('id', flat=True).first() or 0
+        tokens = {
+            'plain': RefreshToken.for_user(user).access_token,
+            'claims': ClaimsTokenObtainPairSerializer.get_token(user).access_token,
+        }
+        host = next((host.lstrip('.') for host in settings.ALLOWED_HOSTS if '*' not in host), 'localhost')
+        client = APIClient(HTTP_HOST=host)
+
+        self.stdout.write(f"{'endpoint':<40} {'status':>6} {'plain':>6} {'claims':>7}")
+        for endpoint in options['endpoint'] or ENDPOINTS:
+            path = endpoint.format(order_id=order_id)
+            counts = {}
+            for name, token in tokens.items():
+                client.credentials(HTTP_AUTHORIZATION=f'JWT {token}')
+                with CaptureQueriesContext(connection) as queries:
+                    response = client.get(path)
+                counts[name] = len(queries)
+            self.stdout.write(f"{path:<40} {response.status_code:>6} {counts['plain']:>6} {counts['claims']:>7}")
@@ -0,0 +1,185 @@
+import json
+import multiprocessing
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from time import perf_counter
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import identify_hasher, make_password
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand
+from django.db import connection, connections, transaction
+from django.db.models.functions import Lower
+
+from store.catalog_io import guess_format, read_records
+from store.models import Customer
+
+'''
+Records: username, email, password (plain text) or password_hash (a
+hash Django understands, kept as is), first_name, last_name and the
+customer fields phone, birth_date, membership
+'''
+CUSTOMER_FIELDS = ['phone', 'birth_date', 'membership']
+
+
+class Command(BaseCommand):
+    help = ('Stream users from a CSV or JSONL file and create them with their customers '
+            'in chunked bulk inserts, hashing the passwords in a process pool')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to read, '-' for stdin")
+        parser.add_argument('--format', choices=['csv', 'jsonl'])
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                            help='Processes hashing passwords')
+        parser.add_argument('--rejects', help='Write rejected rows and their errors here (JSONL)')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = guess_format(path, options['format'])
+        self.User = get_user_model()
+        self.seen = set()
+        totals = {'rows': 0, 'created': 0, 'rejected': 0}
+        rejects_file = open(options['rejects'], 'a') if options['rejects'] else None
+        file = sys.stdin if path == '-' else open(path, newline='' if format == 'csv' else None)
+
+        # Forked workers must not inherit open database connections
+        connections.close_all()
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('fork') if 'fork' in methods else None
+        workers = max(options['workers'], 1)
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+        start = perf_counter()
+        try:
+            records = read_records(file, format)
+            while True:
+                chunk = list(islice(records, options['chunk_size']))
+                if not chunk:
+                    break
+                chunk_start = perf_counter()
+                rows, rejects = self.validate_chunk(chunk)
+                passwords = [row['password'] for row in rows if row['password'] is not None]
+                hashes = iter(pool.map(make_password, passwords, chunksize=max(len(passwords) // (workers * 4), 1)))
+                for row in rows:
+                    if row['password'] is not None:
+                        row['password_hash'] = next(hashes)
+                with transaction.atomic():
+                    self.write_chunk(rows)
+                for record, errors in rejects:
+                    if rejects_file:
+                        record = {key: value for key, value in record.items() if key != 'password'}
+                        rejects_file.write(json.dumps({'record': record, 'errors': errors}, default=str) + '\n')
+                totals['rows'] += len(chunk)
+                totals['created'] += len(rows)
+                totals['rejected'] += len(rejects)
+                if options['verbosity'] > 1:
+                    self.stdout.write(
+                        f"{totals['rows']} rows, chunk {len(chunk) / (perf_counter() - chunk_start):,.0f} rows/s")
+        finally:
+            pool.shutdown()
+            if file is not sys.stdin:
+                file.close()
+            if rejects_file:
+                rejects_file.close()
+            # Users bulk inserted by an interrupted chunk, or by anything
+            # else that skipped the signal
+            missing = Customer.objects.create_missing()
+
+        elapsed = perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f"{totals['rows']} rows in {elapsed:.1f}s ({totals['rows'] / elapsed if elapsed else 0:,.0f} rows/s): "
+            f"{totals['created']} created, {totals['rejected']} rejected, {missing} missing customers created"))
+
+    def taken(self, name, values):
+        '''
+        Lower cased values of the user field name already in use. MySQL's
+        default collation compares case insensitively and keeps the index,
+        other backends compare lower()
+        '''
+        users = self.User.objects.order_by()
+        if connection.vendor == 'mysql':
+            users = users.filter(**{f'{name}__in': values})
+        else:
+            users = users.annotate(lowered=Lower(name)).filter(lowered__in=values)
+        return {value.lower() for value in users.values_list(name, flat=True)}
+
+    def validate_chunk(self, records):
+        usernames = {str(record.get('username') or '').strip().lower() for record in records}
+        emails = {str(record.get('email') or '').strip().lower() for record in records}
+        # Usernames and emails are different namespaces
+        taken = {'username': self.taken('username', usernames), 'email': self.taken('email', emails)}
+        # Their max_length and validators (username characters, email format)
+        fields = {name: self.User._meta.get_field(name) for name in ['username', 'email', 'first_name', 'last_name']}
+        phone = Customer._meta.get_field('phone')
+        birth_date = Customer._meta.get_field('birth_date')
+        memberships = dict(Customer.MEMBERSHIP_CHOICES)
+
+        rows = []
+        rejects = []
+        for record in records:
+            errors = {}
+            values = {
+                'username': str(record.get('username') or '').strip(),
+                'email': str(record.get('email') or '').strip(),
+                'first_name': str(record.get('first_name') or ''),
+                'last_name': str(record.get('last_name') or ''),
+            }
+            for name, field in fields.items():
+                try:
+                    if name in ['username', 'email'] and not values[name]:
+                        raise ValidationError('This field is required.')
+                    field.run_validators(values[name])
+                except ValidationError as error:
+                    errors[name] = error.messages
+            for name in ['username', 'email']:
+                value = values[name].lower()
+                if value and (value in taken[name] or (name, value) in self.seen):
+                    errors.setdefault(name, []).append(f'A user with this {name} already exists.')
+
+            password = record.get('password') or None
+            password_hash = record.get('password_hash') or None
+            if password_hash is not None:
+                try:
+                    identify_hasher(password_hash)
+                except ValueError:
+                    errors['password_hash'] = ['Unknown password hash format.']
+
+            row = dict(
+                values,
+                password=password if password_hash is None else None,
+                password_hash=password_hash if password_hash is not None else make_password(None),
+                phone=str(record.get('phone') or ''),
+                membership=record.get('membership') or Customer.MEMBERSHIP_BRONZE)
+            try:
+                phone.run_validators(row['phone'])
+            except ValidationError as error:
+                errors['phone'] = error.messages
+            if row['membership'] not in memberships:
+                errors['membership'] = [f"Unknown membership {row['membership']!r}"]
+            try:
+                row['birth_date'] = birth_date.to_python(record.get('birth_date') or None)
+            except ValidationError as error:
+                errors['birth_date'] = error.messages
+
+            if errors:
+                rejects.append((record, errors))
+                continue
+            self.seen.add(('username', row['username'].lower()))
+            self.seen.add(('email', row['email'].lower()))
+            rows.append(row)
+        return rows, rejects
+
+    def write_chunk(self, rows):
+        if not rows:
+            return
+        self.User.objects.bulk_create([
+            self.User(username=row['username'], email=row['email'], first_name=row['first_name'],
+                      last_name=row['last_name'], password=row['password_hash'])
+            for row in rows])
+        # Ids read back by username, MySQL does not return them from bulk inserts
+        ids = dict(self.User.objects.filter(username__in=[row['username'] for row in rows])
+                   .values_list('username', 'id'))
+        Customer.objects.bulk_create([
+            Customer(user_id=ids[row['username']], phone=row['phone'], birth_date=row['birth_date'],
+                     membership=row['membership'])
+            for row in rows])
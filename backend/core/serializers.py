@@ -1,5 +1,12 @@
+from time import time
 from djoser.serializers import UserCreateSerializer as BaseUserCreateSerializer
 from djoser.serializers import UserSerializer as BaseUserSerializer
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from core.authentication import ISSUED_AT_CLAIM, is_revoked, load_claims, token_claims
 '''
 This is for creating additional fields in userregistration
 Now this serializer will represent our UserRegistration Page
@@ -12,4 +19,32 @@ class UserCreateSerializer(BaseUserCreateSerializer):
 class UserSerializer(BaseUserSerializer):
     class Meta(BaseUserSerializer.Meta):
         fields= ['id','username','email','first_name','last_name']
-        
\ No newline at end of file
+
+# Puts the customer claims in the tokens (core.authentication)
+class ClaimsTokenObtainPairSerializer(TokenObtainPairSerializer):
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        for name,value in token_claims(user).items():
+            token[name] = value
+        # Copied into the access tokens made from this refresh token
+        token[ISSUED_AT_CLAIM] = time()
+        return token
+
+# A revoked or deactivated user can not get new access tokens with an
+# old refresh token, and the new access token gets the current claims
+class ClaimsTokenRefreshSerializer(TokenRefreshSerializer):
+    def validate(self, attrs):
+        refresh = self.token_class(attrs['refresh'])
+        if is_revoked(refresh):
+            raise InvalidToken('Token has been revoked')
+        data = super().validate(attrs)
+        if 'customer_id' in refresh:
+            claims = load_claims(refresh[jwt_settings.USER_ID_CLAIM])
+            if not claims.pop('is_active'):
+                raise InvalidToken('User is inactive')
+            access = AccessToken(data['access'])
+            for name,value in claims.items():
+                access[name] = value
+            data['access'] = str(access)
+        return data
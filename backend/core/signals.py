@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from core.authentication import forget_claims, revoke_tokens
+
+
+# Claims cached by ClaimsJWTAuthentication follow the user row. A
+# deactivated or deleted user loses the tokens it holds, so does one
+# whose staff flags changed (they are in the tokens)
+@receiver(pre_save,sender=settings.AUTH_USER_MODEL)
+def note_staff_flags(sender,instance,**kwargs):
+    old = sender.objects.filter(pk=instance.pk).values('is_staff','is_superuser').first() if instance.pk else None
+    instance._staff_flags_changed = old is not None and \
+        (old['is_staff'],old['is_superuser']) != (instance.is_staff,instance.is_superuser)
+
+
+@receiver(post_save,sender=settings.AUTH_USER_MODEL)
+def refresh_user_claims(sender,instance,**kwargs):
+    if not instance.is_active or getattr(instance,'_staff_flags_changed',False):
+        revoke_tokens(instance.pk)
+    else:
+        forget_claims(instance.pk)
+
+
+@receiver(post_delete,sender=settings.AUTH_USER_MODEL)
+def revoke_deleted_user(sender,instance,**kwargs):
+    revoke_tokens(instance.pk)
@@ -1,3 +1,127 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import tempfile
+from io import StringIO
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase, override_settings
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
 
-# Create your tests here.
+from core.authentication import get_claims_cache, revoke_tokens
+from store.models import Customer
+
+
+class ClaimsAuthenticationTests(TestCase):
+    '''
+    Token claims are checked against the user row on every request when
+    the claims cache is per process (LocMemCache in tests)
+    '''
+    def setUp(self):
+        # A revocation left by an earlier test would hit a reused user pk
+        cache.clear()
+        get_claims_cache().clear()
+        self.user = get_user_model().objects.create_user(username='staff', password='secret',
+                                                         email='staff@example.com', is_staff=True)
+        self.client = APIClient()
+        self.tokens = self.client.post('/auth/jwt/create/', {'username': 'staff', 'password': 'secret'}).json()
+        self.client.credentials(HTTP_AUTHORIZATION='JWT ' + self.tokens['access'])
+
+    def test_token_carries_the_claims(self):
+        token = AccessToken(self.tokens['access'])
+        customer = Customer.objects.get(user=self.user)
+        self.assertEqual((token['customer_id'], token['membership'], token['is_staff']),
+                         (customer.id, customer.membership, True))
+        self.assertEqual(self.client.get('/store/reports/daily-products/').status_code, 200)
+
+    def test_inactive_user_is_rejected(self):
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get('/store/orders/').status_code, 401)
+        self.assertEqual(self.client.post('/auth/jwt/refresh/', {'refresh': self.tokens['refresh']}).status_code, 401)
+
+    def test_demoted_staff_loses_access(self):
+        self.user.is_staff = False
+        self.user.save()
+        self.assertIn(self.client.get('/store/reports/daily-products/').status_code, (401, 403))
+
+    def test_refresh_writes_the_current_claims(self):
+        Customer.objects.filter(user=self.user).update(membership=Customer.MEMBERSHIP_GOLD)
+        get_user_model().objects.filter(pk=self.user.pk).update(is_staff=False)
+        response = self.client.post('/auth/jwt/refresh/', {'refresh': self.tokens['refresh']})
+        token = AccessToken(response.json()['access'])
+        self.assertEqual((token['membership'], token['is_staff']), (Customer.MEMBERSHIP_GOLD, False))
+
+    def test_tokens_issued_after_a_revocation_are_accepted(self):
+        revoke_tokens(self.user.pk)
+        self.assertEqual(self.client.post('/auth/jwt/refresh/', {'refresh': self.tokens['refresh']}).status_code, 401)
+        # Most likely within the same second as the revocation
+        tokens = self.client.post('/auth/jwt/create/', {'username': 'staff', 'password': 'secret'}).json()
+        self.client.credentials(HTTP_AUTHORIZATION='JWT ' + tokens['access'])
+        self.assertEqual(self.client.get('/store/reports/daily-products/').status_code, 200)
+        self.assertEqual(self.client.post('/auth/jwt/refresh/', {'refresh': tokens['refresh']}).status_code, 200)
+
+
+class SharedClaimsCacheTests(ClaimsAuthenticationTests):
+    '''
+    Same checks with the claims cached in a cache all the workers share
+    '''
+    def setUp(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        caches = {
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'claims': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location},
+        }
+        shared = override_settings(CACHES=caches, CORE_CLAIMS_CACHE='claims', CORE_CLAIMS_CACHE_TTL=60)
+        shared.enable()
+        self.addCleanup(shared.disable)
+        super().setUp()
+
+    def test_claims_are_cached(self):
+        self.assertEqual(self.client.get('/store/reports/daily-products/').status_code, 200)
+        # A direct write skips the signals, the cached claims still apply
+        get_user_model().objects.filter(pk=self.user.pk).update(is_staff=False)
+        self.assertEqual(self.client.get('/store/reports/daily-products/').status_code, 200)
+
+
+# The command closes the connections before it starts the hashing pool
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class ImportUsersTests(TransactionTestCase):
+    def write_records(self, records):
+        handle, path = tempfile.mkstemp(suffix='.jsonl')
+        self.addCleanup(os.remove, path)
+        with os.fdopen(handle, 'w') as file:
+            for record in records:
+                file.write(json.dumps(record) + '\n')
+        return path
+
+    def test_users_and_customers_are_created(self):
+        get_user_model().objects.create_user(username='taken', email='taken@example.com')
+        path = self.write_records([
+            {'username': 'ann', 'email': 'ann@example.com', 'password': 'secret', 'membership': 'G'},
+            {'username': 'bob', 'email': 'bob@example.com', 'password_hash': 'md5$salt$0123'},
+            {'username': 'TAKEN', 'email': 'other@example.com', 'password': 'secret'},
+            {'username': 'ann', 'email': 'ann2@example.com', 'password': 'secret'},
+            {'username': 'bad name!', 'email': 'not an email'},
+        ])
+        rejects = os.path.join(tempfile.mkdtemp(), 'rejects.jsonl')
+        self.addCleanup(shutil.rmtree, os.path.dirname(rejects))
+        out = StringIO()
+        call_command('import_users', path, workers=2, chunk_size=2, rejects=rejects, stdout=out)
+        self.assertIn('2 created, 3 rejected', out.getvalue())
+        ann = get_user_model().objects.get(username='ann')
+        self.assertTrue(ann.check_password('secret'))
+        self.assertEqual(Customer.objects.get(user=ann).membership, Customer.MEMBERSHIP_GOLD)
+        self.assertEqual(get_user_model().objects.get(username='bob').password, 'md5$salt$0123')
+        with open(rejects) as file:
+            rejected = [json.loads(line) for line in file]
+        self.assertEqual([row['record']['username'] for row in rejected], ['TAKEN', 'ann', 'bad name!'])
+        self.assertNotIn('password', rejected[0]['record'])
+
+    def test_zero_workers_still_hash(self):
+        path = self.write_records([{'username': 'ann', 'email': 'ann@example.com', 'password': 'secret'}])
+        call_command('import_users', path, workers=0, stdout=StringIO())
+        self.assertTrue(get_user_model().objects.get(username='ann').check_password('secret'))
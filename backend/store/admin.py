@@ -6,6 +6,7 @@ from django.utils.html import format_html,urlencode
 from django.urls import reverse
 from django.http.request import HttpRequest
 from . import models
+from .imaging import variant_urls
 
 class InventoryFilter(admin.SimpleListFilter):
     title = 'Inventory'
@@ -28,7 +29,9 @@ class ProductImageInline(admin.TabularInline):
 
     def thumbnail(self,instance):
         if instance.image.name != '':
-            return format_html(f'<img src="{instance.image.url}" class="thumbnail">')
+            # Falls back to the original until the variant is rendered
+            url = variant_urls(instance).get('thumbnail',instance.image.url)
+            return format_html('<img src="{}" class="thumbnail">',url)
         return ''
 
 
@@ -105,11 +108,6 @@ class CollectionAdmin(admin.ModelAdmin):
         return format_html('<a href="{}">{}<a>',url,collection.products_count)
 
     
-    def get_queryset(self, request):
-        return super().get_queryset(request).annotate(
-            products_count = Count('product')
-        )
-    
 class OrderItemInline(admin.StackedInline):
     model = models.OrderItem
     min_num = 1
@@ -125,6 +123,11 @@ class OrderAdmin(admin.ModelAdmin):
     list_select_related = ['customer']
     inlines = [OrderItemInline]
 
+    # Items edited here change the totals of the order history row
+    def save_related(self,request,form,formsets,change):
+        super().save_related(request,form,formsets,change)
+        models.OrderSummary.objects.rebuild(models.Order.objects.filter(pk=form.instance.pk))
+
     @admin.display(ordering='customer__first_name')
     def customer_title(self,order):
         return order.customer.first_name + ' ' + order.customer.last_name
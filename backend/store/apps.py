@@ -9,3 +9,6 @@ class StoreConfig(AppConfig):
     '''
     def ready(self) -> None:
         import store.signals
+        # Periodic abandoned cart sweep, only with STORE_CART_SWEEP_INTERVAL set
+        from store.sweeper import start_scheduler
+        start_scheduler()
@@ -0,0 +1,510 @@
+import logging
+import threading
+from array import array
+from bisect import bisect_left
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import close_old_connections
+from django.utils import timezone
+
+from store.cache import get_catalog_version
+from store.changes import ChangeReader
+from store.models import CatalogChange, Product
+from tags.models import Tag, TaggedItem
+
+'''
+In-process bitmap indexes for browsing products by tag and collection
+"Tagged X and Y, in collection Z, not tagged W" through TaggedItem's
+generic relation is one self join (or EXISTS) per tag. Here every tag
+and every collection keeps the set of its product ids and such a query
+is a few set operations; the database is only asked for the products
+of the page being shown.
+Sets are roaring style: ids are split in chunks of 65536 by their high
+bits, a chunk holds its low 16 bits either as a sorted array('H') (2
+bytes per id) or, past ARRAY_LIMIT ids, as a 8KB bitmap kept in a
+Python int, so AND/OR/AND NOT of dense chunks run over machine words.
+Like the search index every process keeps its own copy: its own writes
+are applied by store.signals, writes of other processes are picked up
+from the change log when the catalog version changes (store/changes.py,
+tagging a product logs the product, renaming or deleting a tag the tag).
+'''
+logger = logging.getLogger(__name__)
+
+CHUNK_BITS = 16
+LOW_MASK = (1 << CHUNK_BITS) - 1
+BITMAP_BYTES = (1 << CHUNK_BITS) // 8
+# Above this many ids an array chunk is bigger than a bitmap one
+ARRAY_LIMIT = 4096
+# Set bit positions of every byte value
+BYTE_BITS = tuple(tuple(bit for bit in range(8) if value >> bit & 1) for value in range(256))
+
+
+def _to_bitmap(lows):
+    data = bytearray(BITMAP_BYTES)
+    for low in lows:
+        data[low >> 3] |= 1 << (low & 7)
+    return int.from_bytes(data, 'little')
+
+
+def _to_array(bitmap):
+    lows = array('H')
+    for position, byte in enumerate(bitmap.to_bytes(BITMAP_BYTES, 'little')):
+        if byte:
+            base = position << 3
+            lows.extend(base + bit for bit in BYTE_BITS[byte])
+    return lows
+
+
+def _size(container):
+    return container.bit_count() if isinstance(container, int) else len(container)
+
+
+def _normalize(container):
+    # Picks the smaller representation, None for an empty chunk
+    size = _size(container)
+    if not size:
+        return None
+    if isinstance(container, int):
+        return _to_array(container) if size <= ARRAY_LIMIT else container
+    return _to_bitmap(container) if size > ARRAY_LIMIT else container
+
+
+def _and(left, right):
+    if isinstance(left, int) and isinstance(right, int):
+        return _normalize(left & right)
+    if isinstance(left, int):
+        left, right = right, left
+    if isinstance(right, int):
+        data = right.to_bytes(BITMAP_BYTES, 'little')
+        return _normalize(array('H', [low for low in left if data[low >> 3] >> (low & 7) & 1]))
+    if len(left) > len(right):
+        left, right = right, left
+    right = set(right)
+    return _normalize(array('H', [low for low in left if low in right]))
+
+
+def _or(left, right):
+    if isinstance(left, int) or isinstance(right, int):
+        return _normalize(_bits(left) | _bits(right))
+    return _normalize(array('H', sorted(set(left).union(right))))
+
+
+def _and_not(left, right):
+    if isinstance(left, int):
+        return _normalize(left & ~_bits(right))
+    if isinstance(right, int):
+        data = right.to_bytes(BITMAP_BYTES, 'little')
+        return _normalize(array('H', [low for low in left if not data[low >> 3] >> (low & 7) & 1]))
+    right = set(right)
+    return _normalize(array('H', [low for low in left if low not in right]))
+
+
+def _bits(container):
+    return container if isinstance(container, int) else _to_bitmap(container)
+
+
+def _copy(container):
+    # Bitmaps are immutable ints, arrays are changed in place by add()
+    return container if isinstance(container, int) else array('H', container)
+
+
+class IdSet:
+    '''
+    Compressed set of non negative integer ids, iterated in ascending
+    order. Slicing (ids[20:30]) walks the chunk sizes, so it can back a
+    Paginator without materializing the whole set
+    '''
+    __slots__ = ('chunks',)
+
+    def __init__(self, ids=()):
+        # high bits -> array('H') or int bitmap of the low bits
+        self.chunks = {}
+        grouped = {}
+        for value in ids:
+            grouped.setdefault(value >> CHUNK_BITS, set()).add(value & LOW_MASK)
+        for high, lows in grouped.items():
+            self.chunks[high] = _normalize(array('H', sorted(lows)))
+
+    @classmethod
+    def from_chunks(cls, chunks):
+        ids = cls()
+        ids.chunks = {high: container for high, container in chunks.items() if container is not None}
+        return ids
+
+    def copy(self):
+        return IdSet.from_chunks({high: _copy(container) for high, container in self.chunks.items()})
+
+    def __len__(self):
+        return sum(_size(container) for container in self.chunks.values())
+
+    def __bool__(self):
+        return bool(self.chunks)
+
+    def __contains__(self, value):
+        container = self.chunks.get(value >> CHUNK_BITS)
+        if container is None:
+            return False
+        low = value & LOW_MASK
+        if isinstance(container, int):
+            return bool(container >> low & 1)
+        position = bisect_left(container, low)
+        return position < len(container) and container[position] == low
+
+    def __iter__(self):
+        for high in sorted(self.chunks):
+            base = high << CHUNK_BITS
+            container = self.chunks[high]
+            for low in _to_array(container) if isinstance(container, int) else container:
+                yield base + low
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice) or index.step not in (None, 1):
+            raise TypeError('IdSet only supports [start:stop] slices')
+        start, stop, _ = index.indices(len(self))
+        ids = []
+        for high in sorted(self.chunks):
+            if start >= stop:
+                break
+            container = self.chunks[high]
+            size = _size(container)
+            if start >= size:
+                start -= size
+                stop -= size
+                continue
+            if isinstance(container, int):
+                container = _to_array(container)
+            base = high << CHUNK_BITS
+            ids.extend(base + low for low in container[start:stop])
+            start, stop = 0, stop - size
+        return ids
+
+    def __repr__(self):
+        return f'<IdSet of {len(self)} ids>'
+
+    def add(self, value):
+        high, low = value >> CHUNK_BITS, value & LOW_MASK
+        container = self.chunks.get(high)
+        if container is None:
+            self.chunks[high] = array('H', [low])
+        elif isinstance(container, int):
+            self.chunks[high] = container | 1 << low
+        else:
+            position = bisect_left(container, low)
+            if position == len(container) or container[position] != low:
+                container.insert(position, low)
+                if len(container) > ARRAY_LIMIT:
+                    self.chunks[high] = _to_bitmap(container)
+
+    def discard(self, value):
+        high, low = value >> CHUNK_BITS, value & LOW_MASK
+        container = self.chunks.get(high)
+        if container is None:
+            return
+        if isinstance(container, int):
+            container = _normalize(container & ~(1 << low))
+        else:
+            position = bisect_left(container, low)
+            if position < len(container) and container[position] == low:
+                del container[position]
+            container = container or None
+        if container is None:
+            del self.chunks[high]
+        else:
+            self.chunks[high] = container
+
+    def __and__(self, other):
+        if len(self.chunks) > len(other.chunks):
+            self, other = other, self
+        return IdSet.from_chunks({high: _and(container, other.chunks[high])
+                                  for high, container in self.chunks.items() if high in other.chunks})
+
+    def __or__(self, other):
+        chunks = {high: _copy(container) for high, container in self.chunks.items()}
+        for high, container in other.chunks.items():
+            chunks[high] = _or(chunks[high], container) if high in chunks else _copy(container)
+        return IdSet.from_chunks(chunks)
+
+    def __sub__(self, other):
+        return IdSet.from_chunks({
+            high: _and_not(container, other.chunks[high]) if high in other.chunks else _copy(container)
+            for high, container in self.chunks.items()})
+
+    def difference_update(self, other):
+        # Only the chunks the two sets share are rewritten
+        for high in [high for high in other.chunks if high in self.chunks]:
+            container = _and_not(self.chunks[high], other.chunks[high])
+            if container is None:
+                del self.chunks[high]
+            else:
+                self.chunks[high] = container
+
+    @classmethod
+    def union(cls, sets):
+        result = cls()
+        for ids in sets:
+            result = result | ids
+        return result
+
+    def nbytes(self):
+        # Payload size, without the Python object overhead
+        return sum(BITMAP_BYTES if isinstance(container, int) else container.itemsize * len(container)
+                   for container in self.chunks.values())
+
+
+class DescendingIds:
+    '''
+    Sliceable view of an IdSet from the highest id down (newest first)
+    '''
+    def __init__(self, ids):
+        self.ids = ids
+        self.length = len(ids)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        start, stop, _ = index.indices(self.length)
+        return self.ids[self.length - stop:self.length - start][::-1]
+
+
+class TagBitmapIndex:
+    # A refresh that sees more than this share of the catalog changed
+    # rebuilds instead of patching every set
+    rebuild_ratio = 0.25
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # One catch up at a time, the others query what is there
+        self.refresh_lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.products = IdSet()
+        # tag id / collection id -> IdSet of product ids
+        self.tags = {}
+        self.collections = {}
+        # Tag labels are not unique, a label stands for all its tags
+        self.labels = {}
+        self.tag_labels = {}
+        self.version = None
+        self.synced_at = None
+        self.changes = ChangeReader()
+
+    @property
+    def is_built(self):
+        return self.synced_at is not None
+
+    def __len__(self):
+        return len(self.products)
+
+    def product_tags(self):
+        return TaggedItem.objects.order_by() \
+            .filter(content_type=ContentType.objects.get_for_model(Product))
+
+    def set_tag(self, tag_id, label):
+        label = label.strip().lower()
+        with self.lock:
+            previous = self.tag_labels.get(tag_id)
+            if previous == label:
+                return
+            if previous is not None:
+                self.labels[previous].discard(tag_id)
+                if not self.labels[previous]:
+                    del self.labels[previous]
+            self.tag_labels[tag_id] = label
+            self.labels.setdefault(label, set()).add(tag_id)
+
+    def remove_tag(self, tag_id):
+        with self.lock:
+            label = self.tag_labels.pop(tag_id, None)
+            if label is not None:
+                self.labels[label].discard(tag_id)
+                if not self.labels[label]:
+                    del self.labels[label]
+            self.tags.pop(tag_id, None)
+
+    def add_product(self, product_id, collection_id, previous_collection_id=None):
+        with self.lock:
+            self.products.add(product_id)
+            if previous_collection_id is not None and previous_collection_id != collection_id:
+                self._discard(self.collections, previous_collection_id, product_id)
+            self.collections.setdefault(collection_id, IdSet()).add(product_id)
+
+    def remove_product(self, product_id, collection_id):
+        with self.lock:
+            self.products.discard(product_id)
+            self._discard(self.collections, collection_id, product_id)
+            # TaggedItem has no cascade from Product, its rows may stay
+            for tag_id in list(self.tags):
+                self._discard(self.tags, tag_id, product_id)
+
+    def tag_product(self, tag_id, product_id):
+        with self.lock:
+            self.tags.setdefault(tag_id, IdSet()).add(product_id)
+
+    def untag_product(self, tag_id, product_id):
+        with self.lock:
+            self._discard(self.tags, tag_id, product_id)
+
+    def _discard(self, sets, key, product_id):
+        ids = sets.get(key)
+        if ids is not None:
+            ids.discard(product_id)
+            if not ids:
+                del sets[key]
+
+    def _group(self, rows):
+        grouped = {}
+        for key, product_id in rows:
+            grouped.setdefault(key, []).append(product_id)
+        return grouped
+
+    def _load_labels(self):
+        self.labels = {}
+        self.tag_labels = {}
+        for tag_id, label in Tag.objects.order_by().values_list('id', 'label'):
+            self.set_tag(tag_id, label)
+
+    def build_from_database(self, chunk_size=5000, changes=None):
+        # changes: a reader already caught up, see refresh
+        version = get_catalog_version()
+        if changes is None:
+            changes = ChangeReader()
+            changes.start()
+        synced_at = timezone.now()
+        products = Product.objects.order_by().values_list('collection_id', 'id').iterator(chunk_size=chunk_size)
+        collections = self._group(products)
+        tags = self._group(self.product_tags().values_list('tag_id', 'object_id').iterator(chunk_size=chunk_size))
+        with self.lock:
+            self.clear()
+            self.collections = {key: IdSet(ids) for key, ids in collections.items()}
+            self.products = IdSet.union(self.collections.values())
+            # Rows left behind by deleted products are not indexed
+            self.tags = {key: ids for key, ids in
+                         ((key, IdSet(ids) & self.products) for key, ids in tags.items()) if ids}
+            self._load_labels()
+            self.changes = changes
+            self.version = version
+            self.synced_at = synced_at
+
+    def refresh(self, chunk_size=5000):
+        '''
+        Catches up with writes made by other processes since the last sync
+        '''
+        version = get_catalog_version()
+        if version == self.version and not self.changes.is_poll_due():
+            return
+        if not self.refresh_lock.acquire(blocking=False):
+            return
+        try:
+            changes = self.changes.read()
+            product_ids = sorted(changes.get(CatalogChange.KIND_PRODUCT, ()))
+            if len(product_ids) > len(self.products) * self.rebuild_ratio:
+                # Read after the changes, so it has them all
+                self.build_from_database(changes=self.changes)
+                return
+            tag_ids = list(changes.get(CatalogChange.KIND_TAG, ()))
+            products, tagged = [], []
+            for offset in range(0, len(product_ids), chunk_size):
+                chunk = product_ids[offset:offset + chunk_size]
+                products.extend(Product.objects.order_by().filter(id__in=chunk).values_list('collection_id', 'id'))
+                tagged.extend(self.product_tags().filter(object_id__in=chunk).values_list('tag_id', 'object_id'))
+            labels = dict(Tag.objects.order_by().filter(id__in=tag_ids).values_list('id', 'label'))
+            with self.lock:
+                stale = IdSet(product_ids)
+                for sets in (self.collections, self.tags):
+                    for key in list(sets):
+                        sets[key].difference_update(stale)
+                        if not sets[key]:
+                            del sets[key]
+                # Products that are gone were deleted, their TaggedItem rows may stay
+                existing = IdSet(product_id for _, product_id in products)
+                self.products = (self.products - stale) | existing
+                for key, ids in self._group(products).items():
+                    self.collections[key] = self.collections.get(key, IdSet()) | IdSet(ids)
+                for key, ids in self._group(tagged).items():
+                    ids = IdSet(ids) & existing
+                    if ids:
+                        self.tags[key] = self.tags.get(key, IdSet()) | ids
+                for tag_id in tag_ids:
+                    if tag_id in labels:
+                        self.set_tag(tag_id, labels[tag_id])
+                    else:
+                        self.remove_tag(tag_id)
+                self.version = version
+                self.synced_at = timezone.now()
+        finally:
+            self.refresh_lock.release()
+
+    def ensure_fresh(self):
+        if self.is_built:
+            self.refresh()
+            return
+        with self.lock:
+            if not self.is_built:
+                self.build_from_database()
+
+    def label_ids(self, label):
+        tag_ids = self.labels.get(label.strip().lower(), ())
+        return IdSet.union(self.tags[tag_id] for tag_id in tag_ids if tag_id in self.tags)
+
+    def query(self, all_tags=(), any_tags=(), exclude_tags=(), collections=()):
+        '''
+        Product ids tagged with every label of all_tags, at least one of
+        any_tags and none of exclude_tags, in one of the collections
+        (empty arguments do not filter)
+        '''
+        with self.lock:
+            required = [self.label_ids(label) for label in all_tags]
+            if any_tags:
+                required.append(IdSet.union(self.label_ids(label) for label in any_tags))
+            if collections:
+                required.append(IdSet.union(self.collections.get(key, IdSet()) for key in collections))
+            if not required:
+                result = self.products.copy()
+            else:
+                # Smallest first, every AND only gets cheaper
+                required.sort(key=len)
+                result = required[0]
+                for ids in required[1:]:
+                    if not result:
+                        break
+                    result = result & ids
+            for label in exclude_tags:
+                if not result:
+                    break
+                result = result - self.label_ids(label)
+        return result
+
+    def nbytes(self):
+        with self.lock:
+            return sum(ids.nbytes() for sets in (self.tags, self.collections)
+                       for ids in sets.values()) + self.products.nbytes()
+
+
+tag_index = TagBitmapIndex()
+
+_warm_up = None
+
+
+def warm_up_index():
+    try:
+        tag_index.ensure_fresh()
+        logger.info('Tag index built: %s products, %s tags', len(tag_index), len(tag_index.tags))
+    except Exception:
+        logger.exception('Building the tag index failed')
+    finally:
+        close_old_connections()
+
+
+def start_warm_up():
+    '''
+    Builds tag_index in a background thread when a web worker starts
+    (storefront/wsgi.py), nothing when STORE_TAG_INDEX_WARMUP is off.
+    Requests arriving meanwhile wait on the index lock
+    '''
+    global _warm_up
+    if not getattr(settings, 'STORE_TAG_INDEX_WARMUP', True) or _warm_up is not None:
+        return
+    _warm_up = threading.Thread(target=warm_up_index, name='tag-index-warm-up', daemon=True)
+    _warm_up.start()
@@ -0,0 +1,145 @@
+from hashlib import md5
+from time import perf_counter, time
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from rest_framework.response import Response
+
+'''
+Catalog response cache
+Product list/detail responses are stored under a key which contains
+the current catalog version, so invalidation is just bumping the
+version (store.signals does that on every catalog write) and old
+entries simply expire.
+The version counter must live in a cache shared by all the workers
+(Redis/Memcached in production), with LocMemCache every process
+only sees its own writes.
+'''
+CATALOG_VERSION_KEY = 'catalog:version'
+STATS_KEY = 'catalog:stats:{endpoint}:{name}'
+STATS_NAMES = ['hits', 'misses', 'hit_us', 'miss_us']
+
+
+def get_cache():
+    return caches[getattr(settings, 'STORE_CATALOG_CACHE', 'default')]
+
+
+def is_shared_cache(cache):
+    # LocMemCache lives in one process, DummyCache keeps nothing
+    return not isinstance(cache, (LocMemCache, DummyCache))
+
+
+def _initial_version():
+    # Counter is seeded from the clock, so if the key gets evicted the
+    # new sequence can not collide with entries written before
+    return int(time() * 1000)
+
+
+def get_catalog_version():
+    cache = get_cache()
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        cache.add(CATALOG_VERSION_KEY, _initial_version(), timeout=None)
+        version = cache.get(CATALOG_VERSION_KEY)
+    return version
+
+
+def bump_catalog_version():
+    cache = get_cache()
+    try:
+        return cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        cache.add(CATALOG_VERSION_KEY, _initial_version(), timeout=None)
+        return cache.get(CATALOG_VERSION_KEY)
+
+
+def normalize_query_params(query_params):
+    # Same filters in a different order (or with empty values) should
+    # hit the same entry
+    items = []
+    for key in sorted(query_params.keys()):
+        values = sorted(value for value in query_params.getlist(key) if value != '')
+        for value in values:
+            items.append(f'{key}={value}')
+    return '&'.join(items)
+
+
+def _incr(cache, key, delta):
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        if not cache.add(key, delta, timeout=None):
+            cache.incr(key, delta)
+
+
+def record_request(endpoint, hit, elapsed):
+    cache = get_cache()
+    count, total = ('hits', 'hit_us') if hit else ('misses', 'miss_us')
+    _incr(cache, STATS_KEY.format(endpoint=endpoint, name=count), 1)
+    _incr(cache, STATS_KEY.format(endpoint=endpoint, name=total), int(elapsed * 1000000))
+
+
+def get_stats(endpoints):
+    cache = get_cache()
+    stats = {}
+    for endpoint in endpoints:
+        keys = {name: STATS_KEY.format(endpoint=endpoint, name=name) for name in STATS_NAMES}
+        values = cache.get_many(keys.values())
+        row = {name: values.get(key, 0) for name, key in keys.items()}
+        requests = row['hits'] + row['misses']
+        stats[endpoint] = {
+            'hits': row['hits'],
+            'misses': row['misses'],
+            'hit_rate': row['hits'] / requests if requests else 0,
+            'avg_hit_ms': row['hit_us'] / row['hits'] / 1000 if row['hits'] else 0,
+            'avg_miss_ms': row['miss_us'] / row['misses'] / 1000 if row['misses'] else 0,
+        }
+    return stats
+
+
+def reset_stats(endpoints):
+    get_cache().delete_many([
+        STATS_KEY.format(endpoint=endpoint, name=name)
+        for endpoint in endpoints for name in STATS_NAMES])
+
+
+class CatalogCacheMixin:
+    '''
+    Caches list and retrieve responses of a catalog viewset
+    cache_endpoint is the name used for the keys and the stats
+    '''
+    cache_endpoint = None
+
+    def get_cache_key(self, request, endpoint):
+        # Hashed because search terms can contain characters (and lengths)
+        # memcached does not accept in keys
+        request_key = '{host}:{kwargs}:{query}'.format(
+            host=request.get_host(),
+            kwargs=':'.join(f'{key}={value}' for key, value in sorted(self.kwargs.items())),
+            query=normalize_query_params(request.query_params))
+        return 'catalog:{version}:{endpoint}:{digest}'.format(
+            version=get_catalog_version(),
+            endpoint=endpoint,
+            digest=md5(request_key.encode()).hexdigest())
+
+    def cached_response(self, request, endpoint, handler, *args, **kwargs):
+        start = perf_counter()
+        cache = get_cache()
+        key = self.get_cache_key(request, endpoint)
+        data = cache.get(key)
+        if data is not None:
+            record_request(endpoint, True, perf_counter() - start)
+            return Response(data, headers={'X-Cache': 'HIT'})
+        response = handler(request, *args, **kwargs)
+        if response.status_code == 200:
+            cache.set(key, response.data, getattr(settings, 'STORE_CATALOG_CACHE_TIMEOUT', 300))
+        response['X-Cache'] = 'MISS'
+        record_request(endpoint, False, perf_counter() - start)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(request, f'{self.cache_endpoint}-list', super().list, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(request, f'{self.cache_endpoint}-detail', super().retrieve, *args, **kwargs)
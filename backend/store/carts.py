@@ -0,0 +1,692 @@
+import atexit
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from uuid import UUID, uuid4
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from decimal import Decimal
+from django.db import close_old_connections, connection, transaction
+from django.db.models import DecimalField, F, Sum
+from django.db.models.functions import Coalesce
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from rest_framework.exceptions import APIException, ValidationError
+
+from store.cache import is_shared_cache
+from store.models import Cart, CartItem, Product, conflict_fields
+
+'''
+Cart storage
+Carts are short lived and written on almost every request, so the views
+and serializers do not talk to Cart/CartItem directly but to a
+CartStore (STORE_CART_BACKEND):
+  DatabaseCartStore  every change is a database write
+  CachedCartStore    carts live in a cache shared by all the workers
+                     (Redis/Memcached, STORE_CART_CACHE) and are written
+                     to the database behind the requests, in batches, by
+                     a background thread and always before checkout
+Both hand out Cart instances with their items attached like
+prefetch_related('items__product__price') would, so the serializers do
+not care which one is in use. A cart holds one item per product, an
+item is addressed by its id (/carts/<cart>/items/<id>/) or by its
+product (/carts/<cart>/items/products/<product id>/).
+'''
+logger = logging.getLogger(__name__)
+
+# CartItem.quantity is a PositiveSmallIntegerField
+MAX_QUANTITY = 32767
+
+
+class CartBusy(APIException):
+    status_code = 503
+    default_detail = 'The cart is being updated, try again.'
+    default_code = 'cart_busy'
+
+
+def parse_cart_id(value):
+    try:
+        return value if isinstance(value, UUID) else UUID(str(value))
+    except ValueError:
+        return None
+
+
+def check_quantities(quantities):
+    # Adds pile up, the database would refuse (or wrap) a bigger sum
+    if any(quantity > MAX_QUANTITY for quantity in quantities):
+        raise ValidationError({'quantity': [f'A cart item can not hold more than {MAX_QUANTITY}.']})
+
+
+def collapse_operations(operations):
+    '''
+    operations: (op, product_id, quantity) with op add/set/remove, in
+    request order. Returns {product_id: (op, quantity)} with one net
+    change per product: only adds stay an add of their sum, anything
+    after a set/remove is absolute (a set, or a remove)
+    '''
+    changes = {}
+    for op, product_id, quantity in operations:
+        current = changes.get(product_id)
+        if op == 'add' and current is not None:
+            current_op, current_quantity = current
+            if current_op == 'remove':
+                changes[product_id] = ('set', quantity)
+            else:
+                changes[product_id] = (current_op, current_quantity + quantity)
+        else:
+            changes[product_id] = (op, quantity)
+    return changes
+
+
+def upsert_items(cart_id, quantities, increment):
+    '''
+    One INSERT for all the products, existing items get their quantity
+    incremented (increment=True) or replaced. Relies on the unique
+    (cart, product) constraint, so concurrent adds can not collide
+    '''
+    if not quantities:
+        return
+    meta = CartItem._meta
+    quote = connection.ops.quote_name
+    table = quote(meta.db_table)
+    cart_column = quote(meta.get_field('cart').column)
+    product_column = quote(meta.get_field('product').column)
+    quantity_column = quote(meta.get_field('quantity').column)
+    cart_value = meta.get_field('cart').get_db_prep_value(cart_id, connection)
+
+    if connection.vendor == 'mysql':
+        new_value = 'VALUES({column})'
+        conflict = 'ON DUPLICATE KEY UPDATE {column} = {update}'
+    else:
+        new_value = 'excluded.{column}'
+        conflict = f'ON CONFLICT ({cart_column}, {product_column}) DO UPDATE SET {{column}} = {{update}}'
+    update = new_value.format(column=quantity_column)
+    if increment:
+        update = f'{table}.{quantity_column} + {update}'
+    sql = 'INSERT INTO {table} ({cart}, {product}, {quantity}) VALUES {values} {conflict}'.format(
+        table=table, cart=cart_column, product=product_column, quantity=quantity_column,
+        values=', '.join(['(%s, %s, %s)'] * len(quantities)),
+        conflict=conflict.format(column=quantity_column, update=update))
+    params = []
+    for product_id, quantity in quantities.items():
+        params += [cart_value, product_id, quantity]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+
+
+CENT = Decimal('0.01')
+
+
+def make_summary(cart_id, item_count, total_price):
+    return {
+        'id': cart_id,
+        'item_count': item_count or 0,
+        'total_price': Decimal(total_price or 0).quantize(CENT),
+    }
+
+
+def attach_items(cart, items):
+    # Fills the cache cart.items.all() reads, same as a prefetch
+    queryset = cart.items.all()
+    queryset._result_cache = list(items)
+    queryset._prefetch_done = True
+    cart._prefetched_objects_cache = {'items': queryset}
+    return cart
+
+
+class CartStore:
+    def create(self):
+        raise NotImplementedError
+
+    def get(self, cart_id, items=True):
+        '''
+        Returns the Cart (items attached unless items=False) or None
+        '''
+        raise NotImplementedError
+
+    def delete(self, cart_id):
+        raise NotImplementedError
+
+    def add_item(self, cart_id, product_id, quantity):
+        '''
+        Adds quantity to the product's item, returns the CartItem or
+        None when there is no such cart
+        '''
+        raise NotImplementedError
+
+    def set_item(self, cart_id, product_id, quantity):
+        # Returns the CartItem or None when the cart has no such item
+        raise NotImplementedError
+
+    def remove_item(self, cart_id, product_id):
+        # Returns whether an item was removed
+        raise NotImplementedError
+
+    def apply(self, cart_id, operations):
+        '''
+        Applies (op, product_id, quantity) operations atomically, op is
+        add, set or remove. Returns False when there is no such cart
+        '''
+        raise NotImplementedError
+
+    def pop(self, cart_id):
+        '''
+        Deletes the cart and returns its {product_id: quantity} (None
+        when there is no cart), nothing can be added to it afterwards.
+        Checkout freezes the cart this way
+        '''
+        raise NotImplementedError
+
+    def restore(self, cart_id, items):
+        '''
+        Puts the cart back with these {product_id: quantity}, for a
+        checkout that failed after pop()
+        '''
+        raise NotImplementedError
+
+    def discard(self, cart_ids):
+        # Drops copies kept outside the database (used by the sweeper)
+        pass
+
+    def get_summary(self, cart_id):
+        '''
+        {'id', 'item_count', 'total_price'} without loading the items,
+        None when there is no cart
+        '''
+        raise NotImplementedError
+
+    def get_validator(self, cart_id):
+        # ETag source for conditional GETs, None when there is no cart
+        raise NotImplementedError
+
+    def flush(self, cart_ids=None):
+        '''
+        Makes sure the database has the current state of these carts
+        (all pending ones when None)
+        '''
+        return 0
+
+    def get_item(self, cart_id, product_id):
+        cart = self.get(cart_id)
+        if cart is None:
+            return None
+        for item in cart.items.all():
+            if item.product_id == product_id:
+                return item
+        return None
+
+    def get_item_by_id(self, cart_id, item_id):
+        cart = self.get(cart_id)
+        if cart is None:
+            return None
+        for item in cart.items.all():
+            if item.id == item_id:
+                return item
+        return None
+
+
+class DatabaseCartStore(CartStore):
+    def create(self):
+        return Cart.objects.create()
+
+    def get(self, cart_id, items=True):
+        cart_id = parse_cart_id(cart_id)
+        if cart_id is None:
+            return None
+        queryset = Cart.objects.filter(pk=cart_id)
+        if items:
+            queryset = queryset.prefetch_related('items__product__price')
+        return queryset.first()
+
+    def delete(self, cart_id):
+        cart_id = parse_cart_id(cart_id)
+        if cart_id is None:
+            return False
+        deleted, _ = Cart.objects.filter(pk=cart_id).delete()
+        return deleted > 0
+
+    def pop(self, cart_id):
+        cart_id = parse_cart_id(cart_id)
+        if cart_id is None:
+            return None
+        with transaction.atomic():
+            # Writers lock the cart row (touch) or the item rows, so a
+            # change either makes it into the items or finds no cart
+            if not self.touch(cart_id):
+                return None
+            items = dict(CartItem.objects.select_for_update().filter(cart_id=cart_id).order_by('id')
+                         .values_list('product_id', 'quantity'))
+            Cart.objects.filter(pk=cart_id).delete()
+        return items
+
+    def restore(self, cart_id, items):
+        existing = set(Product.objects.filter(id__in=list(items)).values_list('id', flat=True))
+        with transaction.atomic():
+            Cart.objects.bulk_create([Cart(id=cart_id)], ignore_conflicts=True)
+            upsert_items(cart_id, {product_id: quantity for product_id, quantity in items.items()
+                                   if product_id in existing}, increment=False)
+
+    def add_item(self, cart_id, product_id, quantity):
+        cart_id = parse_cart_id(cart_id)
+        if not self.apply(cart_id, [('add', product_id, quantity)]):
+            return None
+        return CartItem.objects.get(cart_id=cart_id, product_id=product_id)
+
+    def touch(self, cart_id):
+        # Last activity, the sweeper deletes carts idle for too long.
+        # Also tells whether the cart exists
+        return Cart.objects.filter(pk=cart_id).update(updated_at=timezone.now()) > 0
+
+    def apply(self, cart_id, operations):
+        cart_id = parse_cart_id(cart_id)
+        if cart_id is None:
+            return False
+        changes = collapse_operations(operations)
+        removed = [product_id for product_id, (op, _) in changes.items() if op == 'remove']
+        replaced = {product_id: quantity for product_id, (op, quantity) in changes.items() if op == 'set'}
+        added = {product_id: quantity for product_id, (op, quantity) in changes.items() if op == 'add'}
+        with transaction.atomic():
+            if not self.touch(cart_id):
+                return False
+            # The cart row is locked now, the quantities can not move
+            current = {}
+            if added:
+                current = dict(CartItem.objects.filter(cart_id=cart_id, product_id__in=list(added))
+                               .values_list('product_id', 'quantity'))
+            check_quantities(list(replaced.values()) +
+                             [current.get(product_id, 0) + quantity for product_id, quantity in added.items()])
+            if removed:
+                CartItem.objects.filter(cart_id=cart_id, product_id__in=removed).delete()
+            upsert_items(cart_id, replaced, increment=False)
+            upsert_items(cart_id, added, increment=True)
+        return True
+
+    def set_item(self, cart_id, product_id, quantity):
+        cart_id = parse_cart_id(cart_id)
+        if cart_id is None:
+            return None
+        item = CartItem.objects.filter(cart_id=cart_id, product_id=product_id).first()
+        if item is not None:
+            item.quantity = quantity
+            item.save()
+            self.touch(cart_id)
+        return item
+
+    def remove_item(self, cart_id, product_id):
+        cart_id = parse_cart_id(cart_id)
+        if cart_id is None:
+            return False
+        deleted, _ = CartItem.objects.filter(cart_id=cart_id, product_id=product_id).delete()
+        if deleted:
+            self.touch(cart_id)
+        return deleted > 0
+
+    def get_item(self, cart_id, product_id):
+        cart_id = parse_cart_id(cart_id)
+        if cart_id is None:
+            return None
+        return CartItem.objects.select_related('product__price') \
+            .filter(cart_id=cart_id, product_id=product_id).first()
+
+    def get_item_by_id(self, cart_id, item_id):
+        cart_id = parse_cart_id(cart_id)
+        if cart_id is None:
+            return None
+        return CartItem.objects.select_related('product__price') \
+            .filter(cart_id=cart_id, pk=item_id).first()
+
+    def get_summary(self, cart_id):
+        cart_id = parse_cart_id(cart_id)
+        if cart_id is None:
+            return None
+        # One grouped LEFT JOIN, no row when the cart does not exist.
+        # Prices come from the ProductPrice table, the list price while a
+        # product has no price row yet
+        row = Cart.objects.filter(pk=cart_id).values('id').annotate(
+            item_count=Sum('items__quantity'),
+            total_price=Sum(F('items__quantity') * Coalesce(
+                F('items__product__price__discounted_price'), F('items__product__unit_price')),
+                output_field=DecimalField(max_digits=12, decimal_places=2))).first()
+        if row is None:
+            return None
+        return make_summary(cart_id, row['item_count'], row['total_price'])
+
+    def get_validator(self, cart_id):
+        cart_id = parse_cart_id(cart_id)
+        if cart_id is None:
+            return None
+        # LEFT JOIN: no rows when the cart does not exist, one row of
+        # Nones when it is empty
+        rows = list(Cart.objects.filter(pk=cart_id)
+                    .order_by('items__product_id')
+                    .values_list('items__product_id', 'items__quantity', 'items__product__last_update'))
+        if not rows:
+            return None
+        return repr(rows)
+
+
+class CachedCartStore(CartStore):
+    '''
+    A cart is one cache entry: {'created_at', 'version', 'items':
+    {product_id: quantity}, 'ids': {product_id: CartItem id}}. Writes
+    take a short lock entry (cache.add is atomic on every backend) so
+    concurrent requests on the same cart do not lose updates. Changed
+    carts are remembered per process and flushed every
+    STORE_CART_FLUSH_INTERVAL seconds, under the same lock. The state
+    itself is in the shared cache, so any process can flush any cart at
+    checkout. A cart that is not in the cache (evicted, or written by
+    the database backend) is read back from the database.
+    Item ids only exist once a line is in the database, so a new line
+    added on its own (POST /items/, which answers with the id) is
+    written at once, quantity changes and bulk changes are written
+    behind.
+    A per process cache (LocMemCache) is refused: every worker would
+    see and flush its own copy of the carts
+    '''
+    key_prefix = 'cart:'
+    lock_timeout = 5
+
+    def __init__(self):
+        self.cache = caches[getattr(settings, 'STORE_CART_CACHE', 'default')]
+        if not is_shared_cache(self.cache):
+            raise ImproperlyConfigured('CachedCartStore needs a cache shared by all the workers (STORE_CART_CACHE)')
+        self.timeout = getattr(settings, 'STORE_CART_CACHE_TIMEOUT', 7 * 24 * 60 * 60)
+        self.flush_interval = getattr(settings, 'STORE_CART_FLUSH_INTERVAL', 2)
+        self.dirty = set()
+        self.dirty_lock = threading.Lock()
+        self.flusher = None
+
+    def key(self, cart_id):
+        return f'{self.key_prefix}{cart_id}'
+
+    @contextmanager
+    def locked(self, cart_id):
+        lock_key = f'{self.key(cart_id)}:lock'
+        token = uuid4().hex
+        # The entry expires after lock_timeout, so a dead holder's lock is
+        # gone before the deadline and a live one means the cart is busy
+        deadline = time.monotonic() + self.lock_timeout
+        while not self.cache.add(lock_key, token, self.lock_timeout):
+            if time.monotonic() > deadline:
+                raise CartBusy()
+            time.sleep(0.001)
+        try:
+            yield
+        finally:
+            # Ours could have expired and been taken by someone else
+            if self.cache.get(lock_key) == token:
+                self.cache.delete(lock_key)
+
+    def load(self, cart_id):
+        state = self.cache.get(self.key(cart_id))
+        if state is not None:
+            return state
+        cart = Cart.objects.filter(pk=cart_id).values('created_at').first()
+        if cart is None:
+            return None
+        items = list(CartItem.objects.filter(cart_id=cart_id).order_by('id').values_list('product_id', 'quantity', 'id'))
+        state = {'created_at': cart['created_at'], 'version': 0,
+                 'items': {product_id: quantity for product_id, quantity, _ in items},
+                 'ids': {product_id: item_id for product_id, _, item_id in items}}
+        self.cache.add(self.key(cart_id), state, self.timeout)
+        return state
+
+    def save(self, cart_id, state):
+        state['version'] += 1
+        self.cache.set(self.key(cart_id), state, self.timeout)
+        with self.dirty_lock:
+            self.dirty.add(cart_id)
+        self.start_flusher()
+
+    def create(self):
+        cart = Cart(id=uuid4(), created_at=timezone.now())
+        state = {'created_at': cart.created_at, 'version': 0, 'items': {}, 'ids': {}}
+        self.save(cart.id, state)
+        return attach_items(cart, [])
+
+    def get(self, cart_id, items=True):
+        cart_id = parse_cart_id(cart_id)
+        if cart_id is None:
+            return None
+        state = self.load(cart_id)
+        if state is None:
+            return None
+        cart = Cart(id=cart_id, created_at=state['created_at'])
+        if not items:
+            return cart
+        products = Product.objects.select_related('price').in_bulk(list(state['items']))
+        ids = state.get('ids', {})
+        # Items of products deleted since are dropped
+        return attach_items(cart, [
+            CartItem(id=ids.get(product_id), cart=cart, product=products[product_id], quantity=quantity)
+            for product_id, quantity in state['items'].items() if product_id in products])
+
+    def delete(self, cart_id):
+        cart_id = parse_cart_id(cart_id)
+        if cart_id is None:
+            return False
+        with self.locked(cart_id):
+            existed = self.cache.get(self.key(cart_id)) is not None
+            self.cache.delete(self.key(cart_id))
+            with self.dirty_lock:
+                self.dirty.discard(cart_id)
+            deleted, _ = Cart.objects.filter(pk=cart_id).delete()
+        return existed or deleted > 0
+
+    def pop(self, cart_id):
+        cart_id = parse_cart_id(cart_id)
+        if cart_id is None:
+            return None
+        with self.locked(cart_id):
+            state = self.load(cart_id)
+            if state is None:
+                return None
+            self.cache.delete(self.key(cart_id))
+            with self.dirty_lock:
+                self.dirty.discard(cart_id)
+            Cart.objects.filter(pk=cart_id).delete()
+        return state['items']
+
+    def restore(self, cart_id, items):
+        with self.locked(cart_id):
+            state = {'created_at': timezone.now(), 'version': 0, 'items': dict(items), 'ids': {}}
+            self.save(cart_id, state)
+
+    def change_item(self, cart_id, product_id, change):
+        cart_id = parse_cart_id(cart_id)
+        if cart_id is None:
+            return None
+        with self.locked(cart_id):
+            state = self.load(cart_id)
+            if state is None:
+                return None
+            quantity = change(state['items'].get(product_id))
+            if quantity is None:
+                return None
+            check_quantities([quantity])
+            state['items'][product_id] = quantity
+            self.save(cart_id, state)
+        return CartItem(id=state.get('ids', {}).get(product_id), cart_id=cart_id,
+                        product_id=product_id, quantity=quantity)
+
+    def add_item(self, cart_id, product_id, quantity):
+        item = self.change_item(cart_id, product_id, lambda current: (current or 0) + quantity)
+        if item is not None and item.id is None:
+            ids = self.write_cart(item.cart_id)
+            item.id = ids.get(product_id) if ids else None
+        return item
+
+    def set_item(self, cart_id, product_id, quantity):
+        return self.change_item(cart_id, product_id, lambda current: quantity if current is not None else None)
+
+    def apply(self, cart_id, operations):
+        cart_id = parse_cart_id(cart_id)
+        if cart_id is None:
+            return False
+        with self.locked(cart_id):
+            state = self.load(cart_id)
+            if state is None:
+                return False
+            items = state['items']
+            changes = collapse_operations(operations)
+            for product_id, (op, quantity) in changes.items():
+                if op == 'remove':
+                    items.pop(product_id, None)
+                elif op == 'set':
+                    items[product_id] = quantity
+                else:
+                    items[product_id] = items.get(product_id, 0) + quantity
+            check_quantities([items[product_id] for product_id in changes if product_id in items])
+            self.save(cart_id, state)
+        return True
+
+    def remove_item(self, cart_id, product_id):
+        cart_id = parse_cart_id(cart_id)
+        if cart_id is None:
+            return False
+        with self.locked(cart_id):
+            state = self.load(cart_id)
+            if state is None or product_id not in state['items']:
+                return False
+            del state['items'][product_id]
+            self.save(cart_id, state)
+        return True
+
+    def discard(self, cart_ids):
+        self.cache.delete_many([self.key(cart_id) for cart_id in cart_ids])
+        with self.dirty_lock:
+            self.dirty.difference_update(cart_ids)
+
+    def get_summary(self, cart_id):
+        cart_id = parse_cart_id(cart_id)
+        if cart_id is None:
+            return None
+        state = self.load(cart_id)
+        if state is None:
+            return None
+        items = state['items']
+        prices = dict(Product.objects.order_by().filter(id__in=list(items))
+                      .values_list('id', Coalesce(F('price__discounted_price'), F('unit_price'))))
+        return make_summary(
+            cart_id,
+            sum(quantity for product_id, quantity in items.items() if product_id in prices),
+            sum(quantity * prices[product_id] for product_id, quantity in items.items() if product_id in prices))
+
+    def get_validator(self, cart_id):
+        cart_id = parse_cart_id(cart_id)
+        if cart_id is None:
+            return None
+        state = self.load(cart_id)
+        if state is None:
+            return None
+        # Product changes (prices) show up in the cart too
+        products = sorted(Product.objects.order_by().filter(id__in=list(state['items']))
+                          .values_list('id', 'last_update'))
+        return f"{state['version']}:{sorted(state['items'].items())}:{products}"
+
+    def flush(self, cart_ids=None):
+        if cart_ids is None:
+            with self.dirty_lock:
+                cart_ids, self.dirty = list(self.dirty), set()
+        else:
+            cart_ids = [cart_id for cart_id in map(parse_cart_id, cart_ids) if cart_id is not None]
+            with self.dirty_lock:
+                self.dirty.difference_update(cart_ids)
+        written = 0
+        for index, cart_id in enumerate(cart_ids):
+            try:
+                if self.write_cart(cart_id) is not None:
+                    written += 1
+            except Exception:
+                # Try again on the next round
+                with self.dirty_lock:
+                    self.dirty.update(cart_ids[index:])
+                raise
+        return written
+
+    def write_cart(self, cart_id):
+        '''
+        Writes the cart's rows under its lock, so pop() and delete() can
+        not run between reading the state and writing it (the rows of a
+        cart already checked out would come back and load() would return
+        it). Returns {product_id: item id}, None when the cart is gone
+        '''
+        key = self.key(cart_id)
+        with self.locked(cart_id):
+            state = self.cache.get(key)
+            if state is None:
+                return None
+            items = state['items']
+            existing = set(Product.objects.filter(id__in=list(items)).values_list('id', flat=True))
+            with transaction.atomic():
+                # New carts are inserted, existing ones get updated_at moved
+                Cart.objects.bulk_create(
+                    [Cart(id=cart_id, created_at=state['created_at'])],
+                    update_conflicts=True, unique_fields=conflict_fields('id'), update_fields=['updated_at'])
+                CartItem.objects.filter(cart_id=cart_id).exclude(product_id__in=list(existing)).delete()
+                # Upserted, so a line keeps its id
+                CartItem.objects.bulk_create(
+                    [CartItem(cart_id=cart_id, product_id=product_id, quantity=quantity)
+                     for product_id, quantity in items.items() if product_id in existing],
+                    update_conflicts=True, unique_fields=conflict_fields('cart', 'product'),
+                    update_fields=['quantity'])
+                ids = dict(CartItem.objects.filter(cart_id=cart_id).values_list('product_id', 'id'))
+                # The lock could have expired during a slow write: a cart
+                # that is gone stays gone, a newer state is written again
+                current = self.cache.get(key)
+                if current is None:
+                    transaction.set_rollback(True)
+                    return None
+                if current['version'] != state['version']:
+                    with self.dirty_lock:
+                        self.dirty.add(cart_id)
+                    return ids
+            if state.get('ids') != ids:
+                state['ids'] = ids
+                self.cache.set(key, state, self.timeout)
+        return ids
+
+    def start_flusher(self):
+        if self.flusher is not None or not self.flush_interval:
+            return
+        with self.dirty_lock:
+            if self.flusher is not None:
+                return
+            self.flusher = threading.Thread(target=self.run_flusher, name='cart-flusher', daemon=True)
+            self.flusher.start()
+            atexit.register(self.flush)
+
+    def run_flusher(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Writing carts to the database failed')
+            finally:
+                close_old_connections()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+@receiver(setting_changed)
+def reset_cart_store(setting, **kwargs):
+    global _store
+    if setting.startswith('STORE_CART_') or setting == 'CACHES':
+        _store = None
+
+
+def get_cart_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                backend = getattr(settings, 'STORE_CART_BACKEND', 'store.carts.DatabaseCartStore')
+                _store = import_string(backend)()
+    return _store
@@ -0,0 +1,147 @@
+import csv
+import json
+from django.core.exceptions import ValidationError
+from django.utils.text import slugify
+
+from store.models import Collection, Product, Promotion
+
+'''
+Shared pieces of the import_products / export_products commands
+Records are flat dicts with these keys, promotions is a list of
+promotion ids (written as "1|2" in CSV)
+'''
+FIELDS = ['id', 'title', 'slug', 'description', 'unit_price', 'inventory', 'collection', 'promotions']
+VALIDATED_FIELDS = ['title', 'slug', 'description', 'unit_price', 'inventory']
+PROMOTION_SEPARATOR = '|'
+
+
+def guess_format(path, format=None):
+    if format:
+        return format
+    return 'jsonl' if str(path).endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+def read_records(file, format):
+    if format == 'jsonl':
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+        return
+    for row in csv.DictReader(file):
+        promotions = row.get('promotions')
+        if promotions is not None:
+            row['promotions'] = [value for value in promotions.split(PROMOTION_SEPARATOR) if value]
+        yield row
+
+
+class RecordWriter:
+    def __init__(self, file, format):
+        self.file = file
+        self.format = format
+        if format == 'csv':
+            self.writer = csv.DictWriter(file, fieldnames=FIELDS)
+            self.writer.writeheader()
+
+    def write(self, record):
+        if self.format == 'jsonl':
+            self.file.write(json.dumps(record, default=str) + '\n')
+        else:
+            record = dict(record, promotions=PROMOTION_SEPARATOR.join(str(value) for value in record['promotions']))
+            self.writer.writerow(record)
+
+
+class ReferenceMaps:
+    '''
+    Collections and promotions are small tables, they are loaded once
+    and references are resolved in memory (by id or by title/description)
+    '''
+    def __init__(self):
+        self.collections = {}
+        for collection_id, title in Collection.objects.values_list('id', 'title'):
+            self.collections[str(collection_id)] = collection_id
+            self.collections.setdefault(title.strip().lower(), collection_id)
+        self.promotions = {}
+        for promotion_id, description in Promotion.objects.values_list('id', 'description'):
+            self.promotions[str(promotion_id)] = promotion_id
+            self.promotions.setdefault(description.strip().lower(), promotion_id)
+
+    def collection(self, value):
+        return self.collections.get(str(value).strip().lower())
+
+    def promotion(self, value):
+        return self.promotions.get(str(value).strip().lower())
+
+
+def validate_chunk(records, references):
+    '''
+    Runs the Product field validators column by column over a chunk
+    (no full_clean() per row, it would also run uniqueness queries).
+    Returns (clean rows, rejects) where rejects are (record, errors)
+    '''
+    errors = [dict() for _ in records]
+    columns = {}
+    for name in VALIDATED_FIELDS:
+        field = Product._meta.get_field(name)
+        values = []
+        for position, record in enumerate(records):
+            raw = record.get(name)
+            if name == 'slug' and not raw:
+                raw = slugify(record.get('title') or '')
+            if name == 'description' and raw == '':
+                raw = None
+            try:
+                value = field.to_python(raw)
+                if value is None and not field.null:
+                    raise ValidationError('This field is required.')
+                if value is not None:
+                    field.run_validators(value)
+            except ValidationError as error:
+                errors[position][name] = error.messages
+                value = None
+            values.append(value)
+        columns[name] = values
+
+    rows = []
+    rejects = []
+    for position, record in enumerate(records):
+        row = {name: columns[name][position] for name in VALIDATED_FIELDS}
+        row_errors = errors[position]
+
+        row['id'] = None
+        if record.get('id') not in (None, ''):
+            try:
+                row['id'] = int(record['id'])
+            except (TypeError, ValueError):
+                row_errors['id'] = ['A valid integer is required.']
+
+        row['collection_id'] = references.collection(record.get('collection', ''))
+        if row['collection_id'] is None:
+            row_errors['collection'] = [f"Unknown collection {record.get('collection')!r}"]
+
+        row['promotions'] = None
+        if record.get('promotions') is not None:
+            row['promotions'] = []
+            for value in record['promotions']:
+                promotion_id = references.promotion(value)
+                if promotion_id is None:
+                    row_errors.setdefault('promotions', []).append(f'Unknown promotion {value!r}')
+                row['promotions'].append(promotion_id)
+
+        if row_errors:
+            rejects.append((record, row_errors))
+        else:
+            rows.append(row)
+    return rows, rejects
+
+
+def product_record(row, promotions):
+    return {
+        'id': row['id'],
+        'title': row['title'],
+        'slug': row['slug'],
+        'description': row['description'] or '',
+        'unit_price': row['unit_price'],
+        'inventory': row['inventory'],
+        'collection': row['collection_id'],
+        'promotions': promotions,
+    }
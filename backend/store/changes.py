@@ -0,0 +1,130 @@
+from bisect import bisect_left, bisect_right
+from datetime import timedelta
+from time import monotonic
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from store.cache import get_cache, is_shared_cache
+from store.models import CatalogChange
+
+'''
+Catalog change log
+Every product write adds a CatalogChange row in its own transaction
+(store.signals, bulk writers call log_changes themselves). The
+in-process indexes read the rows added since their last catch up and
+re-read the products they name, a product that is gone was deleted. So a
+catch up costs as much as the changes, not a scan of the catalog, and
+does not depend on clocks or on how long a transaction takes.
+Ids are handed out at insert but become visible at commit, a long
+transaction can commit an id below one already read. ChangeReader keeps
+such holes and asks for them again on every read, for
+STORE_CATALOG_CHANGE_GAP_TIMEOUT seconds (a rolled back transaction
+leaves its hole for good). 'manage.py purge_catalog_changes' deletes the
+rows older than STORE_CATALOG_CHANGE_RETENTION seconds, an index saved
+before that is rebuilt instead of caught up.
+The indexes read the log when the catalog version changes. With a per
+process catalog cache (LocMemCache) the writes of other processes never
+bump it here, the log is polled every STORE_CATALOG_CHANGE_POLL_INTERVAL
+seconds instead (one indexed query when nothing changed).
+'''
+
+
+def log_changes(kind, object_ids):
+    CatalogChange.objects.bulk_create([CatalogChange(kind=kind, object_id=object_id) for object_id in set(object_ids)])
+
+
+def get_gap_timeout():
+    return timedelta(seconds=getattr(settings, 'STORE_CATALOG_CHANGE_GAP_TIMEOUT', 10 * 60))
+
+
+def get_retention():
+    return timedelta(seconds=getattr(settings, 'STORE_CATALOG_CHANGE_RETENTION', 7 * 24 * 60 * 60))
+
+
+def get_poll_interval():
+    return getattr(settings, 'STORE_CATALOG_CHANGE_POLL_INTERVAL', 2)
+
+
+def _holes(start, end, ids):
+    # Ranges of start..end not in ids (sorted)
+    holes = []
+    for change_id in ids:
+        if change_id > start:
+            holes.append((start, change_id - 1))
+        start = change_id + 1
+    if start <= end:
+        holes.append((start, end))
+    return holes
+
+
+class ChangeReader:
+    def __init__(self, position=0, gaps=()):
+        # Highest id read, and the (first, last, noticed at) id ranges
+        # below it that were not there yet
+        self.position = position
+        self.gaps = list(gaps)
+        # monotonic() of the last read, for is_poll_due()
+        self.read_at = 0
+
+    def start(self):
+        '''
+        Called before the index reads the catalog. Transactions running
+        at that point may commit ids below the newest one, so the changes
+        of the last gap timeout are read again on the first catch up
+        '''
+        cutoff = timezone.now() - get_gap_timeout()
+        self.position = CatalogChange.objects.filter(created_at__lt=cutoff) \
+            .order_by('-id').values_list('id', flat=True).first() or 0
+        self.gaps = []
+        self.read_at = monotonic()
+
+    def is_poll_due(self):
+        '''
+        Whether to read although the catalog version did not change, only
+        when the version is not shared by the processes
+        '''
+        if is_shared_cache(get_cache()):
+            return False
+        return monotonic() - self.read_at >= get_poll_interval()
+
+    def read(self):
+        '''
+        {kind: set of object ids} changed since the last read
+        '''
+        self.read_at = monotonic()
+        now = timezone.now()
+        expired = now - get_gap_timeout()
+        gaps = [gap for gap in self.gaps if gap[2] > expired]
+        condition = Q(id__gt=self.position)
+        for first, last, _ in gaps:
+            condition |= Q(id__range=(first, last))
+        rows = list(CatalogChange.objects.filter(condition).order_by('id').values_list('id', 'kind', 'object_id'))
+
+        changes = {}
+        for _, kind, object_id in rows:
+            changes.setdefault(kind, set()).add(object_id)
+        ids = [change_id for change_id, _, _ in rows]
+        self.gaps = []
+        for first, last, noticed in gaps:
+            seen = ids[bisect_left(ids, first):bisect_right(ids, last)]
+            self.gaps.extend((start, end, noticed) for start, end in _holes(first, last, seen))
+        if ids and ids[-1] > self.position:
+            seen = ids[bisect_right(ids, self.position):]
+            self.gaps.extend((start, end, now) for start, end in _holes(self.position + 1, ids[-1], seen))
+            self.position = ids[-1]
+        return changes
+
+    def state(self):
+        return {'position': self.position, 'gaps': self.gaps}
+
+
+def purge_changes(batch_size=1000):
+    cutoff = timezone.now() - get_retention()
+    purged = 0
+    while True:
+        ids = list(CatalogChange.objects.filter(created_at__lt=cutoff)
+                   .order_by('id').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return purged
+        purged += CatalogChange.objects.filter(id__in=ids).delete()[0]
@@ -0,0 +1,192 @@
+import logging
+import time
+from django.conf import settings
+from django.db import OperationalError, close_old_connections, transaction
+from django.db.models import F
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from store.carts import get_cart_store
+from store.inventory import InsufficientStock, reserve
+from store.models import Cart, CartItem, CheckoutJob, Order, OrderItem, OrderSummary, Product
+
+logger = logging.getLogger(__name__)
+
+'''
+Queued checkout
+With STORE_CHECKOUT_QUEUE on, POST /store/orders/ validates the cart,
+freezes it (its items are copied to a CheckoutJob and the cart is taken
+out of the cart store, so a change made after the 202 can not go
+missing from the order) and answers 202, the client polls
+/store/checkouts/<id>/. 'manage.py run_checkout_workers' places the
+orders: each worker locks a batch of the oldest queued jobs (SKIP
+LOCKED, so workers never wait on each other) and handles the whole
+batch in one transaction. Orders are inserted one by one (their ids are
+needed and MySQL does not return them from bulk inserts) with a
+savepoint each, so one failing order fails only its own job; the items
+and summaries of the batch are single statements. A failed job gives
+the cart back. When the batch itself fails its jobs are placed one by
+one, and a job that fails alone is marked failed, so a bad job never
+blocks the queue. A worker that dies mid batch rolls back and its jobs
+are queued again, as are jobs hit by a lost connection or a lock
+timeout (OperationalError).
+'''
+
+
+def enqueue(customer_id, cart_id):
+    '''
+    Freezes the cart into a queued job, returns None when the cart is
+    gone or empty (checked out by a concurrent request). pop() is not
+    part of the transaction with every store (CachedCartStore), so when
+    the job can not be written the cart is put back
+    '''
+    store = get_cart_store()
+    items = store.pop(cart_id)
+    if not items:
+        if items is not None:
+            # An empty cart stays
+            store.restore(cart_id, items)
+        return None
+    try:
+        return CheckoutJob.objects.create(
+            customer_id=customer_id, cart_id=cart_id, items=[[product_id, quantity] for product_id, quantity in items.items()])
+    except Exception:
+        store.restore(cart_id, items)
+        raise
+
+
+def price_items(jobs):
+    # {product_id: unit_price} of the jobs' products, priced like
+    # Product.effective_price
+    product_ids = {product_id for job in jobs for product_id, _ in job.items}
+    return dict(Product.objects.order_by().filter(id__in=product_ids)
+                .values_list('id', Coalesce(F('price__discounted_price'), F('unit_price'))))
+
+
+def restore_carts(jobs, prices):
+    # Failed jobs give the cart back as it was queued, like the cart
+    # store the items of products deleted since are dropped
+    Cart.objects.bulk_create([Cart(id=job.cart_id) for job in jobs], ignore_conflicts=True)
+    CartItem.objects.bulk_create([
+        CartItem(cart_id=job.cart_id, product_id=product_id, quantity=quantity)
+        for job in jobs for product_id, quantity in job.items if product_id in prices], ignore_conflicts=True)
+
+
+def place_jobs(batch_size, job_ids=None):
+    with transaction.atomic():
+        jobs = CheckoutJob.objects.select_for_update(skip_locked=True).filter(status=CheckoutJob.STATUS_QUEUED)
+        if job_ids is not None:
+            jobs = jobs.filter(id__in=job_ids)
+        jobs = list(jobs.order_by('created_at')[:batch_size])
+        if not jobs:
+            return 0
+        prices = price_items(jobs)
+        now = timezone.now()
+        placed = []
+        failed = []
+        for job in jobs:
+            job.finished_at = now
+            job.status = CheckoutJob.STATUS_FAILED
+            rows = [(product_id, quantity, prices[product_id]) for product_id, quantity in job.items
+                    if product_id in prices]
+            if not rows:
+                job.error = 'Cart is empty'
+                failed.append(job)
+                continue
+            try:
+                with transaction.atomic():
+                    order = Order.objects.create(customer_id=job.customer_id)
+                    reserve(order, {product_id: quantity for product_id, quantity, _ in rows})
+            except InsufficientStock as error:
+                job.error = str(error)[:255]
+                failed.append(job)
+                continue
+            except OperationalError:
+                raise
+            except Exception as error:
+                logger.exception('Checkout job %s failed', job.id)
+                job.error = f'Checkout failed: {error}'[:255]
+                failed.append(job)
+                continue
+            job.status = CheckoutJob.STATUS_DONE
+            job.order = order
+            placed.append((job, order, rows))
+
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product_id=product_id, quantity=quantity, unit_price=unit_price)
+            for _, order, rows in placed for product_id, quantity, unit_price in rows])
+        OrderSummary.objects.bulk_create([
+            OrderSummary(
+                order=order,
+                customer_id=order.customer_id,
+                placed_at=order.placed_at,
+                payment_status=order.payment_status,
+                item_count=sum(quantity for _, quantity, _ in rows),
+                total_amount=sum(unit_price * quantity for _, quantity, unit_price in rows))
+            for _, order, rows in placed])
+        restore_carts(failed, prices)
+        CheckoutJob.objects.bulk_update(jobs, ['status', 'order', 'error', 'finished_at'])
+    return len(jobs)
+
+
+def fail_job(job_id, error):
+    with transaction.atomic():
+        job = CheckoutJob.objects.select_for_update(skip_locked=True) \
+            .filter(id=job_id, status=CheckoutJob.STATUS_QUEUED).first()
+        if job is None:
+            return 0
+        job.status = CheckoutJob.STATUS_FAILED
+        job.error = f'Checkout failed: {error}'[:255]
+        job.finished_at = timezone.now()
+        job.save(update_fields=['status', 'error', 'finished_at'])
+        restore_carts([job], price_items([job]))
+    return 1
+
+
+def place_batch(batch_size=None):
+    '''
+    Places the orders of one batch of queued jobs, returns the number of
+    jobs handled (0 when the queue is empty)
+    '''
+    batch_size = batch_size or getattr(settings, 'STORE_CHECKOUT_BATCH_SIZE', 50)
+    try:
+        return place_jobs(batch_size)
+    except OperationalError:
+        raise
+    except Exception:
+        logger.exception('Checkout batch failed, placing its jobs one by one')
+    job_ids = list(CheckoutJob.objects.filter(status=CheckoutJob.STATUS_QUEUED)
+                   .order_by('created_at').values_list('id', flat=True)[:batch_size])
+    handled = 0
+    for job_id in job_ids:
+        try:
+            handled += place_jobs(1, [job_id])
+        except OperationalError:
+            raise
+        except Exception as error:
+            logger.exception('Checkout job %s failed', job_id)
+            handled += fail_job(job_id, error)
+    return handled
+
+
+def run_worker(batch_size=None, poll_interval=None, once=False):
+    '''
+    Worker loop, drains the queue and sleeps poll_interval seconds when
+    it is empty. once=True returns as soon as the queue is empty
+    '''
+    poll_interval = poll_interval if poll_interval is not None else \
+        getattr(settings, 'STORE_CHECKOUT_POLL_INTERVAL', 0.5)
+    handled = 0
+    while True:
+        close_old_connections()
+        try:
+            count = place_batch(batch_size)
+        except Exception:
+            logger.exception('Checkout batch failed')
+            count = 0
+        handled += count
+        if count:
+            continue
+        if once:
+            return handled
+        time.sleep(poll_interval)
@@ -0,0 +1,112 @@
+from collections.abc import Mapping
+from operator import attrgetter, itemgetter
+from django.conf import settings
+from django.db.models import Model
+from rest_framework import serializers
+from rest_framework.fields import SkipField
+from rest_framework.relations import PKOnlyObject, PrimaryKeyRelatedField
+
+'''
+Read-only fast path for serializers
+DRF resolves every field of every row through Field.get_attribute()
+(source traversal, callable checks, exception handling). Most of our
+fields are plain model attributes, so the first time a serializer
+instance renders a row we build a plan: one (name, getter,
+to_representation) entry per readable field, with the getter already
+reduced to an attrgetter/itemgetter where that is safe. Anything the
+plan does not understand goes through the normal DRF path, so the
+output is the same as ModelSerializer.to_representation().
+Plans are kept per serializer instance because fields are bound to
+their serializer (context, parent); with many=True that means one
+plan per request. Rows can be model instances or .values() dicts.
+'''
+IDENTITY = lambda value: value
+
+
+def _model_field(model, name):
+    if model is None:
+        return None
+    try:
+        return model._meta.get_field(name)
+    except Exception:
+        return None
+
+
+def _compile_field(serializer, field, model, dict_rows):
+    '''
+    Returns (getter, to_representation) or None for the generic path
+    '''
+    if isinstance(field, serializers.SerializerMethodField):
+        return IDENTITY, getattr(serializer, field.method_name)
+    if field.source == '*' or len(field.source_attrs) != 1:
+        return None
+    source = field.source_attrs[0]
+
+    if dict_rows:
+        # .values() rows only carry plain columns (relations come as ids)
+        if isinstance(field, serializers.BaseSerializer):
+            return None
+        if isinstance(field, PrimaryKeyRelatedField):
+            return (itemgetter(source), IDENTITY) if field.pk_field is None else None
+        return itemgetter(source), field.to_representation
+
+    model_field = _model_field(model, source)
+    if model_field is None:
+        return None
+    if isinstance(field, PrimaryKeyRelatedField):
+        # Same as the pk only optimization, read the <name>_id column
+        if field.pk_field is not None or not model_field.many_to_one:
+            return None
+        return attrgetter(model_field.attname), IDENTITY
+    if model_field.is_relation:
+        # Reverse one-to-one raises DoesNotExist, leave it to DRF
+        if model_field.one_to_one and not model_field.concrete:
+            return None
+        return attrgetter(source), field.to_representation
+    if not model_field.concrete:
+        return None
+    return attrgetter(source), field.to_representation
+
+
+def compile_plan(serializer, dict_rows=False):
+    model = getattr(getattr(serializer, 'Meta', None), 'model', None)
+    plan = []
+    for field in serializer._readable_fields:
+        compiled = _compile_field(serializer, field, model, dict_rows)
+        if compiled is None:
+            plan.append((field.field_name, field, None, True))
+        else:
+            getter, to_representation = compiled
+            plan.append((field.field_name, getter, to_representation, False))
+    return plan
+
+
+class CompiledRepresentationMixin:
+    '''
+    Put it before ModelSerializer in the bases. Turned off with
+    STORE_COMPILED_SERIALIZERS = False
+    '''
+    def to_representation(self, instance):
+        if not getattr(settings, 'STORE_COMPILED_SERIALIZERS', True):
+            return super().to_representation(instance)
+
+        dict_rows = isinstance(instance, Mapping) and not isinstance(instance, Model)
+        plans = self.__dict__.setdefault('_compiled_plans', {})
+        plan = plans.get(dict_rows)
+        if plan is None:
+            plan = plans[dict_rows] = compile_plan(self, dict_rows)
+
+        ret = {}
+        for name, getter, to_representation, generic in plan:
+            if generic:
+                field = getter
+                try:
+                    attribute = field.get_attribute(instance)
+                except SkipField:
+                    continue
+                check_for_none = attribute.pk if isinstance(attribute, PKOnlyObject) else attribute
+                ret[name] = None if check_for_none is None else field.to_representation(attribute)
+                continue
+            value = getter(instance)
+            ret[name] = None if value is None else to_representation(value)
+        return ret
@@ -0,0 +1,87 @@
+from hashlib import md5
+from django.core.exceptions import ValidationError
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+from store.cache import CatalogCacheMixin, get_cache, normalize_query_params
+
+'''
+Conditional GET for viewsets
+Views give a cheap validator (one small query, no serialization):
+get_list_validator(queryset) and get_detail_validator(pk) return
+(etag_source, last_modified) or None when there is nothing to compare.
+If the client's If-None-Match / If-Modified-Since still matches we
+answer 304 before the real queryset is evaluated.
+Last-Modified is only sent for single objects, a max(last_update) does
+not move when a row is deleted from a list, the ETag (which also
+contains the row count) does.
+'''
+class ConditionalGetMixin:
+    conditional_private = False
+
+    def get_list_validator(self, queryset):
+        return None
+
+    def get_detail_validator(self, pk):
+        return None
+
+    def make_etag(self, request, source):
+        key = f'{source}|{request.path}|{normalize_query_params(request.query_params)}|{request.headers.get("Accept", "")}'
+        return '"{}"'.format(md5(key.encode()).hexdigest())
+
+    def get_validator(self, request, compute):
+        # Catalog views cache their validators next to the responses,
+        # a revalidation then costs no query at all
+        if isinstance(self, CatalogCacheMixin):
+            key = self.get_cache_key(request, f'{self.cache_endpoint}-validator-{self.action}')
+            cache = get_cache()
+            validator = cache.get(key)
+            if validator is None:
+                validator = compute()
+                if validator is not None:
+                    cache.set(key, validator)
+            return validator
+        return compute()
+
+    def conditional_response(self, request, compute, handler, *args, **kwargs):
+        validator = self.get_validator(request, compute)
+        if validator is None:
+            return handler(request, *args, **kwargs)
+
+        source, last_modified = validator
+        etag = self.make_etag(request, source)
+        not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        response = not_modified or handler(request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+            # Clients may keep the response but have to revalidate it
+            if self.conditional_private:
+                patch_cache_control(response, no_cache=True, private=True)
+            else:
+                patch_cache_control(response, no_cache=True)
+        return response
+
+
+# Kept apart because routers only add a list route when the view has list()
+class ConditionalListMixin(ConditionalGetMixin):
+    def list(self, request, *args, **kwargs):
+        compute = lambda: self.get_list_validator(self.filter_queryset(self.get_queryset()).order_by())
+        return self.conditional_response(request, compute, super().list, *args, **kwargs)
+
+
+class ConditionalRetrieveMixin(ConditionalGetMixin):
+    def retrieve(self, request, *args, **kwargs):
+        pk = kwargs[self.lookup_url_kwarg or self.lookup_field]
+        try:
+            pk = self.get_queryset().model._meta.pk.to_python(pk)
+        except ValidationError:
+            # Malformed pk, let the normal path answer 404
+            return super().retrieve(request, *args, **kwargs)
+        compute = lambda: self.get_detail_validator(pk)
+        return self.conditional_response(request, compute, super().retrieve, *args, **kwargs)
+
+
+def timestamp(value):
+    return int(value.timestamp()) if value is not None else None
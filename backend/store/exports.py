@@ -0,0 +1,53 @@
+from rest_framework import serializers
+from rest_framework.utils.encoders import JSONEncoder
+
+from store.models import OrderItem
+
+'''
+Streaming order export
+Orders are read in batches by primary key (WHERE id > last id LIMIT n,
+QuerySet.iterator() does not stream on MySQL, the driver buffers the
+whole result) and one query per batch fetches the items of all its
+orders joined with their product, so a batch costs two queries
+whatever its size. Rows are plain
+.values() dicts, nothing is kept once its line is written. The record
+shape is the same as OrderSerializer (decimals as numbers, like the
+API with COERCE_DECIMAL_TO_STRING off).
+'''
+ORDER_COLUMNS = ['id', 'customer_id', 'placed_at', 'payment_status']
+ITEM_COLUMNS = ['order_id', 'id', 'product_id', 'product__title', 'product__unit_price', 'unit_price', 'quantity']
+
+
+def iter_order_records(queryset, chunk_size=1000):
+    placed_at = serializers.DateTimeField()
+    orders = queryset.order_by('id').values(*ORDER_COLUMNS)
+    last_id = None
+    while True:
+        page = orders if last_id is None else orders.filter(id__gt=last_id)
+        batch = list(page[:chunk_size])
+        if not batch:
+            return
+        last_id = batch[-1]['id']
+        items = {}
+        for item in OrderItem.objects.filter(order_id__in=[order['id'] for order in batch]) \
+                .order_by('order_id', 'id').values(*ITEM_COLUMNS):
+            items.setdefault(item['order_id'], []).append({
+                'id': item['id'],
+                'product': {
+                    'id': item['product_id'],
+                    'title': item['product__title'],
+                    'unit_price': item['product__unit_price'],
+                },
+                'unit_price': item['unit_price'],
+                'quantity': item['quantity'],
+            })
+        for order in batch:
+            order['placed_at'] = placed_at.to_representation(order['placed_at'])
+            order['items'] = items.get(order['id'], [])
+            yield order
+
+
+def ndjson_lines(records):
+    encoder = JSONEncoder()
+    for record in records:
+        yield encoder.encode(record) + '\n'
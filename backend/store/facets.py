@@ -0,0 +1,95 @@
+from hashlib import md5
+from django.conf import settings
+from django.db.models import Case, Count, IntegerField, Value, When
+from rest_framework.exceptions import ValidationError
+
+from store.cache import get_cache, get_catalog_version, normalize_query_params
+
+'''
+Facet counts for the product list
+?facets=collection,price adds a "facets" object to the list response
+with the number of matching products per collection and per price
+bucket, for the current filters. All facets come from one GROUP BY
+(collection, price bucket) query, the per facet counts are sums over
+its rows. Counts only depend on the filter parameters (not on page or
+ordering) and are cached under the catalog version.
+Buckets are bounded by STORE_PRICE_FACET_BUCKETS, e.g. [25, 50] gives
+0-25, 25-50 and 50+.
+'''
+FACETS_PARAM = 'facets'
+FACETS = ['collection', 'price']
+DEFAULT_PRICE_BUCKETS = [25, 50, 100, 250]
+
+
+def get_price_buckets():
+    return getattr(settings, 'STORE_PRICE_FACET_BUCKETS', DEFAULT_PRICE_BUCKETS)
+
+
+def price_bucket(field='unit_price'):
+    bounds = get_price_buckets()
+    return Case(*[When(**{f'{field}__lt': bound}, then=Value(position)) for position, bound in enumerate(bounds)],
+                default=Value(len(bounds)), output_field=IntegerField())
+
+
+def compute_facets(queryset):
+    bounds = get_price_buckets()
+    rows = queryset.order_by() \
+        .annotate(price_bucket=price_bucket()) \
+        .values('collection_id', 'collection__title', 'price_bucket') \
+        .annotate(count=Count('pk'))
+
+    collections = {}
+    buckets = [0] * (len(bounds) + 1)
+    for row in rows:
+        collection = collections.setdefault(row['collection_id'], {
+            'id': row['collection_id'], 'title': row['collection__title'], 'count': 0})
+        collection['count'] += row['count']
+        buckets[row['price_bucket']] += row['count']
+
+    lower = [0] + list(bounds)
+    upper = list(bounds) + [None]
+    return {
+        'collection': sorted(collections.values(), key=lambda collection: collection['title']),
+        'price': [{'min': lower[position], 'max': upper[position], 'count': count}
+                  for position, count in enumerate(buckets)],
+    }
+
+
+class FacetsMixin:
+    '''
+    Viewset side. Only the parameters which change the queryset (the
+    filterset fields and the search) are part of the cache key
+    '''
+    def get_requested_facets(self, request):
+        value = request.query_params.get(FACETS_PARAM, '')
+        names = [name.strip() for name in value.split(',') if name.strip()]
+        unknown = [name for name in names if name not in FACETS]
+        if unknown:
+            raise ValidationError({FACETS_PARAM: f"Unknown facets: {', '.join(unknown)}. Choose from {', '.join(FACETS)}"})
+        return names
+
+    def get_facets_cache_key(self, request):
+        names = set(self.filterset_class.get_filters()) | {'search'}
+        params = request.query_params.copy()
+        for key in list(params):
+            if key not in names:
+                del params[key]
+        digest = md5(f'{normalize_query_params(params)}:{get_price_buckets()}'.encode()).hexdigest()
+        return f'catalog:{get_catalog_version()}:facets:{digest}'
+
+    def get_facets(self, request, queryset):
+        cache = get_cache()
+        key = self.get_facets_cache_key(request)
+        facets = cache.get(key)
+        if facets is None:
+            facets = compute_facets(queryset)
+            cache.set(key, facets, getattr(settings, 'STORE_CATALOG_CACHE_TIMEOUT', 300))
+        return facets
+
+    def list(self, request, *args, **kwargs):
+        names = self.get_requested_facets(request)
+        response = super().list(request, *args, **kwargs)
+        if names and response.status_code == 200 and isinstance(response.data, dict):
+            facets = self.get_facets(request, self.filter_queryset(self.get_queryset()))
+            response.data['facets'] = {name: facets[name] for name in names}
+        return response
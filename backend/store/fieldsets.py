@@ -0,0 +1,95 @@
+'''
+Sparse fieldsets
+?fields=id,title,unit_price trims a GET response to those fields and
+?expand=images adds nested relations on top of them. Besides the
+payload the selection also drives the queryset: only() the columns the
+fields read, and prefetch only the relations that were asked for.
+Serializers describe what their fields need in Meta:
+    sparse_only = {'price_with_tax': ['unit_price']}   # columns, default is the field's own column
+    sparse_prefetch = {'images': ['images']}           # prefetch_related lookups
+    sparse_select = {'price_with_tax': ['price']}      # select_related lookups
+'''
+FIELDS_PARAM = 'fields'
+EXPAND_PARAM = 'expand'
+
+
+def parse_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+class SparseFieldsMixin:
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Nested serializers get their context when they are bound, so
+        # only the top level serializer (or its many=True child) trims
+        requested = self.get_requested_fields(self.context.get('request'))
+        if requested is not None:
+            for name in list(self.fields):
+                if name not in requested:
+                    self.fields.pop(name)
+
+    @classmethod
+    def get_requested_fields(cls, request):
+        if request is None or request.method != 'GET':
+            return None
+        fields = parse_list(request.query_params.get(FIELDS_PARAM, ''))
+        if not fields:
+            return None
+        return set(fields) | set(parse_list(request.query_params.get(EXPAND_PARAM, '')))
+
+    @classmethod
+    def optimize_queryset(cls, queryset, requested, extra_columns=()):
+        meta = cls.Meta
+        sparse_only = getattr(meta, 'sparse_only', {})
+        sparse_prefetch = getattr(meta, 'sparse_prefetch', {})
+        sparse_select = getattr(meta, 'sparse_select', {})
+        declared = cls._declared_fields
+
+        columns = {'pk', *extra_columns}
+        lookups = []
+        related = []
+        for name in requested:
+            if name in sparse_only:
+                columns.update(sparse_only[name])
+            elif name in meta.fields:
+                source = getattr(declared.get(name), 'source', None) or name
+                model_field = _concrete_field(meta.model, source)
+                if model_field is not None:
+                    columns.add(model_field.name)
+            for lookup in sparse_prefetch.get(name, []):
+                if lookup not in lookups:
+                    lookups.append(lookup)
+            for lookup in sparse_select.get(name, []):
+                if lookup not in related:
+                    related.append(lookup)
+        queryset = queryset.prefetch_related(None).prefetch_related(*lookups)
+        # only() has to leave the selected relations loadable
+        queryset = queryset.select_related(None).select_related(*related)
+        return queryset.only(*columns, *related)
+
+
+def _concrete_field(model, name):
+    try:
+        field = model._meta.get_field(name)
+    except Exception:
+        return None
+    return field if field.concrete else None
+
+
+class SparseQuerysetMixin:
+    '''
+    Viewset side: shapes the queryset after the fields the serializer
+    will render. Hooked on filter_queryset() so views that override
+    get_queryset() keep working. Keyset ordering columns are always
+    loaded because the paginator reads them from the last row
+    '''
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        serializer_class = self.get_serializer_class()
+        if not issubclass(serializer_class, SparseFieldsMixin):
+            return queryset
+        requested = serializer_class.get_requested_fields(self.request)
+        if requested is None:
+            return queryset
+        return serializer_class.optimize_queryset(
+            queryset, requested, extra_columns=getattr(self, 'keyset_ordering_fields', []))
@@ -0,0 +1,56 @@
+import os
+from contextlib import contextmanager
+from time import monotonic, sleep, time
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.filebased import FileBasedCache
+
+'''
+Local stand-in for the Redis 'carts' cache (settings.CACHES)
+Entries are files, so every worker process of the host sees the same
+carts, and under /dev/shm they never touch the disk. Two things
+FileBasedCache does not do and CachedCartStore needs:
+  add() is atomic between processes (the cart locks are cache.add)
+  entries are never culled, a cart is only gone when it expires or
+  is deleted, not before it was written to the database
+One host only, production uses Redis.
+'''
+
+
+class LocalCartCache(FileBasedCache):
+    # A lock file older than this belongs to a dead process
+    lock_timeout = 5
+
+    def _cull(self):
+        pass
+
+    @contextmanager
+    def key_lock(self, key, version=None):
+        self._createdir()
+        path = self._key_to_file(key, version) + '.lock'
+        deadline = monotonic() + self.lock_timeout
+        while True:
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                pass
+            try:
+                if time() - os.path.getmtime(path) > self.lock_timeout:
+                    os.remove(path)
+                    continue
+            except FileNotFoundError:
+                continue
+            if monotonic() > deadline:
+                raise TimeoutError(f'Cache key {key} stays locked ({path})')
+            sleep(0.0005)
+        try:
+            yield
+        finally:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        with self.key_lock(key, version):
+            return super().add(key, value, timeout, version)
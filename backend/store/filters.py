@@ -1,6 +1,6 @@
 from django_filters.rest_framework import FilterSet
 
-from store.models import Product
+from store.models import DailyCollectionSales, DailyProductSales, MonthlyCustomerSales, Order, Product
 
 
 class ProductFilter(FilterSet):
@@ -11,4 +11,40 @@ class ProductFilter(FilterSet):
             'unit_price':['gt','lt'],
             'title':['istartswith']
 
-    }
\ No newline at end of file
+    }
+
+
+class OrderExportFilter(FilterSet):
+    class Meta:
+        model = Order
+        fields = {
+            'placed_at':['gte','lte'],
+            'payment_status':['exact']
+        }
+
+
+class DailyProductSalesFilter(FilterSet):
+    class Meta:
+        model = DailyProductSales
+        fields = {
+            'date':['gte','lte'],
+            'product_id':['exact']
+        }
+
+
+class DailyCollectionSalesFilter(FilterSet):
+    class Meta:
+        model = DailyCollectionSales
+        fields = {
+            'date':['gte','lte'],
+            'collection_id':['exact']
+        }
+
+
+class MonthlyCustomerSalesFilter(FilterSet):
+    class Meta:
+        model = MonthlyCustomerSales
+        fields = {
+            'month':['gte','lte'],
+            'customer_id':['exact']
+        }
@@ -0,0 +1,131 @@
+import json
+from datetime import timedelta
+from hashlib import sha256
+from time import monotonic, sleep
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+from store.models import IdempotencyKey
+
+'''
+Idempotency keys
+A client that retries a POST sends the same Idempotency-Key header and
+gets the stored response of the first attempt back, the view does not
+run again. Keys belong to the user (or, for anonymous requests, to the
+path, which holds the cart id) and are kept STORE_IDEMPOTENCY_TTL
+seconds.
+The first request inserts the key row before it runs, the unique
+(scope, key) constraint makes it the lock: a concurrent duplicate waits
+up to STORE_IDEMPOTENCY_WAIT seconds for the response and then gets a
+409. Only successful responses are stored (their body and the
+REPLAYED_HEADERS they carry), after an error the key is released so the
+retry runs for real. Reusing a key with a different body is a 422.
+'''
+HEADER = 'Idempotency-Key'
+REPLAYED_HEADERS = ['Location', 'Content-Location', 'Retry-After']
+MAX_KEY_LENGTH = 255
+POLL_INTERVAL = 0.05
+
+
+def get_scope(request):
+    user = request.user.pk if request.user and request.user.is_authenticated else 'anon'
+    return f'{user} {request.method} {request.path}'[:255]
+
+
+def get_request_hash(request):
+    data = request.data
+    if hasattr(data, 'lists'):
+        data = dict(data.lists())
+    payload = json.dumps(data, cls=JSONEncoder, sort_keys=True)
+    return sha256(payload.encode()).hexdigest()
+
+
+def claim(scope, key, request_hash):
+    '''
+    Returns (True, row) when this request owns the key, else (False, row)
+    with the row of the earlier request (finished, still running after
+    the wait, or for another body)
+    '''
+    lock_timeout = getattr(settings, 'STORE_IDEMPOTENCY_LOCK_TIMEOUT', 60)
+    deadline = monotonic() + getattr(settings, 'STORE_IDEMPOTENCY_WAIT', 10)
+    while True:
+        try:
+            with transaction.atomic():
+                row = IdempotencyKey.objects.create(
+                    scope=scope, key=key, request_hash=request_hash,
+                    expires_at=timezone.now() + timedelta(seconds=lock_timeout))
+            return True, row
+        except IntegrityError:
+            pass
+        row = IdempotencyKey.objects.filter(scope=scope, key=key).first()
+        if row is None:
+            continue
+        if row.expires_at <= timezone.now():
+            # Expired response, or a lock left by a request that died
+            IdempotencyKey.objects.filter(pk=row.pk, expires_at=row.expires_at).delete()
+            continue
+        if row.request_hash != request_hash or row.status_code is not None or monotonic() > deadline:
+            return False, row
+        sleep(POLL_INTERVAL)
+
+
+def replay(row, request_hash):
+    if row.request_hash != request_hash:
+        return Response({'detail': f'{HEADER} was already used for a different request'},
+                        status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+    if row.status_code is None:
+        return Response({'detail': f'A request with this {HEADER} is still in progress'},
+                        status=status.HTTP_409_CONFLICT)
+    response = Response(row.response, status=row.status_code, headers=row.headers)
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+class IdempotencyMixin:
+    '''
+    Viewset side: create() honours the header, other actions opt in by
+    wrapping their handler with idempotent_response()
+    '''
+    def idempotent_response(self, request, handler, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if not key:
+            return handler(request, *args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return Response({'detail': f'{HEADER} is longer than {MAX_KEY_LENGTH} characters'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        request_hash = get_request_hash(request)
+        owned, row = claim(get_scope(request), key, request_hash)
+        if not owned:
+            return replay(row, request_hash)
+        try:
+            response = handler(request, *args, **kwargs)
+        except Exception:
+            row.delete()
+            raise
+        if not status.is_success(response.status_code):
+            row.delete()
+            return response
+        # Stored as it will be rendered, decimals and uuids included
+        row.response = json.loads(json.dumps(response.data, cls=JSONEncoder))
+        row.status_code = response.status_code
+        row.headers = {name: response[name] for name in REPLAYED_HEADERS if response.has_header(name)}
+        row.expires_at = timezone.now() + timedelta(seconds=getattr(settings, 'STORE_IDEMPOTENCY_TTL', 24 * 60 * 60))
+        row.save(update_fields=['response', 'status_code', 'headers', 'expires_at'])
+        return response
+
+    def create(self, request, *args, **kwargs):
+        return self.idempotent_response(request, super().create, *args, **kwargs)
+
+
+def purge_expired(batch_size=1000):
+    purged = 0
+    while True:
+        ids = list(IdempotencyKey.objects.filter(expires_at__lt=timezone.now())
+                   .order_by('expires_at').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return purged
+        purged += IdempotencyKey.objects.filter(id__in=ids).delete()[0]
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from store.cache import bump_catalog_version
+from store.models import Product, ProductImage
+from store.rendering import render_variant
+
+'''
+Resized variants of product images
+Every upload gets the variants listed in STORE_IMAGE_VARIANTS (WebP
+and JPEG). Decoding and encoding run in a process pool (started with
+forkserver or spawn, see store/rendering.py), the request
+that uploaded the image only schedules the work after commit, so its
+latency does not depend on the image.
+Variant files are content addressed: the name is the sha256 of the
+source bytes plus the variant spec, so re-uploads of the same picture
+share their files and nothing is rendered twice. Because files can be
+shared they are not deleted together with a ProductImage.
+ProductImage.variants maps the variant name to its storage path.
+'''
+logger = logging.getLogger(__name__)
+
+DEFAULT_VARIANTS = {
+    'thumbnail': {'width': 160, 'height': 160, 'format': 'WEBP', 'quality': 80},
+    'medium': {'width': 640, 'height': 640, 'format': 'WEBP', 'quality': 82},
+    'medium_jpeg': {'width': 640, 'height': 640, 'format': 'JPEG', 'quality': 85},
+}
+EXTENSIONS = {'WEBP': 'webp', 'JPEG': 'jpg', 'PNG': 'png'}
+VARIANTS_DIR = 'store/variants'
+
+
+def get_variant_specs():
+    return getattr(settings, 'STORE_IMAGE_VARIANTS', DEFAULT_VARIANTS)
+
+
+def variant_path(source_digest, spec):
+    key = hashlib.sha256(f'{source_digest}:{json.dumps(spec, sort_keys=True)}'.encode()).hexdigest()
+    return f'{VARIANTS_DIR}/{key[:2]}/{key}.{EXTENSIONS[spec["format"]]}'
+
+
+_lock = threading.Lock()
+_process_pool = None
+_dispatcher = None
+
+
+def get_process_pool():
+    global _process_pool
+    with _lock:
+        if _process_pool is None:
+            # Never fork: this runs in a thread of a threaded web worker
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            _process_pool = ProcessPoolExecutor(
+                max_workers=getattr(settings, 'STORE_IMAGE_WORKERS', None), mp_context=context)
+        return _process_pool
+
+
+def generate_variants(image_id, force=False):
+    '''
+    Renders the missing variants of one image and stores their paths.
+    Returns the number of files written
+    '''
+    row = ProductImage.objects.filter(pk=image_id).values('image', 'variants', 'product_id').first()
+    if row is None or not row['image']:
+        return 0
+    specs = get_variant_specs()
+    with default_storage.open(row['image'], 'rb') as file:
+        data = file.read()
+    digest = hashlib.sha256(data).hexdigest()
+
+    variants = {name: variant_path(digest, spec) for name, spec in specs.items()}
+    if variants == row['variants'] and not force:
+        return 0
+    pending = {name: spec for name, spec in specs.items()
+               if force or not default_storage.exists(variants[name])}
+    if pending:
+        pool = get_process_pool()
+        futures = {name: pool.submit(render_variant, data, spec) for name, spec in pending.items()}
+        for name, future in futures.items():
+            path = variants[name]
+            if default_storage.exists(path):
+                default_storage.delete(path)
+            variants[name] = default_storage.save(path, ContentFile(future.result()))
+
+    with transaction.atomic():
+        ProductImage.objects.filter(pk=image_id).update(variants=variants)
+        # update() sends no signals, do what the ProductImage ones would
+        Product.objects.filter(pk=row['product_id']).update(last_update=timezone.now())
+        transaction.on_commit(bump_catalog_version)
+    return len(pending)
+
+
+def _generate_in_background(image_id):
+    try:
+        generate_variants(image_id)
+    except Exception:
+        logger.exception('Generating variants of product image %s failed', image_id)
+    finally:
+        close_old_connections()
+
+
+def schedule_variants(image_id):
+    '''
+    Hands the image to a background thread which drives the process
+    pool, with STORE_IMAGE_PROCESSING = 'sync' it is done inline
+    '''
+    global _dispatcher
+    if getattr(settings, 'STORE_IMAGE_PROCESSING', 'background') == 'sync':
+        generate_variants(image_id)
+        return
+    with _lock:
+        if _dispatcher is None:
+            _dispatcher = ThreadPoolExecutor(max_workers=2, thread_name_prefix='image-variants')
+    _dispatcher.submit(_generate_in_background, image_id)
+
+
+def variant_urls(image, request=None):
+    urls = {}
+    for name, path in (image.variants or {}).items():
+        url = default_storage.url(path)
+        urls[name] = request.build_absolute_uri(url) if request is not None else url
+    return urls
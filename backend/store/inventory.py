@@ -0,0 +1,190 @@
+import random
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Sum, Value, When
+from django.utils import timezone
+
+from store.cache import bump_catalog_version
+from store.models import InventoryReservation, InventoryShard, Order, OrderSummary, Product
+
+'''
+Inventory reservation
+Checkout locks the order's product rows in primary key order (SELECT
+... FOR UPDATE ORDER BY id, an UPDATE alone gives no lock order on
+every database), so two checkouts can not deadlock on each other, then
+takes the stock of all of them with one conditional UPDATE (inventory
+= inventory - q WHERE inventory >= q). If any product is short nothing
+is taken (the transaction rolls back).
+Hot products can have their stock split into InventoryShard rows
+('manage.py inventory_shards'), a checkout then decrements one random
+shard instead of queueing on a single row.
+Every taken quantity is recorded as an InventoryReservation. Paying the
+order drops them, an unpaid order gives the stock back when it fails
+or when its reservations expire ('manage.py release_reservations').
+Product.inventory is written with queryset updates that also move
+last_update. The catalog version (and with it every cached product
+response) is only bumped when a product sells out or comes back in
+stock, other stock counts in cached responses may lag by up to
+STORE_CATALOG_CACHE_TIMEOUT.
+'''
+
+
+class InsufficientStock(Exception):
+    def __init__(self, product_ids):
+        self.product_ids = sorted(product_ids)
+        super().__init__(f"Not enough stock for products {', '.join(map(str, self.product_ids))}")
+
+
+def quantity_case(quantities, field='id'):
+    return Case(*[When(**{field: key}, then=Value(quantity)) for key, quantity in quantities.items()],
+                output_field=IntegerField())
+
+
+def invalidate_on_commit():
+    transaction.on_commit(bump_catalog_version)
+
+
+def take_from_products(quantities):
+    if not quantities:
+        return
+    list(Product.objects.select_for_update().filter(id__in=list(quantities)).order_by('pk')
+         .values_list('id', flat=True))
+    amount = quantity_case(quantities)
+    updated = Product.objects.filter(id__in=list(quantities), inventory__gte=amount) \
+        .update(inventory=F('inventory') - amount, last_update=timezone.now())
+    if updated != len(quantities):
+        enough = set(Product.objects.filter(id__in=list(quantities), inventory__gte=amount)
+                     .values_list('id', flat=True))
+        raise InsufficientStock(set(quantities) - enough)
+    if Product.objects.filter(id__in=list(quantities), inventory=0).exists():
+        invalidate_on_commit()
+
+
+def take_from_shards(product_id, quantity, shards):
+    '''
+    shards: {shard: quantity} as read before (not locked). Returns
+    [(shard, quantity)] of what was taken
+    '''
+    candidates = [shard for shard, available in shards.items() if available >= quantity]
+    if candidates:
+        shard = random.choice(candidates)
+        updated = InventoryShard.objects \
+            .filter(product_id=product_id, shard=shard, quantity__gte=quantity) \
+            .update(quantity=F('quantity') - quantity)
+        if updated:
+            return [(shard, quantity)]
+    # No single shard has enough (or it ran out meanwhile): lock them all
+    # in shard order and take across them
+    rows = list(InventoryShard.objects.select_for_update().filter(product_id=product_id).order_by('shard'))
+    if sum(row.quantity for row in rows) < quantity:
+        raise InsufficientStock([product_id])
+    taken = []
+    remaining = quantity
+    for row in rows:
+        part = min(row.quantity, remaining)
+        if part > 0:
+            row.quantity -= part
+            remaining -= part
+            taken.append((row.shard, part))
+    InventoryShard.objects.bulk_update(rows, ['quantity'])
+    return taken
+
+
+def reserve(order, quantities, ttl=None):
+    '''
+    Takes {product_id: quantity} for the order, raises InsufficientStock.
+    Has to run inside the checkout transaction
+    '''
+    ttl = ttl if ttl is not None else getattr(settings, 'STORE_RESERVATION_TTL', 30 * 60)
+    expires_at = timezone.now() + timedelta(seconds=ttl)
+    product_ids = sorted(quantities)
+
+    shards = {}
+    for product_id, shard, available in InventoryShard.objects \
+            .filter(product_id__in=product_ids).values_list('product_id', 'shard', 'quantity'):
+        shards.setdefault(product_id, {})[shard] = available
+
+    plain = {product_id: quantities[product_id] for product_id in product_ids if product_id not in shards}
+    take_from_products(plain)
+    reservations = [
+        InventoryReservation(order=order, product_id=product_id, quantity=quantity, expires_at=expires_at)
+        for product_id, quantity in plain.items()]
+    for product_id in sorted(shards):
+        for shard, quantity in take_from_shards(product_id, quantities[product_id], shards[product_id]):
+            reservations.append(InventoryReservation(
+                order=order, product_id=product_id, shard=shard, quantity=quantity, expires_at=expires_at))
+    InventoryReservation.objects.bulk_create(reservations)
+    return reservations
+
+
+def release(reservations):
+    '''
+    Gives the stock of these reservations back and deletes them
+    '''
+    rows = list(reservations.order_by().values('product_id', 'shard').annotate(quantity=Sum('quantity')))
+    products = {row['product_id']: row['quantity'] for row in rows if row['shard'] is None}
+    if products:
+        amount = quantity_case(products)
+        Product.objects.filter(id__in=list(products)).update(
+            inventory=F('inventory') + amount, last_update=timezone.now())
+        # Back in stock: it was at 0 before these were added
+        if Product.objects.filter(id__in=list(products), inventory=amount).exists():
+            invalidate_on_commit()
+    for row in sorted((row for row in rows if row['shard'] is not None),
+                      key=lambda row: (row['product_id'], row['shard'])):
+        InventoryShard.objects.filter(product_id=row['product_id'], shard=row['shard']) \
+            .update(quantity=F('quantity') + row['quantity'])
+    reservations.delete()
+    return sum(row['quantity'] for row in rows)
+
+
+def settle(order):
+    '''
+    Called when the payment status changes: paid orders keep the stock,
+    failed ones give it back
+    '''
+    if order.payment_status == Order.PAYMENT_STATUS_COMPLETE:
+        InventoryReservation.objects.filter(order=order).delete()
+    elif order.payment_status == Order.PAYMENT_STATUS_FAILED:
+        release(InventoryReservation.objects.filter(order=order))
+
+
+def release_expired(batch_size=200):
+    '''
+    Fails pending orders whose reservations expired and gives their
+    stock back, a batch of orders per transaction. Returns the number of
+    orders released
+    '''
+    released = 0
+    while True:
+        order_ids = list(InventoryReservation.objects
+                         .filter(expires_at__lt=timezone.now(), order__payment_status=Order.PAYMENT_STATUS_PENDING)
+                         .order_by('order_id').values_list('order_id', flat=True).distinct()[:batch_size])
+        if not order_ids:
+            return released
+        with transaction.atomic():
+            # Locked so a payment can not complete while we release
+            pending = list(Order.objects.select_for_update()
+                           .filter(id__in=order_ids, payment_status=Order.PAYMENT_STATUS_PENDING)
+                           .order_by('id').values_list('id', flat=True))
+            release(InventoryReservation.objects.filter(order_id__in=pending))
+            Order.objects.filter(id__in=pending).update(payment_status=Order.PAYMENT_STATUS_FAILED)
+            OrderSummary.objects.filter(order_id__in=pending).update(
+                payment_status=Order.PAYMENT_STATUS_FAILED, updated_at=timezone.now())
+            # Orders paid in the meantime
+            InventoryReservation.objects.filter(order_id__in=set(order_ids) - set(pending)).delete()
+        released += len(pending)
+
+
+def sync_display_inventory(product_ids=None):
+    # Product.inventory of sharded products shows the sum of their shards
+    totals = InventoryShard.objects.order_by().values('product_id').annotate(total=Sum('quantity'))
+    if product_ids is not None:
+        totals = totals.filter(product_id__in=product_ids)
+    totals = {row['product_id']: row['total'] for row in totals}
+    if totals:
+        changed = Product.objects.filter(id__in=list(totals)).exclude(inventory=quantity_case(totals))
+        if changed.update(inventory=quantity_case(totals), last_update=timezone.now()):
+            invalidate_on_commit()
+    return len(totals)
@@ -0,0 +1,31 @@
+from time import perf_counter
+from django.core.management.base import BaseCommand
+
+from store.imaging import generate_variants
+from store.models import ProductImage
+
+
+class Command(BaseCommand):
+    help = 'Render the resized variants of existing product images'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                            help='Render every image again, also when its variants are up to date')
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        start = perf_counter()
+        images = written = failed = 0
+        ids = ProductImage.objects.exclude(image='').order_by('id').values_list('id', flat=True)
+        for image_id in ids.iterator(chunk_size=options['chunk_size']):
+            try:
+                written += generate_variants(image_id, force=options['force'])
+            except Exception as error:
+                failed += 1
+                self.stderr.write(f'Image {image_id}: {error}')
+            images += 1
+            if options['verbosity'] > 1 and images % 100 == 0:
+                self.stdout.write(f'{images} images')
+        self.stdout.write(self.style.SUCCESS(
+            f'{images} images, {written} variant files written, {failed} failed '
+            f'in {perf_counter() - start:.1f}s'))
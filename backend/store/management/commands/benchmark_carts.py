@@ -0,0 +1,63 @@
+import random
+from time import perf_counter
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+from store.models import Cart, Product
+
+BACKENDS = ['store.carts.DatabaseCartStore', 'store.carts.CachedCartStore']
+
+
+class Command(BaseCommand):
+    help = ('Measure cart add/update throughput of the cart store backends. '
+            'The carts it creates are deleted at the end')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--carts', type=int, default=100)
+        parser.add_argument('--operations', type=int, default=20, help='Adds/updates per cart')
+        parser.add_argument('--backend', action='append', help='Dotted path, default: both stores')
+
+    def handle(self, *args, **options):
+        product_ids = list(Product.objects.values_list('id', flat=True)[:200])
+        if not product_ids:
+            raise CommandError('Needs some products to put in the carts')
+        for backend in options['backend'] or BACKENDS:
+            try:
+                store = import_string(backend)()
+            except ImproperlyConfigured as error:
+                self.stdout.write(self.style.WARNING(f"Skipping {backend.rsplit('.', 1)[-1]}: {error}"))
+                continue
+            self.run(backend.rsplit('.', 1)[-1], store, product_ids, options['carts'], options['operations'])
+
+    def run(self, name, store, product_ids, cart_count, operations):
+        rng = random.Random(1)
+        start = perf_counter()
+        cart_ids = [store.create().id for _ in range(cart_count)]
+        created = perf_counter() - start
+
+        start = perf_counter()
+        for cart_id in cart_ids:
+            for position in range(operations):
+                product_id = rng.choice(product_ids)
+                if position % 4 == 3:
+                    store.set_item(cart_id, product_id, rng.randint(1, 5))
+                else:
+                    store.add_item(cart_id, product_id, 1)
+        mutated = perf_counter() - start
+
+        # Write behind backends pay for the database here
+        start = perf_counter()
+        store.flush(cart_ids)
+        flushed = perf_counter() - start
+
+        total = cart_count * operations
+        self.stdout.write(
+            f'{name:<20} create {cart_count / created:9,.0f} carts/s  '
+            f'add/update {total / mutated:9,.0f} ops/s  '
+            f'flush {flushed * 1000:8.1f}ms  '
+            f'overall {total / (created + mutated + flushed):9,.0f} ops/s')
+
+        for cart_id in cart_ids:
+            store.delete(cart_id)
+        Cart.objects.filter(id__in=cart_ids).delete()
@@ -0,0 +1,76 @@
+import threading
+from time import perf_counter
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from store.inventory import InsufficientStock, reserve
+from store.models import Customer, InventoryShard, Order, Product
+
+
+class Command(BaseCommand):
+    help = ('Measure concurrent checkouts of one product, with its stock on the '
+            'product row and split into shards. Orders, reservations and the '
+            'stock are restored at the end')
+
+    def add_arguments(self, parser):
+        parser.add_argument('product_id', type=int)
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--checkouts', type=int, default=50, help='Checkouts per thread')
+        parser.add_argument('--shards', type=int, default=8)
+
+    def handle(self, *args, **options):
+        product = Product.objects.filter(pk=options['product_id']).first()
+        if product is None:
+            raise CommandError('No such product')
+        customer = Customer.objects.first()
+        if customer is None:
+            raise CommandError('Needs a customer to place the orders')
+        if InventoryShard.objects.filter(product=product).exists():
+            raise CommandError('The product is already sharded, merge it first')
+        inventory = product.inventory
+        needed = options['threads'] * options['checkouts']
+        Product.objects.filter(pk=product.pk).update(inventory=needed)
+        try:
+            self.run('row', product, customer, options)
+            Product.objects.filter(pk=product.pk).update(inventory=needed)
+            call_command('inventory_shards', product.pk, split=options['shards'], stdout=self.stdout)
+            self.run(f'{options["shards"]} shards', product, customer, options)
+        finally:
+            InventoryShard.objects.filter(product=product).delete()
+            Product.objects.filter(pk=product.pk).update(inventory=inventory)
+
+    def run(self, name, product, customer, options):
+        order_ids = []
+        failures = []
+        lock = threading.Lock()
+
+        def worker():
+            try:
+                for _ in range(options['checkouts']):
+                    try:
+                        with transaction.atomic():
+                            order = Order.objects.create(customer=customer)
+                            reserve(order, {product.pk: 1})
+                    except InsufficientStock:
+                        with lock:
+                            failures.append(1)
+                        continue
+                    with lock:
+                        order_ids.append(order.pk)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(options['threads'])]
+        start = perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = perf_counter() - start
+
+        self.stdout.write(
+            f'{name:<12} {len(order_ids) / elapsed:9,.0f} checkouts/s  '
+            f'{len(order_ids)} placed  {len(failures)} out of stock')
+        # Reservations go with their orders
+        Order.objects.filter(id__in=order_ids).delete()
@@ -0,0 +1,150 @@
+import queue
+import threading
+from time import perf_counter
+from uuid import uuid4
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection
+
+from store.checkout import enqueue, place_batch
+from store.models import Cart, CartItem, CheckoutJob, Customer, Order, OrderItem, Product
+from store.serializers import CreateOrderSerializer
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Command(BaseCommand):
+    help = ('Compare synchronous checkout with the queued checkout (store/checkout.py): '
+            'orders/s and p50/p99 latency. Orders, carts and stock are restored at the end')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=200)
+        parser.add_argument('--threads', type=int, default=8, help='Concurrent clients')
+        parser.add_argument('--workers', type=int, default=2, help='Queue workers (threads here)')
+        parser.add_argument('--batch-size', type=int, default=50)
+        parser.add_argument('--items', type=int, default=3, help='Items per cart')
+
+    def handle(self, *args, **options):
+        customer = Customer.objects.first()
+        product_ids = list(Product.objects.order_by('id').values_list('id', flat=True)[:50])
+        if customer is None or not product_ids:
+            raise CommandError('Needs a customer and some products')
+        inventory = dict(Product.objects.filter(id__in=product_ids).values_list('id', 'inventory'))
+        Product.objects.filter(id__in=product_ids).update(inventory=10 ** 6)
+        self.order_ids = []
+        self.cart_ids = []
+        try:
+            self.run_sync(customer, self.make_carts(product_ids, options), options)
+            self.run_queued(customer, self.make_carts(product_ids, options), options)
+        finally:
+            Cart.objects.filter(id__in=self.cart_ids).delete()
+            OrderItem.objects.filter(order_id__in=self.order_ids).delete()
+            Order.objects.filter(id__in=self.order_ids).delete()
+            for product_id, value in inventory.items():
+                Product.objects.filter(id=product_id).update(inventory=value)
+
+    def make_carts(self, product_ids, options):
+        carts = [Cart(id=uuid4()) for _ in range(options['orders'])]
+        Cart.objects.bulk_create(carts)
+        CartItem.objects.bulk_create([
+            CartItem(cart=cart, product_id=product_ids[(position + offset) % len(product_ids)], quantity=1)
+            for position, cart in enumerate(carts) for offset in range(options['items'])])
+        self.cart_ids.extend(cart.id for cart in carts)
+        return [cart.id for cart in carts]
+
+    def run_clients(self, cart_ids, threads, checkout):
+        pending = queue.Queue()
+        for cart_id in cart_ids:
+            pending.put(cart_id)
+        latencies = []
+        failures = []
+
+        def client():
+            try:
+                while True:
+                    try:
+                        cart_id = pending.get_nowait()
+                    except queue.Empty:
+                        return
+                    start = perf_counter()
+                    try:
+                        checkout(cart_id)
+                    except OperationalError:
+                        failures.append(cart_id)
+                        continue
+                    latencies.append(perf_counter() - start)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=client) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if failures:
+            self.stdout.write(f'{len(failures)} checkouts failed on database errors')
+        return latencies
+
+    def run_sync(self, customer, cart_ids, options):
+        def checkout(cart_id):
+            serializer = CreateOrderSerializer(data={'cart_id': cart_id}, context={'user_id': customer.user_id})
+            serializer.is_valid(raise_exception=True)
+            self.order_ids.append(serializer.save().id)
+
+        start = perf_counter()
+        latencies = self.run_clients(cart_ids, options['threads'], checkout)
+        elapsed = perf_counter() - start
+        self.report('sync', len(latencies), elapsed, latencies, latencies)
+
+    def run_queued(self, customer, cart_ids, options):
+        job_ids = []
+
+        def checkout(cart_id):
+            serializer = CreateOrderSerializer(data={'cart_id': cart_id}, context={'user_id': customer.user_id})
+            serializer.is_valid(raise_exception=True)
+            job_ids.append(enqueue(customer.id, cart_id).id)
+
+        done = threading.Event()
+
+        def worker():
+            try:
+                while not done.is_set():
+                    try:
+                        placed = place_batch(options['batch_size'])
+                    except OperationalError:
+                        # Lock timeouts (SQLite), the batch is retried
+                        placed = 0
+                    if not placed:
+                        done.wait(0.01)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=worker) for _ in range(options['workers'])]
+        start = perf_counter()
+        for thread in workers:
+            thread.start()
+        latencies = self.run_clients(cart_ids, options['threads'], checkout)
+        while CheckoutJob.objects.filter(id__in=job_ids, status=CheckoutJob.STATUS_QUEUED).exists():
+            done.wait(0.01)
+        elapsed = perf_counter() - start
+        done.set()
+        for thread in workers:
+            thread.join()
+
+        jobs = list(CheckoutJob.objects.filter(id__in=job_ids).values_list('created_at', 'finished_at', 'order_id'))
+        completion = [(finished_at - created_at).total_seconds() for created_at, finished_at, _ in jobs]
+        self.order_ids.extend(order_id for _, _, order_id in jobs if order_id)
+        self.report('queued', len(jobs), elapsed, latencies, completion)
+        CheckoutJob.objects.filter(id__in=job_ids).delete()
+
+    def report(self, name, count, elapsed, request_latencies, completion_latencies):
+        self.stdout.write(
+            f'{name:<7} {count / elapsed:8,.0f} orders/s  '
+            f'request p50 {percentile(request_latencies, 0.5) * 1000:7.1f}ms '
+            f'p99 {percentile(request_latencies, 0.99) * 1000:7.1f}ms  '
+            f'placed p50 {percentile(completion_latencies, 0.5) * 1000:7.1f}ms '
+            f'p99 {percentile(completion_latencies, 0.99) * 1000:7.1f}ms')
@@ -0,0 +1,91 @@
+import random
+from functools import reduce
+from operator import and_
+from time import perf_counter
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from store.models import Collection, Product
+from store.search import ProductSearchIndex, tokenize
+
+BENCHMARK_COLLECTION = 'Search benchmark'
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ro', 'ta', 'vi', 'zu', 'pe', 'sa', 'do', 'gu', 'fi', 'ha', 'ju', 'be']
+
+
+def make_words(count, seed=1):
+    rng = random.Random(seed)
+    words = set()
+    while len(words) < count:
+        words.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+class Command(BaseCommand):
+    help = ('Compare the product search index with the icontains queries of '
+            'SearchFilter. --populate inserts synthetic products first')
+
+    def add_arguments(self, parser):
+        parser.add_argument('queries', nargs='*', help='Queries to run, random words by default')
+        parser.add_argument('--populate', type=int, default=0, help='Insert this many synthetic products')
+        parser.add_argument('--cleanup', action='store_true', help='Delete the synthetic products afterwards')
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        words = make_words(5000)
+        if options['populate']:
+            self.populate(options['populate'], words)
+
+        start = perf_counter()
+        index = ProductSearchIndex()
+        index.build_from_database()
+        self.stdout.write(f'Index build: {len(index)} products in {perf_counter() - start:.2f}s')
+
+        queries = options['queries'] or [' '.join(random.sample(words, 2)) for _ in range(5)] + [words[0][:3]]
+        repeat = options['repeat']
+        for query in queries:
+            sql_time, sql_count = self.time_sql(query, repeat)
+            index_time, index_count = self.time_index(index, query, repeat)
+            self.stdout.write(
+                f'{query!r:<24} SearchFilter {sql_time * 1000:9.2f}ms ({sql_count} rows)  '
+                f'index {index_time * 1000:8.3f}ms ({index_count} rows)  '
+                f'x{sql_time / index_time if index_time else 0:.0f}')
+
+        if options['cleanup']:
+            deleted, _ = Product.objects.filter(collection__title=BENCHMARK_COLLECTION).delete()
+            Collection.objects.filter(title=BENCHMARK_COLLECTION).delete()
+            self.stdout.write(f'Deleted {deleted} synthetic rows')
+
+    def time_sql(self, query, repeat):
+        # Same WHERE clause SearchFilter builds for search_fields = ['title','description']
+        condition = reduce(and_, [Q(title__icontains=term) | Q(description__icontains=term)
+                                  for term in query.split()])
+        start = perf_counter()
+        for _ in range(repeat):
+            ids = list(Product.objects.filter(condition).values_list('id', flat=True))
+        return (perf_counter() - start) / repeat, len(ids)
+
+    def time_index(self, index, query, repeat):
+        if not tokenize(query):
+            return 0, 0
+        start = perf_counter()
+        for _ in range(repeat):
+            ids = index.search(query)
+        return (perf_counter() - start) / repeat, len(ids)
+
+    def populate(self, count, words, batch_size=5000):
+        rng = random.Random(2)
+        collection, _ = Collection.objects.get_or_create(title=BENCHMARK_COLLECTION)
+        start = perf_counter()
+        for offset in range(0, count, batch_size):
+            with transaction.atomic():
+                Product.objects.bulk_create([
+                    Product(
+                        title=' '.join(rng.sample(words, 3)),
+                        slug=f'benchmark-{offset + i}',
+                        description=' '.join(rng.choices(words, k=40)),
+                        unit_price=rng.randint(1, 999),
+                        inventory=rng.randint(1, 1000),
+                        collection=collection)
+                    for i in range(min(batch_size, count - offset))])
+        self.stdout.write(f'Inserted {count} products in {perf_counter() - start:.1f}s')
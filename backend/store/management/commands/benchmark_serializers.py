@@ -0,0 +1,58 @@
+from time import perf_counter
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory, override_settings
+from rest_framework.request import Request
+
+from store.models import Cart, Order, Product
+from store.serializers import CartSerializer, OrderSerializer, ProductSerializer, SimpleProductSerializer
+
+
+class Command(BaseCommand):
+    help = ('Check that the compiled serializers (store/compiled.py) render exactly '
+            'what DRF renders and compare rows/sec of both paths')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=1000, help='Rows per serializer')
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        limit = options['limit']
+        request = Request(RequestFactory().get('/store/products/'))
+        cases = [
+            ('ProductSerializer', ProductSerializer,
+             list(Product.objects.select_related('price').prefetch_related('images')[:limit])),
+            ('SimpleProductSerializer (.values())', SimpleProductSerializer,
+             list(Product.objects.values('id', 'title', 'unit_price')[:limit])),
+            ('CartSerializer', CartSerializer,
+             list(Cart.objects.prefetch_related('items__product__price')[:limit])),
+            ('OrderSerializer', OrderSerializer,
+             list(Order.objects.prefetch_related('items__product')[:limit])),
+        ]
+        failures = 0
+        for name, serializer_class, rows in cases:
+            if not rows:
+                self.stdout.write(f'{name:<38} no rows, skipped')
+                continue
+            context = {'request': request}
+            with override_settings(STORE_COMPILED_SERIALIZERS=False):
+                expected = serializer_class(rows, many=True, context=context).data
+                drf_rate = self.rate(serializer_class, rows, context, options['repeat'])
+            actual = serializer_class(rows, many=True, context=context).data
+            compiled_rate = self.rate(serializer_class, rows, context, options['repeat'])
+
+            if actual == expected:
+                status = 'ok'
+            else:
+                status = 'MISMATCH'
+                failures += 1
+            self.stdout.write(
+                f'{name:<38} {len(rows):>6} rows  drf {drf_rate:>10,.0f} rows/s  '
+                f'compiled {compiled_rate:>10,.0f} rows/s  x{compiled_rate / drf_rate:.1f}  {status}')
+        if failures:
+            raise CommandError(f'{failures} serializer(s) render differently on the compiled path')
+
+    def rate(self, serializer_class, rows, context, repeat):
+        start = perf_counter()
+        for _ in range(repeat):
+            serializer_class(rows, many=True, context=context).data
+        return len(rows) * repeat / (perf_counter() - start)
@@ -0,0 +1,146 @@
+import random
+from functools import reduce
+from operator import or_
+from time import perf_counter
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+
+from store.bitmaps import TagBitmapIndex
+from store.models import Collection, Product
+from tags.models import Tag, TaggedItem
+
+BENCHMARK_COLLECTION = 'Tag benchmark'
+BENCHMARK_TAG = 'tag-benchmark'
+
+
+class Command(BaseCommand):
+    help = ('Compare tag browsing through the bitmap index with the EXISTS per tag '
+            'queries over TaggedItem. --populate inserts synthetic tagged products first')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--populate', type=int, default=0, help='Insert this many synthetic products')
+        parser.add_argument('--tags', type=int, default=200, help='Synthetic tags to spread over them')
+        parser.add_argument('--tags-per-product', type=int, default=6)
+        parser.add_argument('--collections', type=int, default=5)
+        parser.add_argument('--cleanup', action='store_true', help='Delete the synthetic rows afterwards')
+        parser.add_argument('--queries', type=int, default=6)
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--page-size', type=int, default=10)
+
+    def handle(self, *args, **options):
+        if options['populate']:
+            self.populate(options['populate'], options['tags'], options['tags_per_product'], options['collections'])
+
+        start = perf_counter()
+        index = TagBitmapIndex()
+        index.build_from_database()
+        self.stdout.write(f'Index build: {len(index)} products, {len(index.tags)} tags in '
+                          f'{perf_counter() - start:.2f}s, {index.nbytes() / 1024:.0f}KB of sets')
+
+        labels = sorted(index.labels, key=lambda label: -len(index.label_ids(label)))
+        collections = sorted(index.collections, key=lambda key: -len(index.collections[key]))
+        if len(labels) < 4:
+            self.stdout.write('Not enough tags to benchmark, use --populate')
+            return
+
+        rng = random.Random(3)
+        popular = labels[:max(4, len(labels) // 10)]
+        queries = []
+        for position in range(options['queries']):
+            query = {'all_tags': rng.sample(popular, 2 + position % 2), 'any_tags': [], 'exclude_tags': [],
+                     'collections': [collections[position % len(collections)]] if position % 3 else []}
+            if position % 2:
+                query['any_tags'] = rng.sample([label for label in popular if label not in query['all_tags']], 2)
+            if position % 3 == 2:
+                query['exclude_tags'] = rng.sample(popular, 1)
+            queries.append(query)
+
+        for query in queries:
+            sql_time, sql_count = self.time_sql(query, options['repeat'], options['page_size'])
+            index_time, index_count = self.time_index(index, query, options['repeat'], options['page_size'])
+            self.stdout.write(
+                f"{self.describe(query):<56} SQL {sql_time * 1000:9.2f}ms ({sql_count} rows)  "
+                f"bitmaps {index_time * 1000:8.3f}ms ({index_count} rows)  "
+                f"x{sql_time / index_time if index_time else 0:.0f}")
+
+        if options['cleanup']:
+            self.cleanup()
+
+    def describe(self, query):
+        parts = [' & '.join(query['all_tags'])]
+        if query['any_tags']:
+            parts.append(f"({' | '.join(query['any_tags'])})")
+        parts.extend(f'!{label}' for label in query['exclude_tags'])
+        parts.extend(f'collection {key}' for key in query['collections'])
+        return ' & '.join(parts)
+
+    def time_sql(self, query, repeat, page_size):
+        # What the ORM writes for the same question: one EXISTS over
+        # TaggedItem per tag, then COUNT(*) and the first page of ids
+        content_type = ContentType.objects.get_for_model(Product)
+        tagged = TaggedItem.objects.filter(content_type=content_type, object_id=OuterRef('pk'))
+        queryset = Product.objects.all()
+        for label in query['all_tags']:
+            queryset = queryset.filter(Exists(tagged.filter(tag__label__iexact=label)))
+        if query['any_tags']:
+            condition = reduce(or_, [Q(tag__label__iexact=label) for label in query['any_tags']])
+            queryset = queryset.filter(Exists(tagged.filter(condition)))
+        for label in query['exclude_tags']:
+            queryset = queryset.exclude(Exists(tagged.filter(tag__label__iexact=label)))
+        if query['collections']:
+            queryset = queryset.filter(collection_id__in=query['collections'])
+        start = perf_counter()
+        for _ in range(repeat):
+            count = queryset.count()
+            list(queryset.order_by('id').values_list('id', flat=True)[:page_size])
+        return (perf_counter() - start) / repeat, count
+
+    def time_index(self, index, query, repeat, page_size):
+        start = perf_counter()
+        for _ in range(repeat):
+            ids = index.query(**query)
+            count = len(ids)
+            ids[:page_size]
+        return (perf_counter() - start) / repeat, count
+
+    def populate(self, count, tag_count, tags_per_product, collection_count, batch_size=5000):
+        rng = random.Random(2)
+        start = perf_counter()
+        collections = [Collection.objects.get_or_create(title=f'{BENCHMARK_COLLECTION} {position}')[0]
+                       for position in range(collection_count)]
+        Tag.objects.bulk_create([Tag(label=f'{BENCHMARK_TAG}-{position}') for position in range(tag_count)])
+        # bulk_create does not return ids on MySQL, read them back
+        tag_ids = list(Tag.objects.filter(label__startswith=BENCHMARK_TAG).order_by('id').values_list('id', flat=True))
+        # A few tags are on many products, most on few
+        weights = [1 / (position + 1) for position in range(len(tag_ids))]
+        content_type = ContentType.objects.get_for_model(Product)
+        last_id = Product.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        for offset in range(0, count, batch_size):
+            with transaction.atomic():
+                Product.objects.bulk_create([
+                    Product(
+                        title=f'Tag benchmark {offset + i}',
+                        slug=f'tag-benchmark-{offset + i}',
+                        unit_price=rng.randint(1, 999),
+                        inventory=rng.randint(1, 1000),
+                        collection=rng.choice(collections))
+                    for i in range(min(batch_size, count - offset))])
+                product_ids = list(Product.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True))
+                last_id = product_ids[-1]
+                TaggedItem.objects.bulk_create([
+                    TaggedItem(tag_id=tag_id, content_type=content_type, object_id=product_id)
+                    for product_id in product_ids
+                    for tag_id in set(rng.choices(tag_ids, weights, k=tags_per_product))])
+        Collection.objects.reconcile_products_count()
+        self.stdout.write(f'Inserted {count} products and their tags in {perf_counter() - start:.1f}s')
+
+    def cleanup(self):
+        content_type = ContentType.objects.get_for_model(Product)
+        product_ids = Product.objects.filter(collection__title__startswith=BENCHMARK_COLLECTION).values('id')
+        TaggedItem.objects.filter(content_type=content_type, object_id__in=product_ids).delete()
+        deleted, _ = Product.objects.filter(collection__title__startswith=BENCHMARK_COLLECTION).delete()
+        Collection.objects.filter(title__startswith=BENCHMARK_COLLECTION).delete()
+        Tag.objects.filter(label__startswith=BENCHMARK_TAG).delete()
+        self.stdout.write(f'Deleted {deleted} synthetic rows')
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from store.cache import get_catalog_version, get_stats, reset_stats
+
+ENDPOINTS = ['products-list', 'products-detail']
+
+
+class Command(BaseCommand):
+    help = 'Show hit rate and latency of the catalog response cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Clear the counters after printing them')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'catalog version: {get_catalog_version()}')
+        for endpoint, row in get_stats(ENDPOINTS).items():
+            self.stdout.write(
+                f"{endpoint:<20} hits={row['hits']} misses={row['misses']} "
+                f"hit_rate={row['hit_rate']:.1%} "
+                f"avg_hit={row['avg_hit_ms']:.2f}ms avg_miss={row['avg_miss_ms']:.2f}ms")
+        if options['reset']:
+            reset_stats(ENDPOINTS)
+            self.stdout.write(self.style.SUCCESS('Counters cleared'))
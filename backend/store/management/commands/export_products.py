@@ -0,0 +1,48 @@
+import sys
+from time import perf_counter
+from django.core.management.base import BaseCommand
+
+from store.catalog_io import FIELDS, RecordWriter, guess_format, product_record
+from store.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Stream the catalog to a CSV or JSONL file in id order with constant memory'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to write, '-' for stdout")
+        parser.add_argument('--format', choices=['csv', 'jsonl'])
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = guess_format(path, options['format'])
+        chunk_size = options['chunk_size']
+        columns = [name for name in FIELDS if name not in ('collection', 'promotions')] + ['collection_id']
+        Through = Product.promotions.through
+
+        file = sys.stdout if path == '-' else open(path, 'w', newline='' if format == 'csv' else None)
+        writer = RecordWriter(file, format)
+        start = perf_counter()
+        count = 0
+        last_id = 0
+        try:
+            while True:
+                # Keyset batches: every chunk is a short indexed query
+                rows = list(Product.objects.order_by('id').filter(id__gt=last_id).values(*columns)[:chunk_size])
+                if not rows:
+                    break
+                last_id = rows[-1]['id']
+                promotions = {}
+                for product_id, promotion_id in Through.objects \
+                        .filter(product_id__in=[row['id'] for row in rows]) \
+                        .order_by('promotion_id').values_list('product_id', 'promotion_id'):
+                    promotions.setdefault(product_id, []).append(promotion_id)
+                for row in rows:
+                    writer.write(product_record(row, promotions.get(row['id'], [])))
+                count += len(rows)
+        finally:
+            if file is not sys.stdout:
+                file.close()
+        elapsed = perf_counter() - start
+        self.stderr.write(f'{count} products in {elapsed:.1f}s ({count / elapsed if elapsed else 0:,.0f} rows/s)')
@@ -0,0 +1,179 @@
+import json
+import os
+import sys
+from itertools import islice
+from time import perf_counter
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.utils import timezone
+
+from store.cache import bump_catalog_version
+from store.catalog_io import ReferenceMaps, guess_format, read_records, validate_chunk
+from store.changes import log_changes
+from store.models import CatalogChange, Collection, Product, ProductPrice
+
+UPDATE_FIELDS = ['title', 'slug', 'description', 'unit_price', 'inventory', 'collection_id', 'last_update']
+
+
+class Command(BaseCommand):
+    help = ('Stream products from a CSV or JSONL file into the catalog with '
+            'chunked bulk writes. Rows with an existing id are updated')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to read, '-' for stdin")
+        parser.add_argument('--format', choices=['csv', 'jsonl'])
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--checkpoint', help='Progress file, an interrupted import resumes from it')
+        parser.add_argument('--rejects', help='Write rejected rows and their errors here (JSONL)')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = guess_format(path, options['format'])
+        chunk_size = options['chunk_size']
+        checkpoint = options['checkpoint']
+
+        skip = self.read_checkpoint(checkpoint, path)
+        if skip:
+            self.stdout.write(f'Resuming after {skip} rows')
+
+        self.references = ReferenceMaps()
+        self.touched_collections = set()
+        self.inserted_ids = False
+        totals = {'rows': 0, 'created': 0, 'updated': 0, 'rejected': 0}
+        rejects_file = open(options['rejects'], 'a') if options['rejects'] else None
+        file = sys.stdin if path == '-' else open(path, newline='' if format == 'csv' else None)
+        start = perf_counter()
+        try:
+            records = islice(read_records(file, format), skip, None)
+            done = skip
+            while True:
+                chunk = list(islice(records, chunk_size))
+                if not chunk:
+                    break
+                chunk_start = perf_counter()
+                rows, rejects = validate_chunk(chunk, self.references)
+                with transaction.atomic():
+                    created, updated = self.write_chunk(rows)
+                done += len(chunk)
+                self.write_checkpoint(checkpoint, path, done)
+                for record, errors in rejects:
+                    if rejects_file:
+                        rejects_file.write(json.dumps({'record': record, 'errors': errors}, default=str) + '\n')
+                totals['rows'] += len(chunk)
+                totals['created'] += created
+                totals['updated'] += updated
+                totals['rejected'] += len(rejects)
+                if options['verbosity'] > 1:
+                    self.stdout.write(
+                        f'{done} rows, chunk {len(chunk) / (perf_counter() - chunk_start):,.0f} rows/s')
+        finally:
+            if file is not sys.stdin:
+                file.close()
+            if rejects_file:
+                rejects_file.close()
+            # bulk writes skip the signals, do their work once at the end
+            if self.touched_collections:
+                Collection.objects.reconcile_products_count(self.touched_collections)
+                # Rows bulk inserted without getting their id back
+                ProductPrice.objects.recompute(Product.objects.filter(price__isnull=True))
+                bump_catalog_version()
+            if self.inserted_ids:
+                self.reset_sequences()
+
+        elapsed = perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f"{totals['rows']} rows in {elapsed:.1f}s ({totals['rows'] / elapsed if elapsed else 0:,.0f} rows/s): "
+            f"{totals['created']} created, {totals['updated']} updated, {totals['rejected']} rejected"))
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+    def write_chunk(self, rows):
+        now = timezone.now()
+        # An id repeated within the chunk: the last row wins, as it would
+        # if the rows were in different chunks. The earlier ones count as
+        # updates
+        last = {row['id']: position for position, row in enumerate(rows) if row['id'] is not None}
+        merged = len(rows)
+        rows = [row for position, row in enumerate(rows) if row['id'] is None or last[row['id']] == position]
+        merged -= len(rows)
+        ids = list(last)
+        existing = dict(Product.objects.filter(id__in=ids).values_list('id', 'collection_id')) if ids else {}
+
+        to_update, to_create = [], []
+        for row in rows:
+            product = Product(
+                id=row['id'], title=row['title'], slug=row['slug'], description=row['description'],
+                unit_price=row['unit_price'], inventory=row['inventory'],
+                collection_id=row['collection_id'], last_update=now)
+            self.touched_collections.add(row['collection_id'])
+            if row['id'] in existing:
+                self.touched_collections.add(existing[row['id']])
+                to_update.append((product, row))
+            else:
+                to_create.append((product, row))
+
+        if to_update:
+            Product.objects.bulk_update([product for product, _ in to_update], UPDATE_FIELDS)
+
+        # Backends which can not return ids from a bulk insert (MySQL)
+        # create products that need promotions one by one
+        can_return_ids = connection.features.can_return_rows_from_bulk_insert
+        single_positions = {position for position, (product, row) in enumerate(to_create)
+                            if not can_return_ids and product.id is None and row['promotions']}
+        bulk = [pair for position, pair in enumerate(to_create) if position not in single_positions]
+        single = [pair for position, pair in enumerate(to_create) if position in single_positions]
+        if bulk:
+            Product.objects.bulk_create([product for product, _ in bulk])
+        # raw: the product receivers in store.signals skip it (their work
+        # is done in bulk below), the insert still returns the id
+        for product, _ in single:
+            product.save_base(raw=True)
+        if any(row['id'] is not None for _, row in to_create):
+            self.inserted_ids = True
+
+        links = [(product, row) for product, row in to_update + to_create if row['promotions'] is not None]
+        if links:
+            Through = Product.promotions.through
+            Through.objects.filter(product_id__in=[product.id for product, _ in links]).delete()
+            Through.objects.bulk_create([
+                Through(product_id=product.id, promotion_id=promotion_id)
+                for product, row in links for promotion_id in set(row['promotions'])])
+        # Bulk writes skip the signals, price the chunk in its own transaction
+        priced_ids = [product.id for product, _ in to_update + to_create if product.id is not None]
+        ProductPrice.objects.recompute(Product.objects.filter(id__in=priced_ids))
+        # and tell the search indexes. Rows inserted without getting their
+        # id back are found by slug (re-reading a few more does no harm)
+        changed_ids = list(priced_ids)
+        slugs = [product.slug for product, _ in to_create if product.id is None]
+        if slugs:
+            changed_ids += Product.objects.filter(slug__in=slugs).values_list('id', flat=True)
+        log_changes(CatalogChange.KIND_PRODUCT, changed_ids)
+        return len(to_create), len(to_update) + merged
+
+    def reset_sequences(self):
+        # Rows inserted with their own id do not move the id sequence on
+        # PostgreSQL / Oracle, the next insert would collide (what
+        # 'manage.py sqlsequencereset store' prints, nothing to do elsewhere)
+        statements = connection.ops.sequence_reset_sql(no_style(), [Product])
+        if statements:
+            with connection.cursor() as cursor:
+                for statement in statements:
+                    cursor.execute(statement)
+
+    def read_checkpoint(self, checkpoint, path):
+        if not checkpoint or not os.path.exists(checkpoint):
+            return 0
+        with open(checkpoint) as file:
+            state = json.load(file)
+        if state.get('path') != path:
+            raise CommandError(f"Checkpoint {checkpoint} belongs to {state.get('path')}, not {path}")
+        return state['rows']
+
+    def write_checkpoint(self, checkpoint, path, rows):
+        if not checkpoint:
+            return
+        tmp_path = f'{checkpoint}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump({'path': path, 'rows': rows}, file)
+        os.replace(tmp_path, checkpoint)
@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from store.inventory import invalidate_on_commit, sync_display_inventory
+from store.models import InventoryReservation, InventoryShard, Product
+
+
+class Command(BaseCommand):
+    help = ('Split the stock of hot products into shards, merge it back, or refresh '
+            'the displayed inventory of sharded products')
+
+    def add_arguments(self, parser):
+        parser.add_argument('product_ids', nargs='*', type=int)
+        group = parser.add_mutually_exclusive_group(required=True)
+        group.add_argument('--split', type=int, metavar='SHARDS', help='Spread Product.inventory over this many shards')
+        group.add_argument('--merge', action='store_true', help='Move the shard stock back into Product.inventory')
+        group.add_argument('--sync', action='store_true', help='Set Product.inventory to the sum of the shards')
+
+    def handle(self, *args, **options):
+        product_ids = options['product_ids']
+        if options['sync']:
+            count = sync_display_inventory(product_ids or None)
+            self.stdout.write(self.style.SUCCESS(f'Synced {count} sharded products'))
+            return
+        if not product_ids:
+            raise CommandError('Give the ids of the products')
+        for product_id in product_ids:
+            with transaction.atomic():
+                product = Product.objects.select_for_update().filter(pk=product_id).first()
+                if product is None:
+                    raise CommandError(f'No product {product_id}')
+                shards = list(InventoryShard.objects.select_for_update().filter(product=product).order_by('shard'))
+                # Reservations give their stock back to the shard (or
+                # Product.inventory) they were taken from, so the layout
+                # has to stay until they are settled
+                reserved = InventoryReservation.objects.select_for_update().filter(product=product).count()
+                if reserved:
+                    raise CommandError(f'Product {product_id} has {reserved} pending reservations, try again once '
+                                       f'their orders are paid or released (manage.py release_reservations)')
+                count = options['split']
+                if not options['merge'] and count < 1:
+                    raise CommandError('--split needs at least one shard')
+                stock = sum(shard.quantity for shard in shards) if shards else product.inventory
+                InventoryShard.objects.filter(product=product).delete()
+                # Stock and sold out state are in the cached product responses
+                invalidate_on_commit()
+                if options['merge']:
+                    Product.objects.filter(pk=product_id).update(inventory=stock, last_update=timezone.now())
+                    self.stdout.write(f'Product {product_id}: {stock} in Product.inventory')
+                    continue
+                InventoryShard.objects.bulk_create([
+                    InventoryShard(product=product, shard=shard,
+                                   quantity=stock // count + (1 if shard < stock % count else 0))
+                    for shard in range(count)])
+                Product.objects.filter(pk=product_id).update(inventory=stock, last_update=timezone.now())
+                self.stdout.write(f'Product {product_id}: {stock} over {count} shards')
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from store.changes import purge_changes
+
+
+class Command(BaseCommand):
+    help = 'Delete catalog change log rows older than STORE_CATALOG_CHANGE_RETENTION'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        purged = purge_changes(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Deleted {purged} catalog changes'))
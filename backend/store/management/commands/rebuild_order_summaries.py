@@ -0,0 +1,22 @@
+from time import perf_counter
+from django.core.management.base import BaseCommand
+
+from store.models import Order, OrderSummary
+
+
+class Command(BaseCommand):
+    help = 'Rewrite the OrderSummary rows of all orders (or the given orders) from their items'
+
+    def add_arguments(self, parser):
+        parser.add_argument('order_ids', nargs='*', type=int)
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        orders = Order.objects.all()
+        if options['order_ids']:
+            orders = orders.filter(id__in=options['order_ids'])
+        start = perf_counter()
+        rebuilt = OrderSummary.objects.rebuild(orders, batch_size=options['batch_size'])
+        elapsed = perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'{rebuilt} order summaries written in {elapsed:.2f}s ({rebuilt / elapsed if elapsed else 0:,.0f} rows/s)'))
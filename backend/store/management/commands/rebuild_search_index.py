@@ -0,0 +1,26 @@
+from time import perf_counter
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from store.search import ProductSearchIndex
+
+
+class Command(BaseCommand):
+    help = 'Build the product search index from scratch and save it for the workers to load'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', help='Index file, defaults to STORE_SEARCH_INDEX_PATH')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        path = options['output'] or settings.STORE_SEARCH_INDEX_PATH
+        if not path:
+            raise CommandError('Set STORE_SEARCH_INDEX_PATH or pass --output')
+        index = ProductSearchIndex()
+        start = perf_counter()
+        index.build_from_database(chunk_size=options['chunk_size'])
+        elapsed = perf_counter() - start
+        index.save(path)
+        self.stdout.write(self.style.SUCCESS(
+            f'Indexed {len(index)} products ({len(index.postings)} terms) '
+            f'in {elapsed:.2f}s, saved to {path}'))
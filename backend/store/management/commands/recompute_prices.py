@@ -0,0 +1,26 @@
+from time import perf_counter
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from store.cache import bump_catalog_version
+from store.models import Product, ProductPrice
+
+
+class Command(BaseCommand):
+    help = 'Recalculate the ProductPrice table for the whole catalog (or the given products)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('product_ids', nargs='*', type=int)
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        products = Product.objects.all()
+        if options['product_ids']:
+            products = products.filter(id__in=options['product_ids'])
+        start = perf_counter()
+        with transaction.atomic():
+            priced = ProductPrice.objects.recompute(products, batch_size=options['batch_size'])
+        bump_catalog_version()
+        elapsed = perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'{priced} products priced in {elapsed:.2f}s ({priced / elapsed if elapsed else 0:,.0f} rows/s)'))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from store.models import Collection
+
+
+class Command(BaseCommand):
+    help = 'Recount Collection.products_count in batches and repair the rows that drifted'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('ids', nargs='*', type=int, help='Only these collections')
+
+    def handle(self, *args, **options):
+        fixed = Collection.objects.reconcile_products_count(
+            collection_ids=options['ids'] or None,
+            batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'{fixed} collection(s) repaired'))
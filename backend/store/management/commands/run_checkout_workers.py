@@ -0,0 +1,42 @@
+import multiprocessing
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from store.checkout import run_worker
+
+
+def worker_main(batch_size, poll_interval, once):
+    # Forked children must not share the parent's database connections
+    connections.close_all()
+    run_worker(batch_size=batch_size, poll_interval=poll_interval, once=once)
+
+
+class Command(BaseCommand):
+    help = 'Run a pool of worker processes that place queued checkouts (STORE_CHECKOUT_QUEUE)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--batch-size', type=int, help='Jobs per transaction, default STORE_CHECKOUT_BATCH_SIZE')
+        parser.add_argument('--poll-interval', type=float, help='Seconds to sleep on an empty queue')
+        parser.add_argument('--once', action='store_true', help='Exit when the queue is empty')
+
+    def handle(self, *args, **options):
+        arguments = (options['batch_size'], options['poll_interval'], options['once'])
+        if options['workers'] <= 1:
+            handled = run_worker(*arguments)
+            self.stdout.write(self.style.SUCCESS(f'Handled {handled} checkouts'))
+            return
+        connections.close_all()
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('fork') if 'fork' in methods else multiprocessing.get_context()
+        processes = [context.Process(target=worker_main, args=arguments, daemon=True)
+                     for _ in range(options['workers'])]
+        for process in processes:
+            process.start()
+        self.stdout.write(f'Started {len(processes)} checkout workers')
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.terminate()
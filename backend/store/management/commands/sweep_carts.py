@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from store.sweeper import sweep_carts
+
+
+class Command(BaseCommand):
+    help = 'Delete carts idle for longer than STORE_CART_TTL, in small adaptive batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ttl', type=int, help='Idle seconds, default STORE_CART_TTL')
+        parser.add_argument('--batch-size', type=int, default=500, help='First batch size, adapted afterwards')
+        parser.add_argument('--max-batch-size', type=int, default=5000)
+        parser.add_argument('--target-ms', type=int, default=200, help='Aimed duration of one batch')
+        parser.add_argument('--pause-factor', type=float, default=1.0,
+                            help='Sleep this many times the duration of the last batch between batches')
+        parser.add_argument('--max-batches', type=int)
+
+    def handle(self, *args, **options):
+        ttl = options['ttl'] if options['ttl'] is not None else getattr(settings, 'STORE_CART_TTL', 30 * 24 * 60 * 60)
+        stats = sweep_carts(
+            ttl=ttl,
+            batch_size=options['batch_size'],
+            max_batch_size=options['max_batch_size'],
+            target_seconds=options['target_ms'] / 1000,
+            pause_factor=options['pause_factor'],
+            max_batches=options['max_batches'],
+            log=self.stdout.write if options['verbosity'] > 1 else None)
+        self.stdout.write(self.style.SUCCESS(
+            f"Deleted {stats['carts']} carts idle for more than {ttl}s in {stats['batches']} batches, "
+            f"{stats['seconds']:.1f}s ({stats['rate']:,.0f} carts/s)"))
@@ -0,0 +1,25 @@
+from time import perf_counter
+from django.core.management.base import BaseCommand
+
+from store.rollups import DAY_CHUNK, rebuild_rollups, update_rollups
+
+
+class Command(BaseCommand):
+    help = ('Bring the sales rollup tables up to date with the orders changed since the '
+            'last run, or rebuild them from the whole order history')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true')
+        parser.add_argument('--workers', type=int, default=1, help='Processes for --rebuild')
+        parser.add_argument('--chunk-days', type=int, default=DAY_CHUNK, help='Days per --rebuild chunk')
+
+    def handle(self, *args, **options):
+        start = perf_counter()
+        if options['rebuild']:
+            stats = rebuild_rollups(workers=options['workers'], chunk_days=options['chunk_days'])
+        else:
+            stats = update_rollups()
+        elapsed = perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f"{stats['orders']} orders, {stats['days']} days and {stats['months']} months "
+            f"rolled up in {elapsed:.2f}s"))
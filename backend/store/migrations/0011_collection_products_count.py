@@ -0,0 +1,27 @@
+# Generated by Django 4.2.4 on 2026-10-18 14:10
+
+from django.db import migrations, models
+
+
+def count_products(apps, schema_editor):
+    Collection = apps.get_model('store', 'Collection')
+    Product = apps.get_model('store', 'Product')
+    counts = Product.objects.order_by().values_list('collection_id').annotate(count=models.Count('id'))
+    for collection_id, count in counts:
+        Collection.objects.filter(pk=collection_id).update(products_count=count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0010_collection_last_update'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='collection',
+            name='products_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_products, migrations.RunPython.noop),
+    ]
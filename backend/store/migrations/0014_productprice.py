@@ -0,0 +1,51 @@
+# Generated by Django 4.2.4 on 2026-10-18 14:11
+
+from decimal import Decimal, ROUND_HALF_UP
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+import django.db.models.deletion
+
+
+def price_products(apps, schema_editor):
+    # Same calculation as ProductPriceManager.recompute()
+    Product = apps.get_model('store', 'Product')
+    ProductPrice = apps.get_model('store', 'ProductPrice')
+    tax_rate = Decimal(str(getattr(settings, 'STORE_TAX_RATE', '0.10')))
+    cent = Decimal('0.01')
+    now = timezone.now()
+    rows = Product.objects.order_by().values_list('id', 'unit_price') \
+        .annotate(discount=models.Max('promotions__discount'))
+    prices = []
+    for product_id, unit_price, discount in rows.iterator():
+        discount = Decimal(str(min(max(discount or 0, 0), 100)))
+        discounted = (unit_price * (100 - discount) / 100).quantize(cent, ROUND_HALF_UP)
+        prices.append(ProductPrice(
+            product_id=product_id,
+            base_price=unit_price,
+            discounted_price=discounted,
+            price_with_tax=(discounted * (1 + tax_rate)).quantize(cent, ROUND_HALF_UP),
+            updated_at=now))
+    ProductPrice.objects.bulk_create(prices, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0013_product_collection_price_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductPrice',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('base_price', models.DecimalField(decimal_places=2, max_digits=6)),
+                ('discounted_price', models.DecimalField(decimal_places=2, max_digits=6)),
+                ('price_with_tax', models.DecimalField(decimal_places=2, max_digits=8)),
+                ('updated_at', models.DateTimeField()),
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='price', to='store.product')),
+            ],
+        ),
+        migrations.RunPython(price_products, migrations.RunPython.noop),
+    ]
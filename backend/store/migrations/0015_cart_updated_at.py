@@ -0,0 +1,29 @@
+# Generated by Django 4.2.4 on 2026-10-18 14:16
+
+from django.db import migrations, models
+
+
+def use_created_at(apps, schema_editor):
+    # Existing carts count as idle since they were created
+    Cart = apps.get_model('store', 'Cart')
+    Cart.objects.update(updated_at=models.F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0014_productprice'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.RunPython(use_created_at, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(fields=['updated_at'], name='store_cart_updated_08faa2_idx'),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 4.2.4 on 2026-10-18 14:19
+
+from decimal import Decimal
+from django.db import migrations, models
+from django.utils import timezone
+import django.db.models.deletion
+
+
+def summarize_orders(apps, schema_editor):
+    # Same rows as OrderSummaryManager.rebuild()
+    Order = apps.get_model('store', 'Order')
+    OrderSummary = apps.get_model('store', 'OrderSummary')
+    now = timezone.now()
+    rows = Order.objects.order_by().values_list('id', 'customer_id', 'placed_at', 'payment_status') \
+        .annotate(item_count=models.Sum('items__quantity'),
+                  total_amount=models.Sum(models.F('items__unit_price') * models.F('items__quantity'),
+                                          output_field=models.DecimalField(max_digits=10, decimal_places=2)))
+    summaries = [
+        OrderSummary(order_id=order_id, customer_id=customer_id, placed_at=placed_at,
+                     payment_status=payment_status, item_count=item_count or 0,
+                     total_amount=Decimal(total_amount or 0).quantize(Decimal('0.01')), updated_at=now)
+        for order_id, customer_id, placed_at, payment_status, item_count, total_amount in rows.iterator()]
+    OrderSummary.objects.bulk_create(summaries, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0016_inventory_shards_and_reservations'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderSummary',
+            fields=[
+                ('order', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='summary', serialize=False, to='store.order')),
+                ('placed_at', models.DateTimeField()),
+                ('payment_status', models.CharField(choices=[('P', 'Pending'), ('C', 'Complete'), ('F', 'Failed')], max_length=1)),
+                ('item_count', models.PositiveIntegerField(default=0)),
+                ('total_amount', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='store.customer')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['customer', 'placed_at', 'order'], name='store_order_custome_bab91e_idx'), models.Index(fields=['placed_at', 'order'], name='store_order_placed__82f879_idx')],
+            },
+        ),
+        migrations.RunPython(summarize_orders, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.4 on 2026-10-18 14:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0018_idempotency_keys'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CheckoutJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, primary_key=True, serialize=False)),
+                ('cart_id', models.UUIDField()),
+                ('status', models.CharField(choices=[('Q', 'Queued'), ('D', 'Done'), ('F', 'Failed')], default='Q', max_length=1)),
+                ('error', models.CharField(blank=True, max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(null=True)),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='store.customer')),
+                ('order', models.OneToOneField(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='store.order')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'created_at'], name='store_check_status_eaad27_idx')],
+            },
+        ),
+    ]
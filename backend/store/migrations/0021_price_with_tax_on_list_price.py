@@ -0,0 +1,25 @@
+# Generated by Django 4.2.4 on 2026-10-18 18:05
+
+from decimal import Decimal
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models.functions import Round
+
+
+def tax_list_price(apps, schema_editor):
+    # price_with_tax was computed from the discounted price
+    ProductPrice = apps.get_model('store', 'ProductPrice')
+    rate = Decimal(str(getattr(settings, 'STORE_TAX_RATE', '0.10')))
+    ProductPrice.objects.update(price_with_tax=Round(
+        models.F('base_price') * models.Value(1 + rate, output_field=models.DecimalField()), 2))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0020_sales_rollups'),
+    ]
+
+    operations = [
+        migrations.RunPython(tax_list_price, migrations.RunPython.noop),
+    ]
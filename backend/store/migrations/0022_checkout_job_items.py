@@ -0,0 +1,29 @@
+# Generated by Django 4.2.4 on 2026-10-18 19:20
+
+from django.db import migrations, models
+
+
+def snapshot_queued_carts(apps, schema_editor):
+    # Jobs queued before the cart was frozen at enqueue still point at it
+    CheckoutJob = apps.get_model('store', 'CheckoutJob')
+    CartItem = apps.get_model('store', 'CartItem')
+    for job in CheckoutJob.objects.filter(status='Q'):
+        job.items = [list(row) for row in CartItem.objects.filter(cart_id=job.cart_id)
+                     .order_by('id').values_list('product_id', 'quantity')]
+        job.save(update_fields=['items'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0021_price_with_tax_on_list_price'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='checkoutjob',
+            name='items',
+            field=models.JSONField(default=list),
+        ),
+        migrations.RunPython(snapshot_queued_carts, migrations.RunPython.noop),
+    ]
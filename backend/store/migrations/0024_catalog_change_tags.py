@@ -0,0 +1,18 @@
+# Generated by Django 4.2.4 on 2026-10-18 15:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0023_catalog_changes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='catalogchange',
+            name='kind',
+            field=models.CharField(choices=[('P', 'Product'), ('T', 'Tag')], max_length=1),
+        ),
+    ]
@@ -1,18 +1,67 @@
-from django.db import models
+from decimal import Decimal, ROUND_HALF_UP
+from django.db import connection, models
 from django.contrib import admin
 from django.conf import settings
+from django.utils import timezone
 from django.core.validators import MinValueValidator,MaxValueValidator
 from uuid import uuid4
 from store.validators import validate_file_size
 
 
+def conflict_fields(*fields):
+    '''
+    unique_fields for bulk_create(update_conflicts=True). MySQL's ON
+    DUPLICATE KEY UPDATE can not name the conflicting key (it matches
+    any unique index) and Django refuses unique_fields there
+    '''
+    return list(fields) if connection.features.supports_update_conflicts_with_target else None
+
+
 class Promotion(models.Model):
     description = models.CharField(max_length=255)
     discount = models.FloatField()
 
+class CollectionManager(models.Manager):
+    def reconcile_products_count(self,collection_ids=None,batch_size=500):
+        '''
+        products_count is kept up to date by store.signals, writes that
+        skip signals (queryset.update, bulk_create, raw SQL) make it
+        drift. This recounts in batches and fixes the wrong rows,
+        returns how many were fixed
+        '''
+        queryset = self.order_by('id')
+        if collection_ids is not None:
+            queryset = queryset.filter(id__in=collection_ids)
+        fixed = 0
+        last_id = 0
+        while True:
+            batch = list(queryset.filter(id__gt=last_id).only('id','products_count')[:batch_size])
+            if not batch:
+                return fixed
+            last_id = batch[-1].id
+            counts = dict(
+                Product.objects.order_by()
+                .filter(collection_id__in=[collection.id for collection in batch])
+                .values_list('collection_id')
+                .annotate(count=models.Count('id')))
+            drifted = []
+            for collection in batch:
+                if collection.products_count != counts.get(collection.id,0):
+                    collection.products_count = counts.get(collection.id,0)
+                    collection.last_update = timezone.now()
+                    drifted.append(collection)
+            self.bulk_update(drifted,['products_count','last_update'])
+            fixed += len(drifted)
+
+
 class Collection(models.Model):
     title = models.CharField(max_length=255)
     featured_product = models.ForeignKey('Product',on_delete=models.SET_NULL,related_name='+',null=True)
+    last_update = models.DateTimeField(auto_now=True)
+    # Maintained by store.signals, repaired by 'manage.py reconcile_collection_counts'
+    products_count = models.IntegerField(default=0,editable=False)
+
+    objects = CollectionManager()
     
     def __str__(self) -> str:
         return self.title
@@ -37,14 +86,136 @@ class Product(models.Model):
 
     def __str__(self) -> str:
         return self.title
+
+    def get_price(self):
+        # None until the price row exists (bulk writes skip the signals)
+        try:
+            return self.price
+        except ProductPrice.DoesNotExist:
+            return None
+
+    @property
+    def effective_price(self):
+        price = self.get_price()
+        return price.discounted_price if price is not None else self.unit_price
     
     class Meta:
         ordering = ['title']
+        # Keyset pagination orders by (field, id)
+        indexes = [
+            models.Index(fields=['title','id']),
+            models.Index(fields=['unit_price','id']),
+            # Collection filter + price range, and the facet counts
+            models.Index(fields=['collection','unit_price']),
+        ]
+
+class ProductPriceManager(models.Manager):
+    def recompute(self,products=None,batch_size=1000):
+        '''
+        Recalculates the price rows of the given products (a Product
+        queryset, default the whole catalog). Per batch: one query reads
+        the ids, one reads price + best discount, one upserts the rows.
+        Returns the number of products priced
+        '''
+        products = (Product.objects.all() if products is None else products).order_by('id')
+        tax_rate = Decimal(str(getattr(settings,'STORE_TAX_RATE','0.10')))
+        cent = Decimal('0.01')
+        priced = 0
+        last_id = 0
+        while True:
+            ids = list(products.filter(id__gt=last_id).values_list('id',flat=True)[:batch_size])
+            if not ids:
+                return priced
+            last_id = ids[-1]
+            # Aggregated over all promotions of the product, not only the
+            # ones the caller filtered on
+            rows = Product.objects.order_by().filter(id__in=ids) \
+                .values_list('id','unit_price') \
+                .annotate(discount=models.Max('promotions__discount'))
+            now = timezone.now()
+            prices = []
+            for product_id,unit_price,discount in rows:
+                # Promotion.discount is a percentage, the best one wins
+                discount = Decimal(str(min(max(discount or 0,0),100)))
+                discounted = (unit_price*(100-discount)/100).quantize(cent,ROUND_HALF_UP)
+                prices.append(ProductPrice(
+                    product_id=product_id,
+                    base_price=unit_price,
+                    discounted_price=discounted,
+                    # Tax on the list price, like before prices were materialized
+                    price_with_tax=(unit_price*(1+tax_rate)).quantize(cent,ROUND_HALF_UP),
+                    updated_at=now))
+            self.bulk_create(prices,update_conflicts=True,unique_fields=conflict_fields('product'),
+                             update_fields=['base_price','discounted_price','price_with_tax','updated_at'])
+            priced += len(prices)
+
+
+class ProductPrice(models.Model):
+    '''
+    Effective price of a product, kept in sync by store.signals and
+    rebuilt with 'manage.py recompute_prices'
+    '''
+    product = models.OneToOneField(Product,on_delete=models.CASCADE,related_name='price')
+    base_price = models.DecimalField(max_digits=6,decimal_places=2)
+    discounted_price = models.DecimalField(max_digits=6,decimal_places=2)
+    price_with_tax = models.DecimalField(max_digits=8,decimal_places=2)
+    updated_at = models.DateTimeField()
+
+    objects = ProductPriceManager()
+
 
 class ProductImage(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE,related_name='images')
     image = models.ImageField(upload_to='store/image',
                               validators=[validate_file_size])
+    # Resized copies, variant name -> storage path (see store/imaging.py)
+    variants = models.JSONField(default=dict,blank=True,editable=False)
+
+
+class CatalogChange(models.Model):
+    '''
+    Written in the same transaction as the product (or tag) it names,
+    so the in-process indexes of other processes know what to read
+    again (store/changes.py). An object that is gone was deleted
+    '''
+    KIND_PRODUCT = 'P'
+    KIND_TAG = 'T'
+
+    KIND_CHOICES = [
+        (KIND_PRODUCT, 'Product'),
+        (KIND_TAG, 'Tag')
+    ]
+
+    id = models.BigAutoField(primary_key=True)
+    kind = models.CharField(max_length=1,choices=KIND_CHOICES)
+    object_id = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True,db_index=True)
+
+
+class CustomerManager(models.Manager):
+    def id_for_user(self,user):
+        # Users authenticated from token claims already carry it
+        # (core.authentication), no query then
+        customer_id = getattr(user,'customer_id',None)
+        if customer_id is not None:
+            return customer_id
+        return self.values_list('id',flat=True).get(user_id=user.id)
+
+    def create_missing(self,batch_size=1000):
+        '''
+        Every user gets its customer from a post_save signal, users
+        written with bulk_create (or raw SQL) skip it. Creates the
+        missing rows in batches, returns how many
+        '''
+        from django.contrib.auth import get_user_model
+        users = get_user_model().objects.filter(customer__isnull=True).order_by('id')
+        created = 0
+        while True:
+            ids = list(users.values_list('id',flat=True)[:batch_size])
+            if not ids:
+                return created
+            self.bulk_create([Customer(user_id=user_id) for user_id in ids],ignore_conflicts=True)
+            created += len(ids)
 
 
 class Customer(models.Model):
@@ -66,6 +237,8 @@ class Customer(models.Model):
     membership = models.CharField(max_length=1,choices=MEMBERSHIP_CHOICES,default=MEMBERSHIP_BRONZE)
     user = models.OneToOneField(settings.AUTH_USER_MODEL,on_delete=models.CASCADE)
 
+    objects = CustomerManager()
+
     def __str__(self) -> str:
         return self.user.first_name + ' ' + self.user.last_name
     @admin.display(ordering='user__first_name')
@@ -90,8 +263,44 @@ class Order(models.Model):
     payment_status = models.CharField(max_length=1,choices=PAYMENT_STATUS_CHOICES,default=PAYMENT_STATUS_PENDING)
     customer = models.ForeignKey(Customer,on_delete=models.PROTECT)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['placed_at','id']),
+        ]
+
 
 
+class InventoryShard(models.Model):
+    '''
+    Stock of a hot product split over several rows so concurrent
+    checkouts decrement different rows (store/inventory.py). While a
+    product has shards its Product.inventory is only a display copy
+    '''
+    product = models.ForeignKey(Product,on_delete=models.CASCADE,related_name='inventory_shards')
+    shard = models.PositiveSmallIntegerField()
+    quantity = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = [['product','shard']]
+
+
+class InventoryReservation(models.Model):
+    '''
+    Stock taken by a pending order. Paid orders drop their reservations,
+    unpaid ones give the stock back once expires_at has passed
+    '''
+    order = models.ForeignKey(Order,on_delete=models.CASCADE,related_name='reservations')
+    product = models.ForeignKey(Product,on_delete=models.CASCADE,related_name='+')
+    # Shard the quantity came from, None for Product.inventory
+    shard = models.PositiveSmallIntegerField(null=True)
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['expires_at']),
+        ]
+
 
 class Address(models.Model):
     street = models.CharField(max_length=255)
@@ -106,9 +315,176 @@ class OrderItem(models.Model):
     unit_price = models.DecimalField(max_digits=6,decimal_places=2)
 
 
+class OrderSummaryManager(models.Manager):
+    def rebuild(self,orders=None,batch_size=1000):
+        '''
+        Rewrites the summary rows of the given orders (an Order queryset,
+        default all of them) from their items. Checkout and payment
+        updates write the rows directly, this is for backfills and for
+        changes made around the API (admin, raw SQL)
+        '''
+        orders = (Order.objects.all() if orders is None else orders).order_by('id')
+        rebuilt = 0
+        last_id = 0
+        while True:
+            ids = list(orders.filter(id__gt=last_id).values_list('id',flat=True)[:batch_size])
+            if not ids:
+                return rebuilt
+            last_id = ids[-1]
+            rows = Order.objects.order_by().filter(id__in=ids) \
+                .values_list('id','customer_id','placed_at','payment_status') \
+                .annotate(item_count=models.Sum('items__quantity'),
+                          total_amount=models.Sum(models.F('items__unit_price')*models.F('items__quantity'),
+                                                  output_field=models.DecimalField(max_digits=10,decimal_places=2)))
+            now = timezone.now()
+            summaries = [
+                OrderSummary(order_id=order_id,customer_id=customer_id,placed_at=placed_at,
+                             payment_status=payment_status,item_count=item_count or 0,
+                             total_amount=Decimal(total_amount or 0).quantize(Decimal('0.01')),updated_at=now)
+                for order_id,customer_id,placed_at,payment_status,item_count,total_amount in rows]
+            self.bulk_create(summaries,update_conflicts=True,unique_fields=conflict_fields('order'),
+                             update_fields=['customer','placed_at','payment_status','item_count','total_amount','updated_at'])
+            rebuilt += len(summaries)
+
+
+class OrderSummary(models.Model):
+    '''
+    Read model of an order for order history lists: one row per order
+    with its totals, so a list is a single indexed query without items.
+    Written in the checkout transaction (CreateOrderSerializer) and on
+    payment status changes
+    '''
+    order = models.OneToOneField(Order,on_delete=models.CASCADE,primary_key=True,related_name='summary')
+    customer = models.ForeignKey(Customer,on_delete=models.CASCADE,related_name='+')
+    placed_at = models.DateTimeField()
+    payment_status = models.CharField(max_length=1,choices=Order.PAYMENT_STATUS_CHOICES)
+    # Total quantity of the items
+    item_count = models.PositiveIntegerField(default=0)
+    total_amount = models.DecimalField(max_digits=10,decimal_places=2,default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = OrderSummaryManager()
+
+    class Meta:
+        indexes = [
+            # Customer history and the staff list, newest first
+            models.Index(fields=['customer','placed_at','order']),
+            models.Index(fields=['placed_at','order']),
+            # Changes since the last sales rollup run (store/rollups.py)
+            models.Index(fields=['updated_at']),
+        ]
+
+
+class DailyProductSales(models.Model):
+    '''
+    Sales rollups, built from paid orders by store/rollups.py
+    ('manage.py update_sales_rollups'). Dashboards read these instead
+    of aggregating the order history
+    '''
+    date = models.DateField()
+    product = models.ForeignKey(Product,on_delete=models.CASCADE,related_name='+')
+    orders_count = models.PositiveIntegerField()
+    quantity = models.PositiveIntegerField()
+    revenue = models.DecimalField(max_digits=12,decimal_places=2)
+
+    class Meta:
+        unique_together = [['date','product']]
+
+
+class DailyCollectionSales(models.Model):
+    date = models.DateField()
+    collection = models.ForeignKey(Collection,on_delete=models.CASCADE,related_name='+')
+    orders_count = models.PositiveIntegerField()
+    quantity = models.PositiveIntegerField()
+    revenue = models.DecimalField(max_digits=12,decimal_places=2)
+
+    class Meta:
+        unique_together = [['date','collection']]
+
+
+class MonthlyCustomerSales(models.Model):
+    # First day of the month
+    month = models.DateField()
+    customer = models.ForeignKey(Customer,on_delete=models.CASCADE,related_name='+')
+    orders_count = models.PositiveIntegerField()
+    quantity = models.PositiveIntegerField()
+    revenue = models.DecimalField(max_digits=12,decimal_places=2)
+
+    class Meta:
+        unique_together = [['month','customer']]
+
+
+class RollupWatermark(models.Model):
+    # OrderSummary.updated_at up to which the rollups are complete
+    name = models.CharField(max_length=50,unique=True)
+    value = models.DateTimeField()
+
+
+class CheckoutJob(models.Model):
+    '''
+    Queued checkout of a cart (STORE_CHECKOUT_QUEUE), placed by
+    'manage.py run_checkout_workers', see store/checkout.py
+    '''
+    STATUS_QUEUED = 'Q'
+    STATUS_DONE = 'D'
+    STATUS_FAILED = 'F'
+
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed')
+    ]
+
+    id = models.UUIDField(primary_key=True,default=uuid4)
+    customer = models.ForeignKey(Customer,on_delete=models.CASCADE,related_name='+')
+    cart_id = models.UUIDField()
+    # [[product_id, quantity]], the cart as it was when it was queued
+    items = models.JSONField(default=list)
+    status = models.CharField(max_length=1,choices=STATUS_CHOICES,default=STATUS_QUEUED)
+    order = models.OneToOneField(Order,on_delete=models.SET_NULL,null=True,related_name='+')
+    error = models.CharField(max_length=255,blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True)
+
+    class Meta:
+        # Workers take the oldest queued jobs
+        indexes = [
+            models.Index(fields=['status','created_at']),
+        ]
+
+
+class IdempotencyKey(models.Model):
+    '''
+    Stored response of a request sent with an Idempotency-Key header
+    (store/idempotency.py). status_code is None while the first request
+    is still running, the row is its lock
+    '''
+    # Who sent it and where: user (or anonymous) + method + path
+    scope = models.CharField(max_length=255)
+    key = models.CharField(max_length=255)
+    request_hash = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(null=True)
+    response = models.JSONField(null=True)
+    # Headers the client acts on, e.g. the Location of a queued checkout
+    headers = models.JSONField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = [['scope','key']]
+
+
 class Cart(models.Model):
     id = models.UUIDField(primary_key=True,default=uuid4)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Last activity, moved by the cart store on every change
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        # Expired carts are swept in updated_at order (store/sweeper.py)
+        indexes = [
+            models.Index(fields=['updated_at']),
+        ]
 
 class CartItem(models.Model):
     cart = models.ForeignKey(Cart,on_delete=models.CASCADE,related_name='items')
@@ -1,4 +1,178 @@
-from rest_framework.pagination import PageNumberPagination
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from django.db import connections
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
 class DefaultPagination(PageNumberPagination):
-    page_size =10
\ No newline at end of file
+    page_size =10
+
+
+class KeysetPagination(BasePagination):
+    '''
+    Cursor pagination on (ordering field, pk)
+    Pages are fetched with WHERE (field, pk) > (last field, last pk)
+    instead of OFFSET and there is no COUNT(*), so every page costs the
+    same no matter how deep it is. The cursor is opaque for the client.
+    Views choose the allowed orderings with keyset_ordering_fields and
+    the default with keyset_default_ordering (see KeysetPaginationMixin)
+    '''
+    page_size = 10
+    cursor_query_param = 'cursor'
+    ordering_query_param = 'ordering'
+    approximate_count_query_param = 'approximate_count'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.field, self.descending = self.get_ordering(request, view)
+        self.ordering_key = ('-' if self.descending else '') + self.field
+        cursor = self.decode_cursor(request)
+        self.reverse = cursor is not None and cursor['r']
+
+        self.approximate_count = None
+        if request.query_params.get(self.approximate_count_query_param):
+            self.approximate_count = self.get_approximate_count(queryset)
+
+        # Going backwards is the same query with the order flipped
+        descending = self.descending != self.reverse
+        order = [self.field, 'pk']
+        queryset = queryset.order_by(*[('-' if descending else '') + name for name in order])
+        if cursor is not None:
+            queryset = queryset.filter(self.get_position_filter(cursor['v'], descending))
+
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if self.reverse:
+            results.reverse()
+
+        self.next_position = self.previous_position = None
+        if results:
+            first, last = self.get_position(results[0]), self.get_position(results[-1])
+            if self.reverse:
+                self.next_position = last
+                self.previous_position = first if has_more else None
+            else:
+                self.next_position = last if has_more else None
+                self.previous_position = first if cursor is not None else None
+        return results
+
+    def get_ordering(self, request, view):
+        allowed = getattr(view, 'keyset_ordering_fields', [])
+        ordering = request.query_params.get(self.ordering_query_param, '').split(',')[0].strip()
+        if ordering.lstrip('-') not in allowed:
+            ordering = getattr(view, 'keyset_default_ordering', 'pk')
+        return ordering.lstrip('-'), ordering.startswith('-')
+
+    def get_position(self, instance):
+        return [getattr(instance, self.field), instance.pk]
+
+    def get_position_filter(self, values, descending):
+        field_value, pk_value = values
+        lookup = 'lt' if descending else 'gt'
+        return (Q(**{f'{self.field}__{lookup}': field_value})
+                | Q(**{self.field: field_value, f'pk__{lookup}': pk_value}))
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            cursor = json.loads(urlsafe_b64decode(encoded.encode('ascii')))
+            values, reverse, ordering = cursor['v'], bool(cursor['r']), cursor['o']
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+        # A cursor is only valid for the ordering it was created with
+        if ordering != self.ordering_key or not isinstance(values, list) or len(values) != 2:
+            raise NotFound(self.invalid_cursor_message)
+        return {'v': values, 'r': reverse}
+
+    def encode_cursor(self, position, reverse):
+        # Decimals and datetimes go as strings, the ORM parses them back
+        cursor = json.dumps({'v': position, 'r': int(reverse), 'o': self.ordering_key}, default=str)
+        encoded = urlsafe_b64encode(cursor.encode()).decode('ascii')
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        return self.encode_cursor(self.next_position, False)
+
+    def get_previous_link(self):
+        if self.previous_position is None:
+            return None
+        return self.encode_cursor(self.previous_position, True)
+
+    def get_approximate_count(self, queryset):
+        '''
+        Row estimate from the database statistics, only meaningful when
+        the whole table is listed, filtered querysets return None
+        '''
+        if queryset.query.where:
+            return None
+        connection = connections[queryset.db]
+        table = queryset.model._meta.db_table
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE relname = %s', [table])
+            elif connection.vendor == 'mysql':
+                cursor.execute(
+                    'SELECT TABLE_ROWS FROM information_schema.TABLES '
+                    'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s', [table])
+            else:
+                return None
+            row = cursor.fetchone()
+        return max(row[0], 0) if row and row[0] is not None else None
+
+    def get_paginated_response(self, data):
+        response = {
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        }
+        if self.request.query_params.get(self.approximate_count_query_param):
+            response['approximate_count'] = self.approximate_count
+        return Response(response)
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'approximate_count': {'type': 'integer', 'nullable': True},
+                'results': schema,
+            },
+        }
+
+    @classmethod
+    def is_requested(cls, request):
+        return (request.query_params.get('pagination') == 'cursor'
+                or bool(request.query_params.get(cls.cursor_query_param)))
+
+
+class KeysetPaginationMixin:
+    '''
+    Switches a viewset to KeysetPagination when the client asks for it
+    with ?pagination=cursor (or sends a cursor), otherwise the normal
+    pagination_class is used, which may be None (unpaginated)
+    '''
+    keyset_ordering_fields = []
+    keyset_default_ordering = 'pk'
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            if self.request is not None and KeysetPagination.is_requested(self.request):
+                self._paginator = KeysetPagination()
+            elif self.pagination_class is None:
+                self._paginator = None
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
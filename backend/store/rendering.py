@@ -0,0 +1,26 @@
+from io import BytesIO
+from PIL import Image, ImageOps
+
+'''
+Image rendering done in the store.imaging process pool
+The workers are started with forkserver / spawn (forking a web worker
+that already runs threads can deadlock the child on a lock one of those
+threads held), so they import this module fresh: it must not import
+Django, only PIL.
+'''
+
+
+def render_variant(data, spec):
+    '''
+    Source bytes in, encoded bytes out
+    '''
+    with Image.open(BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((spec['width'], spec['height']), Image.LANCZOS)
+        if spec['format'] == 'JPEG' and image.mode != 'RGB':
+            image = image.convert('RGB')
+        elif image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA')
+        output = BytesIO()
+        image.save(output, spec['format'], quality=spec.get('quality', 85), optimize=True)
+    return output.getvalue()
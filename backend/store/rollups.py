@@ -0,0 +1,183 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, time, timedelta
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Count, DecimalField, F, Max, Min, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from store.models import (DailyCollectionSales, DailyProductSales, MonthlyCustomerSales, Order, OrderItem,
+                          OrderSummary, RollupWatermark)
+
+'''
+Sales rollups
+Paid orders are aggregated into DailyProductSales, DailyCollectionSales
+and MonthlyCustomerSales. An incremental run reads the OrderSummary rows
+whose updated_at moved past the watermark (new orders and payment status
+changes) and recomputes only the days and customer months they fall in,
+each one from scratch, so an order that changed is never counted twice.
+The run stops STORE_ROLLUP_LAG seconds before now, transactions still
+in flight commit behind the watermark otherwise.
+Moving a product to another collection is not a change of any order,
+a full rebuild (split in chunks of days over processes) picks it up.
+'''
+WATERMARK = 'sales'
+DAY_CHUNK = 31
+REVENUE = DecimalField(max_digits=12, decimal_places=2)
+
+
+def day_range(day):
+    start = timezone.make_aware(datetime.combine(day, time.min))
+    return start, start + timedelta(days=1)
+
+
+def month_start(day):
+    return day.replace(day=1)
+
+
+def month_range(month):
+    start = timezone.make_aware(datetime.combine(month, time.min))
+    following = (month + timedelta(days=32)).replace(day=1)
+    return start, timezone.make_aware(datetime.combine(following, time.min))
+
+
+def paid_items_on(days):
+    ranges = Q()
+    for day in days:
+        start, end = day_range(day)
+        ranges |= Q(order__placed_at__gte=start, order__placed_at__lt=end)
+    return OrderItem.objects.order_by().filter(ranges, order__payment_status=Order.PAYMENT_STATUS_COMPLETE) \
+        .annotate(date=TruncDate('order__placed_at'))
+
+
+def sales_totals(queryset, *group):
+    return queryset.values(*group).annotate(
+        orders_count=Count('order_id', distinct=True),
+        quantity_sum=Sum('quantity'),
+        revenue=Sum(F('unit_price') * F('quantity'), output_field=REVENUE))
+
+
+def recompute_days(days):
+    # Rewrites the product and collection rows of these days
+    days = sorted(set(days))
+    for position in range(0, len(days), DAY_CHUNK):
+        chunk = days[position:position + DAY_CHUNK]
+        items = paid_items_on(chunk)
+        products = [
+            DailyProductSales(date=row['date'], product_id=row['product_id'], orders_count=row['orders_count'],
+                              quantity=row['quantity_sum'], revenue=row['revenue'])
+            for row in sales_totals(items, 'date', 'product_id')]
+        collections = [
+            DailyCollectionSales(date=row['date'], collection_id=row['product__collection_id'],
+                                 orders_count=row['orders_count'], quantity=row['quantity_sum'], revenue=row['revenue'])
+            for row in sales_totals(items, 'date', 'product__collection_id')]
+        with transaction.atomic():
+            DailyProductSales.objects.filter(date__in=chunk).delete()
+            DailyCollectionSales.objects.filter(date__in=chunk).delete()
+            DailyProductSales.objects.bulk_create(products, batch_size=1000)
+            DailyCollectionSales.objects.bulk_create(collections, batch_size=1000)
+    return len(days)
+
+
+def recompute_months(months):
+    '''
+    months: {month: customer ids or None for all customers}. Read from
+    OrderSummary, which already has the totals per order
+    '''
+    for month, customer_ids in sorted(months.items()):
+        start, end = month_range(month)
+        orders = OrderSummary.objects.order_by().filter(
+            placed_at__gte=start, placed_at__lt=end, payment_status=Order.PAYMENT_STATUS_COMPLETE)
+        rows = MonthlyCustomerSales.objects.filter(month=month)
+        if customer_ids is not None:
+            orders = orders.filter(customer_id__in=customer_ids)
+            rows = rows.filter(customer_id__in=customer_ids)
+        customers = [
+            MonthlyCustomerSales(month=month, customer_id=row['customer_id'], orders_count=row['orders_count'],
+                                 quantity=row['quantity'] or 0, revenue=row['revenue'] or 0)
+            for row in orders.values('customer_id').annotate(
+                orders_count=Count('order_id'), quantity=Sum('item_count'), revenue=Sum('total_amount'))]
+        with transaction.atomic():
+            rows.delete()
+            MonthlyCustomerSales.objects.bulk_create(customers, batch_size=1000)
+    return len(months)
+
+
+def get_high_mark():
+    return timezone.now() - timedelta(seconds=getattr(settings, 'STORE_ROLLUP_LAG', 60))
+
+
+def set_watermark(value):
+    RollupWatermark.objects.update_or_create(name=WATERMARK, defaults={'value': value})
+
+
+def update_rollups():
+    '''
+    Incremental run, a full rebuild when there is no watermark yet.
+    Returns {'orders', 'days', 'months'}
+    '''
+    watermark = RollupWatermark.objects.filter(name=WATERMARK).values_list('value', flat=True).first()
+    if watermark is None:
+        return rebuild_rollups(workers=1)
+    high_mark = get_high_mark()
+    days = set()
+    months = {}
+    changed = OrderSummary.objects.order_by().filter(updated_at__gt=watermark, updated_at__lte=high_mark) \
+        .values_list('customer_id', 'placed_at')
+    orders = 0
+    for customer_id, placed_at in changed.iterator(chunk_size=2000):
+        day = timezone.localdate(placed_at)
+        days.add(day)
+        months.setdefault(month_start(day), set()).add(customer_id)
+        orders += 1
+    recompute_days(days)
+    recompute_months({month: list(customer_ids) for month, customer_ids in months.items()})
+    set_watermark(high_mark)
+    return {'orders': orders, 'days': len(days), 'months': len(months)}
+
+
+def run_chunk(kind, values):
+    if kind == 'days':
+        return recompute_days(values)
+    return recompute_months({month: None for month in values})
+
+
+def rebuild_rollups(workers=1, chunk_days=DAY_CHUNK):
+    '''
+    Recomputes every rollup row. The days (and months) of the order
+    history are split in chunks which run in parallel in worker
+    processes, each chunk in its own transactions
+    '''
+    high_mark = get_high_mark()
+    bounds = OrderSummary.objects.order_by().aggregate(first=Min('placed_at'), last=Max('placed_at'))
+    tasks = []
+    days = []
+    months = []
+    if bounds['first'] is not None:
+        first, last = timezone.localdate(bounds['first']), timezone.localdate(bounds['last'])
+        days = [first + timedelta(days=offset) for offset in range((last - first).days + 1)]
+        months = sorted({month_start(day) for day in days})
+        tasks += [('days', days[position:position + chunk_days]) for position in range(0, len(days), chunk_days)]
+        tasks += [('months', months[position:position + 12]) for position in range(0, len(months), 12)]
+    if workers > 1 and len(tasks) > 1:
+        # Children open their own connections, the parent's must not be shared
+        connections.close_all()
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('fork') if 'fork' in methods else None
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            for future in [pool.submit(run_chunk, kind, values) for kind, values in tasks]:
+                future.result()
+    else:
+        for kind, values in tasks:
+            run_chunk(kind, values)
+    # Rows of days and months without orders anymore, the chunks only
+    # rewrite the ones inside the history
+    outside_days = Q(date__lt=days[0]) | Q(date__gt=days[-1]) if days else Q()
+    outside_months = Q(month__lt=months[0]) | Q(month__gt=months[-1]) if months else Q()
+    with transaction.atomic():
+        DailyProductSales.objects.filter(outside_days).delete()
+        DailyCollectionSales.objects.filter(outside_days).delete()
+        MonthlyCustomerSales.objects.filter(outside_months).delete()
+    set_watermark(high_mark)
+    return {'orders': OrderSummary.objects.count(), 'days': len(days), 'months': len(months)}
@@ -0,0 +1,304 @@
+import math
+import os
+import pickle
+import re
+import threading
+from bisect import bisect_left, insort
+from django.conf import settings
+from django.utils import timezone
+from rest_framework.filters import OrderingFilter, SearchFilter
+from rest_framework.pagination import PageNumberPagination
+
+from store.cache import get_catalog_version
+from store.changes import ChangeReader, get_retention
+from store.models import CatalogChange, Product
+
+'''
+In-process full text index for products
+Inverted index over title and description with BM25 ranking. The last
+word of a query is matched as a prefix so it works for typeahead.
+Every process keeps its own copy: its own writes are applied by
+store.signals, writes done by other processes are picked up when the
+catalog version changes (or on a poll, see store/changes.py): the
+products named in the change log since the last catch up are re-read,
+the ones that are gone dropped.
+'''
+TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    if not text:
+        return []
+    return TOKEN_RE.findall(text.lower())
+
+
+class ProductSearchIndex:
+    k1 = 1.2
+    b = 0.75
+    # A title word counts as much as this many description words
+    title_weight = 3
+    # Prefix lookups expand to at most this many vocabulary words
+    max_prefix_expansions = 50
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # One catch up at a time, the others search what is there
+        self.refresh_lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.postings = {}
+        self.doc_lengths = {}
+        self.doc_terms = {}
+        self.total_length = 0
+        # Sorted vocabulary for prefix matching
+        self.vocabulary = []
+        self.version = None
+        self.synced_at = None
+        self.changes = ChangeReader()
+
+    @property
+    def is_built(self):
+        return self.synced_at is not None
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    def _weights(self, title, description):
+        weights = {}
+        for term in tokenize(title):
+            weights[term] = weights.get(term, 0) + self.title_weight
+        max_tokens = getattr(settings, 'STORE_SEARCH_MAX_DESCRIPTION_TOKENS', 500)
+        for term in tokenize(description)[:max_tokens]:
+            weights[term] = weights.get(term, 0) + 1
+        return weights
+
+    def add(self, product_id, title, description):
+        weights = self._weights(title, description)
+        with self.lock:
+            self._remove(product_id)
+            for term, weight in weights.items():
+                docs = self.postings.get(term)
+                if docs is None:
+                    docs = self.postings[term] = {}
+                    insort(self.vocabulary, term)
+                docs[product_id] = weight
+            length = sum(weights.values())
+            self.doc_lengths[product_id] = length
+            self.doc_terms[product_id] = tuple(weights)
+            self.total_length += length
+
+    def remove(self, product_id):
+        with self.lock:
+            self._remove(product_id)
+
+    def _remove(self, product_id):
+        terms = self.doc_terms.pop(product_id, None)
+        if terms is None:
+            return
+        self.total_length -= self.doc_lengths.pop(product_id)
+        for term in terms:
+            docs = self.postings[term]
+            del docs[product_id]
+            if not docs:
+                del self.postings[term]
+                del self.vocabulary[bisect_left(self.vocabulary, term)]
+
+    def expand_prefix(self, prefix):
+        start = bisect_left(self.vocabulary, prefix)
+        terms = []
+        for term in self.vocabulary[start:start + self.max_prefix_expansions]:
+            if not term.startswith(prefix):
+                break
+            terms.append(term)
+        return terms
+
+    def search(self, query):
+        '''
+        Returns the ids of all the matching products ranked by BM25. Like
+        SearchFilter every word has to match, the last one only as a prefix
+        '''
+        words = tokenize(query)
+        if not words:
+            return []
+        with self.lock:
+            count = len(self.doc_lengths)
+            if not count:
+                return []
+            average_length = self.total_length / count
+            scores = None
+            for position, word in enumerate(words):
+                if position == len(words) - 1:
+                    terms = self.expand_prefix(word)
+                else:
+                    terms = [word] if word in self.postings else []
+                word_scores = {}
+                for term in terms:
+                    docs = self.postings[term]
+                    idf = math.log(1 + (count - len(docs) + 0.5) / (len(docs) + 0.5))
+                    for product_id, weight in docs.items():
+                        if scores is not None and product_id not in scores:
+                            continue
+                        norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[product_id] / average_length)
+                        score = idf * weight * (self.k1 + 1) / (weight + norm)
+                        if score > word_scores.get(product_id, 0):
+                            word_scores[product_id] = score
+                if scores is None:
+                    scores = word_scores
+                else:
+                    scores = {product_id: scores[product_id] + score
+                              for product_id, score in word_scores.items()}
+                if not scores:
+                    return []
+        return sorted(scores, key=lambda product_id: (-scores[product_id], product_id))
+
+    def build(self, rows):
+        # rows: iterable of (id, title, description)
+        with self.lock:
+            self.clear()
+            for product_id, title, description in rows:
+                self.add(product_id, title, description)
+
+    def build_from_database(self, chunk_size=2000):
+        version = get_catalog_version()
+        changes = ChangeReader()
+        changes.start()
+        synced_at = timezone.now()
+        rows = Product.objects.order_by().values_list('id', 'title', 'description').iterator(chunk_size=chunk_size)
+        with self.lock:
+            self.build(rows)
+            self.changes = changes
+            self.version = version
+            self.synced_at = synced_at
+
+    def refresh(self, chunk_size=2000):
+        '''
+        Catches up with writes made by other processes since the last sync
+        '''
+        version = get_catalog_version()
+        if version == self.version and not self.changes.is_poll_due():
+            return
+        if not self.refresh_lock.acquire(blocking=False):
+            return
+        try:
+            changed = sorted(self.changes.read().get(CatalogChange.KIND_PRODUCT, ()))
+            rows = []
+            for offset in range(0, len(changed), chunk_size):
+                rows.extend(Product.objects.order_by().filter(id__in=changed[offset:offset + chunk_size])
+                            .values_list('id', 'title', 'description'))
+            with self.lock:
+                for product_id, title, description in rows:
+                    self.add(product_id, title, description)
+                for product_id in set(changed).difference(row[0] for row in rows):
+                    self._remove(product_id)
+                self.version = version
+                self.synced_at = timezone.now()
+        finally:
+            self.refresh_lock.release()
+
+    def ensure_fresh(self):
+        if self.is_built:
+            self.refresh()
+            return
+        with self.lock:
+            if self.is_built:
+                return
+            path = getattr(settings, 'STORE_SEARCH_INDEX_PATH', None)
+            if path and os.path.exists(path) and self.load(path):
+                self.refresh()
+            else:
+                self.build_from_database()
+
+    def save(self, path):
+        with self.lock:
+            state = {
+                'postings': self.postings,
+                'doc_lengths': self.doc_lengths,
+                'doc_terms': self.doc_terms,
+                'total_length': self.total_length,
+                'synced_at': self.synced_at,
+                'changes': self.changes.state(),
+            }
+            tmp_path = f'{path}.tmp'
+            with open(tmp_path, 'wb') as file:
+                pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+
+    def load(self, path):
+        '''
+        Returns False (and loads nothing) when the file is older than the
+        change log, it could not be caught up
+        '''
+        with open(path, 'rb') as file:
+            state = pickle.load(file)
+        if 'changes' not in state or state['synced_at'] < timezone.now() - get_retention():
+            return False
+        with self.lock:
+            self.clear()
+            self.postings = state['postings']
+            self.doc_lengths = state['doc_lengths']
+            self.doc_terms = state['doc_terms']
+            self.total_length = state['total_length']
+            self.vocabulary = sorted(self.postings)
+            self.synced_at = state['synced_at']
+            self.changes = ChangeReader(**state['changes'])
+        return True
+
+
+product_index = ProductSearchIndex()
+
+
+def get_max_results():
+    return getattr(settings, 'STORE_SEARCH_MAX_RESULTS', 500)
+
+
+class ProductSearchFilter(SearchFilter):
+    '''
+    ?search= backed by product_index instead of icontains scans
+    The queryset is narrowed to the STORE_SEARCH_MAX_RESULTS best matches,
+    the count, the ETag and the facets reuse it so its IN list has to stay
+    bounded. The ranking is left on the view for SearchRankingMixin
+    '''
+    # With other filters the ranking is checked against them a slice of
+    # STORE_SEARCH_MAX_RESULTS ids at a time, at most this many slices
+    max_filter_slices = 10
+
+    def filter_queryset(self, request, queryset, view):
+        view.search_ranking = None
+        query = request.query_params.get(self.search_param, '')
+        if not tokenize(query):
+            return queryset
+        product_index.ensure_fresh()
+        ids = product_index.search(query)
+        limit = get_max_results()
+        if ids and queryset.query.where:
+            # Other filters too, only their ids keep their rank
+            kept = []
+            for offset in range(0, min(len(ids), limit * self.max_filter_slices), limit):
+                ranked = ids[offset:offset + limit]
+                matching = set(queryset.filter(pk__in=ranked).values_list('pk', flat=True))
+                kept.extend(pk for pk in ranked if pk in matching)
+                if len(kept) >= limit:
+                    break
+            ids = kept
+        ids = ids[:limit]
+        if not ids:
+            return queryset.none()
+        view.search_ranking = ids
+        return queryset.filter(pk__in=ids)
+
+
+class SearchRankingMixin:
+    '''
+    Pages ?search= results in rank order (unless ?ordering= is given):
+    the ranked ids are paginated in memory and only the products of the
+    page are read, like /products/browse/
+    '''
+    def paginate_queryset(self, queryset):
+        ranking = getattr(self, 'search_ranking', None)
+        if ranking is None or not isinstance(self.paginator, PageNumberPagination) \
+                or OrderingFilter().get_ordering(self.request, queryset, self):
+            return super().paginate_queryset(queryset)
+        page_ids = self.paginator.paginate_queryset(ranking, self.request, view=self)
+        products = {product.pk: product for product in queryset.order_by().filter(pk__in=page_ids)}
+        return [products[pk] for pk in page_ids if pk in products]
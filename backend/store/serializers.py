@@ -1,31 +1,60 @@
 from decimal import Decimal
+from django.conf import settings
 from django.db.models import Count
 from django.db import transaction
+from django.utils import timezone
 from rest_framework import serializers
+from rest_framework.exceptions import NotFound
+from tags.models import TaggedItem
 
 
-from .models import Cart, CartItem, Customer, Order, OrderItem, Product,Collection, ProductImage,Review
+from .carts import MAX_QUANTITY, get_cart_store
+from .compiled import CompiledRepresentationMixin
+from .fieldsets import SparseFieldsMixin
+from .imaging import variant_urls
+from .inventory import InsufficientStock, reserve, settle
+from .models import Cart, CartItem, CheckoutJob, Customer, DailyCollectionSales, DailyProductSales, MonthlyCustomerSales, Order, OrderItem, OrderSummary, Product,Collection, ProductImage,Review
 
 class CollectionSerializer(serializers.ModelSerializer):
     class Meta:
         model = Collection
         fields = ['id','title','products_count']
-    products_count = serializers.IntegerField(read_only = True)
+        read_only_fields = ['products_count']
+
+class ProductImageSerializer(CompiledRepresentationMixin,serializers.ModelSerializer):
+    variants = serializers.SerializerMethodField()
+
+    def get_variants(self,image):
+        return variant_urls(image,self.context.get('request'))
 
-class ProductImageSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         product_id = self.context['product_id']
         return ProductImage.objects.create(product_id=product_id,**validated_data)
     class Meta:
         model = ProductImage
-        fields = ['id','image']
+        fields = ['id','image','variants']
+
 
+# Loads the tags of a whole page with one query before the rows render
+class TaggedListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        if 'tags' in self.child.fields:
+            data = TaggedItem.objects.prefetch_tags(data.all() if hasattr(data,'all') else data)
+        return super().to_representation(data)
 
-class ProductSerializer(serializers.ModelSerializer):
+class ProductSerializer(SparseFieldsMixin,CompiledRepresentationMixin,serializers.ModelSerializer):
     images = ProductImageSerializer(many=True,read_only=True)
+    tags = serializers.SerializerMethodField()
     class Meta:
         model = Product
-        fields = ['id','title','slug','description','unit_price','price_with_tax','inventory','collection','images']
+        fields = ['id','title','slug','description','unit_price','discounted_price','price_with_tax','inventory','collection','images','tags']
+        list_serializer_class = TaggedListSerializer
+        # ?fields= / ?expand= support, see store/fieldsets.py
+        sparse_only = {'discounted_price':['unit_price'],'price_with_tax':['unit_price']}
+        sparse_select = {'discounted_price':['price'],'price_with_tax':['price']}
+        sparse_prefetch = {'images':['images']}
+    # Both come from the ProductPrice table (select_related('price'))
+    discounted_price = serializers.SerializerMethodField()
     price_with_tax = serializers.SerializerMethodField(method_name='calculate_tax')
   
     # Simple Serializer
@@ -47,11 +76,25 @@ class ProductSerializer(serializers.ModelSerializer):
     #     view_name= 'collection-detail'
     # )
 
+    def get_tags(self,product: Product):
+        tags = getattr(product,'tags',None)
+        if tags is None:
+            # Detail view, one query for this product
+            tags = [item.tag for item in TaggedItem.objects.get_tags_for(Product,product.pk).order_by('tag__label')]
+        return [tag.label for tag in tags]
+
+    def get_discounted_price(self,product: Product):
+        return product.effective_price
+
     def calculate_tax(self,product: Product):
-        return product.unit_price * Decimal(1.1)
+        price = product.get_price()
+        if price is not None:
+            return price.price_with_tax
+        # Not priced yet
+        return product.unit_price * (1 + Decimal(str(getattr(settings,'STORE_TAX_RATE','0.10'))))
     
 
-class SimpleProductSerializer(serializers.ModelSerializer):
+class SimpleProductSerializer(CompiledRepresentationMixin,serializers.ModelSerializer):
     class Meta:
         model = Product
         fields = ['id','title','unit_price']
@@ -70,12 +113,12 @@ class ReviewSerializer(serializers.ModelSerializer):
         product_id = self.context['product_id']
         return Review.objects.create(product_id = product_id,**validated_data)
 
-class CartItemSerializer(serializers.ModelSerializer):
+class CartItemSerializer(CompiledRepresentationMixin,serializers.ModelSerializer):
     product=SimpleProductSerializer()
     total_price = serializers.SerializerMethodField(method_name='get_total_price')
     
     def get_total_price(self,cartitem:CartItem):
-        return cartitem.product.unit_price * cartitem.quantity
+        return cartitem.product.effective_price * cartitem.quantity
     class Meta:
         model = CartItem
         fields = ['product','quantity','total_price']
@@ -89,66 +132,116 @@ class AddCartItemSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError('This product is not available')
         return value
 
+    # Adds to the quantity when the product is already in the cart
     def save(self, **kwargs):
         cart_id = self.context['cart_id']
         product_id = self.validated_data['product_id']
         quantity = self.validated_data['quantity']
-        try:
-            cart_item =  CartItem.objects.get(cart_id=cart_id,product_id=product_id)
-            cart_item.quantity += quantity
-            cart_item.save()
-            self.instance = cart_item
-        except CartItem.DoesNotExist:
-            self.instance = CartItem.objects.create(cart_id=cart_id,**self.validated_data)
+        self.instance = get_cart_store().add_item(cart_id,product_id,quantity)
+        if self.instance is None:
+            raise NotFound('No cart with this id exists')
         return self.instance   
     class Meta:
         model = CartItem
         fields = ['id','product_id','quantity']
 
+class CartItemOperationSerializer(serializers.Serializer):
+    OPERATION_CHOICES = ['add','set','remove']
+    op = serializers.ChoiceField(choices=OPERATION_CHOICES,default='add')
+    product_id = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=1,max_value=MAX_QUANTITY,required=False)
+
+    def validate(self, data):
+        if data['op'] != 'remove' and 'quantity' not in data:
+            raise serializers.ValidationError({'quantity':'This field is required.'})
+        return data
+
+class BulkCartItemSerializer(serializers.Serializer):
+    '''
+    Several add/set/remove operations in one request, all the product
+    ids are checked with one IN query and applied in one transaction
+    '''
+    items = CartItemOperationSerializer(many=True,allow_empty=False)
+
+    def validate_items(self,items):
+        product_ids = {item['product_id'] for item in items}
+        existing = set(Product.objects.order_by().filter(id__in=product_ids).values_list('id',flat=True))
+        missing = sorted(product_ids - existing)
+        if missing:
+            raise serializers.ValidationError(f"These products are not available: {', '.join(map(str,missing))}")
+        return items
+
+    def save(self, **kwargs):
+        operations = [(item['op'],item['product_id'],item.get('quantity')) for item in self.validated_data['items']]
+        if not get_cart_store().apply(self.context['cart_id'],operations):
+            raise NotFound('No cart with this id exists')
+
 class UpdateCartItemSerializer(serializers.ModelSerializer):
+    def update(self, instance, validated_data):
+        return get_cart_store().set_item(instance.cart_id,instance.product_id,validated_data['quantity'])
+
     class Meta:
         model = CartItem
         fields = ['quantity']    
     
 
-class CartSerializer(serializers.ModelSerializer):
+class CartSerializer(SparseFieldsMixin,CompiledRepresentationMixin,serializers.ModelSerializer):
     id = serializers.UUIDField(read_only=True)
     items = CartItemSerializer(many=True,read_only=True)
     total_price = serializers.SerializerMethodField(method_name='get_total_price')
+    item_count = serializers.SerializerMethodField()
+    def get_item_count(self,cart:Cart):
+        return sum(item.quantity for item in cart.items.all())
+
     def get_total_price(self,cart:Cart):
         # With List Comprehension
-         return sum([item.quantity*item.product.unit_price for item in cart.items.all()])
+         return sum([item.quantity*item.product.effective_price for item in cart.items.all()])
         # With For Loop
         # for item in cart.items.all():
         #     return sum(item.product.unit_price * item.quantity)
 
     class Meta:
         model = Cart
-        fields = ['id','items','total_price']
+        fields = ['id','items','item_count','total_price']
         
     # total_price = serializers.SerializerMethodField(method_name='calculate_total_price')
     # def calculate_total_price(self):
     #     return sum(CartItemSerializer.total_price[:-1])
 
+# ?summary=1, totals computed by the cart store without the items
+class CartSummarySerializer(serializers.Serializer):
+    id = serializers.UUIDField(read_only=True)
+    item_count = serializers.IntegerField(read_only=True)
+    total_price = serializers.DecimalField(max_digits=12,decimal_places=2,read_only=True)
+
 class CustomerSerializer(serializers.ModelSerializer):
     user_id = serializers.IntegerField(read_only=True)
     class Meta:
         model = Customer
         fields = ['user_id','phone','birth_date','membership']
 
-class OrderItemSerializer(serializers.ModelSerializer):
+class OrderItemSerializer(CompiledRepresentationMixin,serializers.ModelSerializer):
     product = SimpleProductSerializer()
     class Meta:
         model = OrderItem
         fields = ['id','product','unit_price','quantity']
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(SparseFieldsMixin,CompiledRepresentationMixin,serializers.ModelSerializer):
     items = OrderItemSerializer(many=True)
     customer_id = serializers.IntegerField()
     placed_at = serializers.DateTimeField()
     class Meta:
         model = Order
         fields = ['id','customer_id','placed_at','payment_status','items']
+        sparse_prefetch = {'items':['items__product']}
+
+# Order history lists, read from OrderSummary without the items
+class OrderSummarySerializer(SparseFieldsMixin,serializers.ModelSerializer):
+    id = serializers.IntegerField(source='order_id',read_only=True)
+    customer_id = serializers.IntegerField(read_only=True)
+    class Meta:
+        model = OrderSummary
+        fields = ['id','customer_id','placed_at','payment_status','item_count','total_amount']
 
 class CreateOrderSerializer(serializers.Serializer):
     # get cart id and create order with that cart id
@@ -157,37 +250,104 @@ class CreateOrderSerializer(serializers.Serializer):
     # After creating ordertems delete the cart
     cart_id = serializers.UUIDField()
     def validate_cart_id(self,cart_id):
-        if not Cart.objects.filter(pk=cart_id).exists():
+        # The cart may only be in the cart store so far
+        summary = get_cart_store().get_summary(cart_id)
+        if summary is None:
             raise serializers.ValidationError('No cart with this id exists')
-        if CartItem.objects.filter(cart_id=cart_id).count()==0:
+        if summary['item_count']==0:
             raise serializers.ValidationError('Cart is Empty')
         return cart_id
 
     def save(self, **kwargs):
+        # pop() freezes the cart: a concurrent checkout of the same cart
+        # gets nothing, and an item added afterwards finds no cart
+        # instead of going missing from the order
+        cart_id = self.validated_data['cart_id']
+        store = get_cart_store()
+        items = store.pop(cart_id)
+        if items is None:
+            raise serializers.ValidationError({'cart_id':'Cart is empty or was already checked out'})
+        try:
+            return self.place(cart_id,items)
+        except Exception:
+            # The cart comes back as it was
+            store.restore(cart_id,items)
+            raise
+
+    def place(self, cart_id, items):
         # If at any point our one or more queries throw exceptions
         # then our database will not updated, its only update when 
         # all querires run jus because of transaction.atomic
         with transaction.atomic():
-            cart_id = self.validated_data['cart_id']
-            customer = Customer.objects.get(user_id=self.context['user_id'])
-            order = Order.objects.create(customer=customer)
-
-            cart_items = CartItem.objects.select_related('product').filter(cart_id=cart_id)
+            customer_id = self.context.get('customer_id') or \
+                Customer.objects.values_list('id',flat=True).get(user_id=self.context['user_id'])
+            order = Order.objects.create(customer_id=customer_id)
 
+            # Orders are charged the effective price (store.models.ProductPrice),
+            # items of products deleted since are dropped like in the cart
+            products = Product.objects.select_related('price').in_bulk(list(items))
             order_items = [
                 OrderItem(
                 order = order,
-                product = item.product,
-                unit_price = item.product.unit_price,
-                quantity = item.quantity
+                product = products[product_id],
+                unit_price = products[product_id].effective_price,
+                quantity = quantity
 
-                ) for item in cart_items
+                ) for product_id,quantity in items.items() if product_id in products
             ]
+            if not order_items:
+                raise serializers.ValidationError({'cart_id':'Cart is empty or was already checked out'})
             OrderItem.objects.bulk_create(order_items)
-            Cart.objects.filter(id = cart_id).delete()
+            # Takes the stock, rolls the whole order back when it is short
+            try:
+                reserve(order,{item.product_id:item.quantity for item in order_items})
+            except InsufficientStock as error:
+                raise serializers.ValidationError({'cart_id':str(error)})
+            OrderSummary.objects.create(
+                order=order,
+                customer_id=customer_id,
+                placed_at=order.placed_at,
+                payment_status=order.payment_status,
+                item_count=sum(item.quantity for item in order_items),
+                total_amount=sum((item.unit_price*item.quantity for item in order_items),Decimal(0)))
             return order
         
+# Sales rollups (store/rollups.py)
+class DailyProductSalesSerializer(serializers.ModelSerializer):
+    product_id = serializers.IntegerField()
+    class Meta:
+        model = DailyProductSales
+        fields = ['date','product_id','orders_count','quantity','revenue']
+
+class DailyCollectionSalesSerializer(serializers.ModelSerializer):
+    collection_id = serializers.IntegerField()
+    class Meta:
+        model = DailyCollectionSales
+        fields = ['date','collection_id','orders_count','quantity','revenue']
+
+class MonthlyCustomerSalesSerializer(serializers.ModelSerializer):
+    customer_id = serializers.IntegerField()
+    class Meta:
+        model = MonthlyCustomerSales
+        fields = ['month','customer_id','orders_count','quantity','revenue']
+
+# Status of a queued checkout (store/checkout.py)
+class CheckoutJobSerializer(serializers.ModelSerializer):
+    order_id = serializers.IntegerField(read_only=True)
+    class Meta:
+        model = CheckoutJob
+        fields = ['id','status','order_id','error','created_at','finished_at']
+
 class UpdateOrderSerializer(serializers.ModelSerializer):
+    # Paid orders keep their reserved stock, failed ones give it back
+    def update(self, instance, validated_data):
+        with transaction.atomic():
+            order = super().update(instance,validated_data)
+            settle(order)
+            # updated_at is what the sales rollups pick changes up by
+            OrderSummary.objects.filter(order=order).update(payment_status=order.payment_status,updated_at=timezone.now())
+        return order
+
     class Meta:
         model = Order
         fields = ['payment_status']
\ No newline at end of file
@@ -1,7 +1,18 @@
-from .models import Customer
+from .models import CatalogChange, Collection, Customer, Product, ProductImage, ProductPrice, Promotion
+from .cache import bump_catalog_version
+from .changes import log_changes
+from .search import product_index
+from .bitmaps import tag_index
+from .imaging import schedule_variants
+from core.authentication import forget_claims
+from tags.models import Tag, TaggedItem
+from functools import wraps
 from django.conf import settings
+from django.db import transaction
 from django.dispatch import receiver
-from django.db.models.signals import post_save
+from django.utils import timezone
+from django.db.models import F
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
 '''
 Ham har user ke create hone ke bad user create hamain signal send karta
 phir ham us signal ko sunte hain or true hone par
@@ -9,7 +20,246 @@ new customer us user ke name se bna dete hain
 Signals diferrent taarike ke hote hain
 Signals file ko apps.py file main add karna lazmi ha
 '''
+# Raw saves (loaddata, import_products) write rows as they are and do
+# the work of the product receivers in bulk themselves
+def skip_raw(handler):
+    @wraps(handler)
+    def wrapper(sender,**kwargs):
+        if kwargs.get('raw'):
+            return
+        return handler(sender,**kwargs)
+    return wrapper
+
 @receiver(post_save,sender = settings.AUTH_USER_MODEL)
 def create_customer_for_each_user(sender,**kwargs):
     if kwargs['created']:
-        Customer.objects.create(user=kwargs['instance'])
\ No newline at end of file
+        Customer.objects.create(user=kwargs['instance'])
+
+# membership is one of the cached token claims (core.authentication)
+@receiver(post_save,sender=Customer)
+def refresh_customer_claims(sender,instance,**kwargs):
+    forget_claims(instance.user_id)
+
+'''
+Any catalog write makes the cached product responses stale.
+The version is bumped after commit, otherwise a request running
+between the bump and the commit could cache the old rows under
+the new version
+'''
+@receiver(post_save,sender=Product)
+@receiver(post_delete,sender=Product)
+@receiver(post_save,sender=ProductImage)
+@receiver(post_delete,sender=ProductImage)
+@receiver(post_save,sender=Collection)
+@receiver(post_delete,sender=Collection)
+@skip_raw
+def invalidate_catalog(sender,**kwargs):
+    transaction.on_commit(bump_catalog_version)
+
+'''
+Tags are part of the product response too. Renaming a tag touches
+every product that carries it
+'''
+@receiver(post_save,sender=TaggedItem)
+@receiver(post_delete,sender=TaggedItem)
+def touch_tagged_product(sender,instance,**kwargs):
+    if instance.content_type.model_class() is Product:
+        Product.objects.filter(pk=instance.object_id).update(last_update=timezone.now())
+        transaction.on_commit(bump_catalog_version)
+
+@receiver(post_save,sender=Tag)
+def touch_tag_products(sender,instance,created,**kwargs):
+    if created:
+        return
+    product_ids = TaggedItem.objects.filter(tag=instance,content_type__model='product',content_type__app_label='store') \
+        .values('object_id')
+    Product.objects.filter(pk__in=product_ids).update(last_update=timezone.now())
+    transaction.on_commit(bump_catalog_version)
+
+@receiver(m2m_changed,sender=Product.promotions.through)
+def invalidate_catalog_promotions(sender,**kwargs):
+    if kwargs['action'] in ['post_add','post_remove','post_clear']:
+        transaction.on_commit(bump_catalog_version)
+
+
+'''
+Keep this process' search index in sync, other processes catch up
+from the change log when the catalog version moves (see
+store/changes.py)
+'''
+@receiver(post_save,sender=Product)
+@receiver(post_delete,sender=Product)
+@skip_raw
+def log_product_change(sender,instance,**kwargs):
+    log_changes(CatalogChange.KIND_PRODUCT,[instance.pk])
+
+# The tag bitmaps re-read a product's tags and a tag's label
+@receiver(post_save,sender=TaggedItem)
+@receiver(post_delete,sender=TaggedItem)
+def log_tagged_product(sender,instance,**kwargs):
+    if instance.content_type.model_class() is Product:
+        log_changes(CatalogChange.KIND_PRODUCT,[instance.object_id])
+
+@receiver(post_save,sender=Tag)
+@receiver(post_delete,sender=Tag)
+def log_tag_change(sender,instance,**kwargs):
+    log_changes(CatalogChange.KIND_TAG,[instance.pk])
+
+@receiver(post_save,sender=Product)
+@skip_raw
+def index_product(sender,instance,**kwargs):
+    if product_index.is_built:
+        product_id,title,description = instance.pk,instance.title,instance.description
+        transaction.on_commit(lambda: product_index.add(product_id,title,description))
+
+@receiver(post_delete,sender=Product)
+def unindex_product(sender,instance,**kwargs):
+    if product_index.is_built:
+        product_id = instance.pk
+        transaction.on_commit(lambda: product_index.remove(product_id))
+
+
+'''
+Same for the tag and collection bitmaps (see store/bitmaps.py)
+'''
+@receiver(post_save,sender=Product)
+@skip_raw
+def index_product_bitmaps(sender,instance,**kwargs):
+    if tag_index.is_built:
+        product_id,collection_id = instance.pk,instance.collection_id
+        previous = getattr(instance,'_previous_collection_id',None)
+        transaction.on_commit(lambda: tag_index.add_product(product_id,collection_id,previous))
+
+@receiver(post_delete,sender=Product)
+def unindex_product_bitmaps(sender,instance,**kwargs):
+    if tag_index.is_built:
+        product_id,collection_id = instance.pk,instance.collection_id
+        transaction.on_commit(lambda: tag_index.remove_product(product_id,collection_id))
+
+@receiver(post_save,sender=TaggedItem)
+def index_tagged_item(sender,instance,**kwargs):
+    if tag_index.is_built and instance.content_type.model_class() is Product:
+        tag_id,product_id = instance.tag_id,instance.object_id
+        transaction.on_commit(lambda: tag_index.tag_product(tag_id,product_id))
+
+@receiver(post_delete,sender=TaggedItem)
+def unindex_tagged_item(sender,instance,**kwargs):
+    if tag_index.is_built and instance.content_type.model_class() is Product:
+        tag_id,product_id = instance.tag_id,instance.object_id
+        transaction.on_commit(lambda: tag_index.untag_product(tag_id,product_id))
+
+@receiver(post_save,sender=Tag)
+def index_tag(sender,instance,**kwargs):
+    if tag_index.is_built:
+        tag_id,label = instance.pk,instance.label
+        transaction.on_commit(lambda: tag_index.set_tag(tag_id,label))
+
+@receiver(post_delete,sender=Tag)
+def unindex_tag(sender,instance,**kwargs):
+    if tag_index.is_built:
+        tag_id = instance.pk
+        transaction.on_commit(lambda: tag_index.remove_tag(tag_id))
+
+
+'''
+Product images are part of the product response, so a change to them
+has to move Product.last_update (the ETag / Last-Modified source)
+'''
+@receiver(post_save,sender=ProductImage)
+@receiver(post_delete,sender=ProductImage)
+def touch_product(sender,instance,**kwargs):
+    Product.objects.filter(pk=instance.product_id).update(last_update=timezone.now())
+
+
+'''
+Variants are rendered after commit in the background, the upload
+request does not wait for them
+'''
+@receiver(post_save,sender=ProductImage)
+def render_image_variants(sender,instance,update_fields=None,**kwargs):
+    if update_fields is not None and 'image' not in update_fields:
+        return
+    if instance.image:
+        image_id = instance.pk
+        transaction.on_commit(lambda: schedule_variants(image_id))
+
+
+'''
+Collection.products_count is a stored counter, every product insert,
+delete or move between collections adjusts it with an F() update in
+the same transaction as the product write
+'''
+def change_products_count(collection_id,delta):
+    Collection.objects.filter(pk=collection_id).update(
+        products_count=F('products_count')+delta,
+        last_update=timezone.now())
+
+@receiver(pre_save,sender=Product)
+@skip_raw
+def remember_collection(sender,instance,**kwargs):
+    instance._previous_collection_id = None
+    if instance.pk is not None:
+        instance._previous_collection_id = Product.objects \
+            .filter(pk=instance.pk).values_list('collection_id',flat=True).first()
+
+@receiver(post_save,sender=Product)
+@skip_raw
+def count_saved_product(sender,instance,created,**kwargs):
+    previous = getattr(instance,'_previous_collection_id',None)
+    if created or previous is None:
+        change_products_count(instance.collection_id,1)
+    elif previous != instance.collection_id:
+        change_products_count(previous,-1)
+        change_products_count(instance.collection_id,1)
+
+@receiver(post_delete,sender=Product)
+def count_deleted_product(sender,instance,**kwargs):
+    change_products_count(instance.collection_id,-1)
+
+
+'''
+ProductPrice rows are recomputed in the same transaction as the write
+that changes them: a product's own price, its promotions, or the
+discount of a promotion (for every product that has it)
+'''
+def reprice(products):
+    ProductPrice.objects.recompute(products)
+    # Prices are part of the product responses (ETags and cache)
+    products.update(last_update=timezone.now())
+    transaction.on_commit(bump_catalog_version)
+
+@receiver(post_save,sender=Product)
+@skip_raw
+def price_saved_product(sender,instance,**kwargs):
+    ProductPrice.objects.recompute(Product.objects.filter(pk=instance.pk))
+
+@receiver(post_save,sender=Promotion)
+def price_saved_promotion(sender,instance,created,**kwargs):
+    if not created:
+        reprice(Product.objects.filter(promotions=instance))
+
+@receiver(pre_delete,sender=Promotion)
+def remember_promoted_products(sender,instance,**kwargs):
+    instance._promoted_product_ids = list(instance.product_set.values_list('id',flat=True))
+
+@receiver(post_delete,sender=Promotion)
+def price_deleted_promotion(sender,instance,**kwargs):
+    product_ids = getattr(instance,'_promoted_product_ids',[])
+    if product_ids:
+        reprice(Product.objects.filter(id__in=product_ids))
+
+@receiver(m2m_changed,sender=Product.promotions.through)
+def price_changed_promotions(sender,instance,action,reverse,pk_set,**kwargs):
+    # reverse: promotion.product_set.add(...), pk_set holds product ids
+    if action == 'pre_clear' and reverse:
+        instance._cleared_product_ids = list(instance.product_set.values_list('id',flat=True))
+    if action not in ['post_add','post_remove','post_clear']:
+        return
+    if not reverse:
+        product_ids = [instance.pk]
+    elif action == 'post_clear':
+        product_ids = getattr(instance,'_cleared_product_ids',[])
+    else:
+        product_ids = pk_set
+    if product_ids:
+        reprice(Product.objects.filter(id__in=product_ids))
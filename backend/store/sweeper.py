@@ -0,0 +1,98 @@
+import logging
+import threading
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from store.cache import get_cache, is_shared_cache
+from store.carts import get_cart_store
+from store.models import Cart
+
+'''
+Abandoned cart sweeper
+Deletes carts idle for longer than STORE_CART_TTL seconds, oldest
+first, in small batches read from the updated_at index. Every batch is
+its own short transaction so checkout is never kept waiting on its
+locks. The batch size adapts to how long the last batch took (aiming
+at target_seconds), and after each batch the sweeper sleeps in
+proportion to that time, so a loaded database gets longer breaks.
+'''
+logger = logging.getLogger(__name__)
+
+SWEEP_LOCK_KEY = 'carts:sweep:lock'
+
+
+def sweep_carts(ttl=None, batch_size=500, min_batch_size=50, max_batch_size=5000,
+                target_seconds=0.2, pause_factor=1.0, max_batches=None, log=None):
+    ttl = ttl if ttl is not None else getattr(settings, 'STORE_CART_TTL', 30 * 24 * 60 * 60)
+    cutoff = timezone.now() - timedelta(seconds=ttl)
+    store = get_cart_store()
+    stats = {'carts': 0, 'batches': 0, 'seconds': 0.0}
+    start = time.perf_counter()
+    while max_batches is None or stats['batches'] < max_batches:
+        batch_start = time.perf_counter()
+        ids = list(Cart.objects.filter(updated_at__lt=cutoff)
+                   .order_by('updated_at').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            break
+        with transaction.atomic():
+            # updated_at is checked again, a cart used in the meantime stays
+            deleted, per_model = Cart.objects.filter(id__in=ids, updated_at__lt=cutoff).delete()
+        store.discard(ids)
+        elapsed = time.perf_counter() - batch_start
+
+        stats['carts'] += per_model.get(Cart._meta.label, 0)
+        stats['batches'] += 1
+        if log:
+            log(f"batch {stats['batches']}: {len(ids)} carts in {elapsed * 1000:.0f}ms (batch size {batch_size})")
+
+        if len(ids) < batch_size:
+            # That was the tail
+            break
+        if elapsed > target_seconds:
+            batch_size = max(min_batch_size, batch_size // 2)
+        elif elapsed < target_seconds / 2:
+            batch_size = min(max_batch_size, batch_size * 3 // 2)
+        time.sleep(elapsed * pause_factor)
+    stats['seconds'] = time.perf_counter() - start
+    stats['rate'] = stats['carts'] / stats['seconds'] if stats['seconds'] else 0
+    return stats
+
+
+_scheduler = None
+
+
+def run_scheduler(interval):
+    while True:
+        time.sleep(interval)
+        # One process sweeps per interval
+        if not get_cache().add(SWEEP_LOCK_KEY, 1, interval):
+            continue
+        try:
+            stats = sweep_carts()
+            if stats['carts']:
+                logger.info('Swept %s carts (%.0f carts/s)', stats['carts'], stats['rate'])
+        except Exception:
+            logger.exception('Sweeping carts failed')
+        finally:
+            close_old_connections()
+
+
+def start_scheduler():
+    '''
+    Runs the sweeper every STORE_CART_SWEEP_INTERVAL seconds in a
+    background thread, nothing when the setting is None. The lock that
+    lets one process sweep per interval is a cache entry, so this needs
+    a shared cache, otherwise every process would sweep
+    '''
+    global _scheduler
+    interval = getattr(settings, 'STORE_CART_SWEEP_INTERVAL', None)
+    if not interval or _scheduler is not None:
+        return
+    if not is_shared_cache(get_cache()):
+        logger.warning('STORE_CART_SWEEP_INTERVAL needs a shared cache, run manage.py sweep_carts from cron instead')
+        return
+    _scheduler = threading.Thread(target=run_scheduler, args=(interval,), name='cart-sweeper', daemon=True)
+    _scheduler.start()
@@ -1,3 +1,942 @@
-from django.test import TestCase
+import json
+import os
+import random
+import shutil
+import tempfile
+from datetime import timedelta
+from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest import mock
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import DatabaseError, connection, transaction
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIClient
+from PIL import Image
 
-# Create your tests here.
+from store.bitmaps import IdSet, TagBitmapIndex
+from store.cache import get_catalog_version
+from store.carts import CachedCartStore, DatabaseCartStore, MAX_QUANTITY, get_cart_store
+from store.changes import ChangeReader, log_changes
+from store.checkout import enqueue, place_batch
+from store.exports import iter_order_records
+from store.filecache import LocalCartCache
+from store.imaging import generate_variants
+from store.inventory import InsufficientStock, reserve, settle
+from store.models import (Cart, CartItem, CatalogChange, CheckoutJob, Collection, Customer, DailyCollectionSales,
+                          DailyProductSales, InventoryReservation, InventoryShard, MonthlyCustomerSales, Order,
+                          OrderItem, OrderSummary, Product, ProductImage, ProductPrice, Promotion)
+from store.rollups import update_rollups
+from store.search import ProductSearchIndex
+from store.serializers import CartItemSerializer, CartSerializer, OrderSerializer, ProductSerializer
+from store.sweeper import sweep_carts
+from tags.models import Tag, TaggedItem
+
+
+# Cart rows are written as the requests go, CartStoreTests covers the cached store
+@override_settings(STORE_CART_BACKEND='store.carts.DatabaseCartStore')
+class CatalogTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.beauty = Collection.objects.create(title='Beauty')
+        cls.toys = Collection.objects.create(title='Toys')
+        cls.products = [
+            Product.objects.create(
+                title=f'Product {i} {"blue widget" if i % 2 else "red gadget"}', slug=f'product-{i}',
+                description=f'Description {i}', unit_price=10 + i, inventory=100,
+                collection=cls.toys if i % 3 == 0 else cls.beauty)
+            for i in range(6)]
+        cls.user = get_user_model().objects.create_user(username='buyer', password='secret', email='buyer@example.com')
+        cls.customer = Customer.objects.get(user=cls.user)
+
+    def setUp(self):
+        # Catalog versions, cached responses and claims outlive a test
+        cache.clear()
+
+    def make_cart(self, items):
+        cart = Cart.objects.create()
+        CartItem.objects.bulk_create([CartItem(cart=cart, product=product, quantity=quantity)
+                                      for product, quantity in items])
+        return cart
+
+    def make_order(self, items, payment_status=Order.PAYMENT_STATUS_PENDING):
+        order = Order.objects.create(customer=self.customer, payment_status=payment_status)
+        OrderItem.objects.bulk_create([OrderItem(order=order, product=product, quantity=quantity,
+                                                 unit_price=product.unit_price)
+                                       for product, quantity in items])
+        return order
+
+
+class CompiledSerializerTests(CatalogTestCase):
+    '''
+    The compiled read path (store/compiled.py) renders what DRF renders
+    '''
+    def setUp(self):
+        super().setUp()
+        promotion = Promotion.objects.create(description='Sale', discount=50)
+        self.products[1].promotions.add(promotion)
+        tag = Tag.objects.create(label='sale')
+        TaggedItem.objects.create(tag=tag, content_type=ContentType.objects.get_for_model(Product),
+                                  object_id=self.products[1].id)
+        self.context = {'request': Request(RequestFactory().get('/store/products/'))}
+
+    def assertSameOutput(self, serializer_class, rows):
+        with override_settings(STORE_COMPILED_SERIALIZERS=False):
+            expected = serializer_class(rows, many=True, context=self.context).data
+        with override_settings(STORE_COMPILED_SERIALIZERS=True):
+            actual = serializer_class(rows, many=True, context=self.context).data
+        self.assertTrue(expected)
+        self.assertEqual(actual, expected)
+
+    def test_product(self):
+        self.assertSameOutput(ProductSerializer, list(Product.objects.select_related('price').prefetch_related('images')))
+
+    def test_cart(self):
+        self.make_cart([(self.products[0], 2), (self.products[1], 1)])
+        self.make_cart([])
+        self.assertSameOutput(CartSerializer, list(Cart.objects.prefetch_related('items__product__price')))
+
+    def test_cart_item(self):
+        self.make_cart([(self.products[0], 2), (self.products[1], 3)])
+        self.assertSameOutput(CartItemSerializer, list(CartItem.objects.select_related('product__price')))
+
+    def test_order(self):
+        self.make_order([(self.products[0], 2), (self.products[2], 1)])
+        self.assertSameOutput(OrderSerializer, list(Order.objects.prefetch_related('items__product')))
+
+
+class CatalogCacheTests(CatalogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+
+    def rename(self, product, title):
+        product.title = title
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+
+    def test_list_is_cached_until_the_catalog_changes(self):
+        self.assertEqual(self.client.get('/store/products/?collection_id=1&ordering=unit_price')['X-Cache'], 'MISS')
+        # Same parameters in another order share the entry
+        response = self.client.get('/store/products/?ordering=unit_price&collection_id=1')
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.rename(self.products[0], 'Renamed')
+        response = self.client.get('/store/products/?collection_id=1&ordering=unit_price')
+        self.assertEqual(response['X-Cache'], 'MISS')
+
+    def test_detail_shows_the_change(self):
+        url = f'/store/products/{self.products[0].id}/'
+        self.assertEqual(self.client.get(url).json()['title'], self.products[0].title)
+        self.assertEqual(self.client.get(url)['X-Cache'], 'HIT')
+        self.rename(Product.objects.get(pk=self.products[0].pk), 'Renamed')
+        response = self.client.get(url)
+        self.assertEqual((response['X-Cache'], response.json()['title']), ('MISS', 'Renamed'))
+
+
+class KeysetPaginationTests(CatalogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        # Ties on unit_price, the pk breaks them
+        Product.objects.bulk_create([
+            Product(title=f'Extra {i}', slug=f'extra-{i}', unit_price=10 + i % 4, inventory=1, collection=self.beauty)
+            for i in range(19)])
+
+    def walk(self, url):
+        ids = []
+        pages = []
+        while url:
+            data = self.client.get(url).json()
+            self.assertNotIn('count', data)
+            ids.extend(product['id'] for product in data['results'])
+            pages.append(data)
+            url = data['next']
+        return ids, pages
+
+    def test_pages_cover_every_row_once(self):
+        ids, pages = self.walk('/store/products/?pagination=cursor&ordering=-unit_price')
+        expected = list(Product.objects.order_by('-unit_price', '-pk').values_list('id', flat=True))
+        self.assertEqual(ids, expected)
+        self.assertEqual(len(pages), 3)
+        # And back from the last page
+        previous = self.client.get(pages[-1]['previous']).json()
+        self.assertEqual([product['id'] for product in previous['results']], expected[10:20])
+
+    def test_cursor_is_bound_to_its_ordering(self):
+        first = self.client.get('/store/products/?pagination=cursor&ordering=title').json()
+        url = first['next'].replace('ordering=title', 'ordering=unit_price')
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertEqual(self.client.get('/store/products/?pagination=cursor&cursor=garbage').status_code, 404)
+
+
+class CatalogChangeTests(CatalogTestCase):
+    def test_reader_asks_for_holes_again(self):
+        reader = ChangeReader()
+        reader.start()
+        reader.read()
+        CatalogChange.objects.create(kind=CatalogChange.KIND_PRODUCT, object_id=1)
+        hole = CatalogChange.objects.create(kind=CatalogChange.KIND_PRODUCT, object_id=2)
+        CatalogChange.objects.create(kind=CatalogChange.KIND_PRODUCT, object_id=3)
+        hole_id = hole.id
+        # Not committed yet, as far as the reader can tell
+        hole.delete()
+        self.assertEqual(reader.read(), {CatalogChange.KIND_PRODUCT: {1, 3}})
+        CatalogChange.objects.create(id=hole_id, kind=CatalogChange.KIND_PRODUCT, object_id=2)
+        self.assertEqual(reader.read(), {CatalogChange.KIND_PRODUCT: {2}})
+        self.assertEqual(reader.read(), {})
+
+    def test_index_catches_up(self):
+        index = ProductSearchIndex()
+        index.build_from_database()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products[1].title = 'Product 1 shiny widget'
+            self.products[1].save()
+            Product.objects.filter(pk=self.products[3].pk).delete()
+        index.refresh()
+        self.assertEqual(index.search('shiny'), [self.products[1].id])
+        self.assertNotIn(self.products[3].id, index.search('widget'))
+
+    @override_settings(STORE_CATALOG_CHANGE_POLL_INTERVAL=0)
+    def test_index_polls_without_a_shared_version(self):
+        index = ProductSearchIndex()
+        index.build_from_database()
+        # Another process: no signals here and its version bump is in its
+        # own LocMemCache
+        Product.objects.filter(pk=self.products[0].pk).update(title='Polished gadget')
+        log_changes(CatalogChange.KIND_PRODUCT, [self.products[0].id])
+        index.refresh()
+        self.assertEqual(index.search('polished'), [self.products[0].id])
+
+    def test_tag_bitmaps_catch_up(self):
+        index = TagBitmapIndex()
+        index.build_from_database()
+        with self.captureOnCommitCallbacks(execute=True):
+            tag = Tag.objects.create(label='eco')
+            TaggedItem.objects.create(tag=tag, content_type=ContentType.objects.get_for_model(Product),
+                                      object_id=self.products[2].id)
+            Product.objects.filter(pk=self.products[3].pk).delete()
+        index.refresh()
+        self.assertEqual(list(index.query(all_tags=['eco'])), [self.products[2].id])
+        self.assertNotIn(self.products[3].id, index.products)
+
+    @override_settings(STORE_CATALOG_CHANGE_POLL_INTERVAL=0)
+    def test_tag_bitmaps_poll_without_a_shared_version(self):
+        index = TagBitmapIndex()
+        index.build_from_database()
+        tag = Tag.objects.create(label='eco')
+        # Written by another process, only the change log tells
+        TaggedItem.objects.bulk_create([TaggedItem(tag=tag, content_type=ContentType.objects.get_for_model(Product),
+                                                   object_id=self.products[4].id)])
+        log_changes(CatalogChange.KIND_TAG, [tag.id])
+        log_changes(CatalogChange.KIND_PRODUCT, [self.products[4].id])
+        index.refresh()
+        self.assertEqual(list(index.query(all_tags=['eco'])), [self.products[4].id])
+
+
+class ProductSearchTests(CatalogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+
+    def test_pages_through_every_match(self):
+        first = self.client.get('/store/products/?search=widget').json()
+        self.assertEqual(first['count'], 3)
+        self.assertEqual([product['id'] for product in first['results']], [self.products[i].id for i in (1, 3, 5)])
+        filtered = self.client.get(f'/store/products/?search=widget&collection_id={self.toys.id}').json()
+        self.assertEqual([product['id'] for product in filtered['results']], [self.products[3].id])
+
+    @override_settings(STORE_SEARCH_MAX_RESULTS=2)
+    def test_results_are_capped(self):
+        self.assertEqual(self.client.get('/store/products/?search=widget').json()['count'], 2)
+        # The filter is checked past the first slice of the ranking
+        filtered = self.client.get(f'/store/products/?search=widget&collection_id={self.beauty.id}').json()
+        self.assertEqual([product['id'] for product in filtered['results']], [self.products[1].id, self.products[5].id])
+
+
+class ConditionalGetTests(CatalogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+
+    def test_unchanged_product_answers_304(self):
+        url = f'/store/products/{self.products[0].id}/'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Last-Modified', response)
+        again = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual((again.status_code, again.content), (304, b''))
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.get(pk=self.products[0].pk).save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+    def test_list_etag_follows_deletes(self):
+        etag = self.client.get('/store/collections/')['ETag']
+        self.assertEqual(self.client.get('/store/collections/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # A delete does not move max(last_update), the count does
+        Product.objects.filter(collection=self.toys).delete()
+        Collection.objects.filter(pk=self.toys.pk).delete()
+        self.assertEqual(self.client.get('/store/collections/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_cart_changes_the_etag(self):
+        cart = self.make_cart([(self.products[0], 1)])
+        url = f'/store/carts/{cart.id}/'
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.client.post(f'{url}items/', {'product_id': self.products[1].id, 'quantity': 1})
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class CollectionCountTests(CatalogTestCase):
+    def counts(self):
+        return dict(Collection.objects.values_list('id', 'products_count'))
+
+    def test_counts_follow_product_writes(self):
+        self.assertEqual(self.counts(), {self.beauty.id: 4, self.toys.id: 2})
+        product = Product.objects.create(title='New', slug='new', unit_price=1, inventory=1, collection=self.toys)
+        moved = Product.objects.get(pk=self.products[1].pk)
+        moved.collection = self.toys
+        moved.save()
+        self.assertEqual(self.counts(), {self.beauty.id: 3, self.toys.id: 4})
+        product.delete()
+        self.assertEqual(self.counts(), {self.beauty.id: 3, self.toys.id: 3})
+        response = APIClient().get(f'/store/collections/{self.toys.id}/')
+        self.assertEqual(response.json()['products_count'], 3)
+
+    def test_reconcile_fixes_drift(self):
+        # bulk writes skip the signals
+        Product.objects.filter(pk=self.products[1].pk).update(collection=self.toys)
+        self.assertEqual(Collection.objects.reconcile_products_count(), 2)
+        self.assertEqual(self.counts(), {self.beauty.id: 3, self.toys.id: 3})
+        self.assertEqual(Collection.objects.reconcile_products_count(), 0)
+
+
+class SparseFieldsetTests(CatalogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+
+    def get(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        return response.json(), [query['sql'] for query in queries]
+
+    def test_fields_trim_the_response_and_the_queries(self):
+        full, full_queries = self.get('/store/products/')
+        sparse, sparse_queries = self.get('/store/products/?fields=id,title')
+        self.assertEqual(set(sparse['results'][0]), {'id', 'title'})
+        self.assertEqual([product['title'] for product in sparse['results']],
+                         [product['title'] for product in full['results']])
+        self.assertLess(len(sparse_queries), len(full_queries))
+        self.assertFalse(any('store_productimage' in sql for sql in sparse_queries))
+
+    def test_expand_adds_relations(self):
+        data, _ = self.get(f'/store/products/{self.products[0].id}/?fields=id&expand=images')
+        self.assertEqual(data, {'id': self.products[0].id, 'images': []})
+
+
+class CatalogImportTests(CatalogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.promotion = Promotion.objects.create(description='Summer', discount=10)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'products.jsonl')
+
+    def write(self, records):
+        with open(self.path, 'w') as file:
+            for record in records:
+                file.write(json.dumps(record) + '\n')
+
+    def test_import_creates_and_updates(self):
+        self.write([
+            {'id': self.products[0].id, 'title': 'Updated', 'unit_price': '15', 'inventory': 5,
+             'collection': 'Beauty', 'promotions': [self.promotion.id]},
+            {'title': 'New one', 'unit_price': '5', 'inventory': 10, 'collection': 'Toys', 'promotions': []},
+            {'title': '', 'unit_price': '0', 'inventory': 10, 'collection': 'Nowhere'},
+        ])
+        call_command('import_products', self.path, '--chunk-size', '2', stdout=StringIO())
+        updated = Product.objects.get(pk=self.products[0].pk)
+        self.assertEqual((updated.title, updated.collection_id), ('Updated', self.beauty.id))
+        self.assertEqual(ProductPrice.objects.get(product=updated).discounted_price, Decimal('13.50'))
+        created = Product.objects.get(title='New one')
+        self.assertEqual(created.slug, 'new-one')
+        self.assertEqual(dict(Collection.objects.values_list('id', 'products_count')),
+                         {self.beauty.id: 5, self.toys.id: 2})
+        self.assertTrue(CatalogChange.objects.filter(object_id=created.id).exists())
+
+    def test_export_round_trip(self):
+        call_command('export_products', self.path, stderr=StringIO())
+        with open(self.path) as file:
+            records = [json.loads(line) for line in file]
+        self.assertEqual([record['id'] for record in records], sorted(product.id for product in self.products))
+        Product.objects.update(title='Changed')
+        call_command('import_products', self.path, stdout=StringIO())
+        self.assertEqual(sorted(Product.objects.values_list('title', flat=True)),
+                         sorted(product.title for product in self.products))
+
+    def test_raw_saves_skip_the_product_receivers(self):
+        changes = CatalogChange.objects.count()
+        product = Product(title='Raw', slug='raw', unit_price=1, inventory=1, collection=self.toys,
+                          last_update=timezone.now())
+        product.save_base(raw=True)
+        self.assertEqual(Collection.objects.get(pk=self.toys.pk).products_count, 2)
+        self.assertEqual(CatalogChange.objects.count(), changes)
+        self.assertFalse(ProductPrice.objects.filter(product=product).exists())
+
+
+class OrderExportTests(CatalogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.orders = [self.make_order([(self.products[0], 2), (self.products[1], 1)]),
+                       self.make_order([], payment_status=Order.PAYMENT_STATUS_COMPLETE),
+                       self.make_order([(self.products[2], 3)])]
+        self.client = APIClient()
+
+    def test_records_match_the_serializer(self):
+        expected = json.loads(JSONRenderer().render(OrderSerializer(
+            Order.objects.order_by('id').prefetch_related('items__product'), many=True).data))
+        # Two queries per batch of orders, one for the empty last page
+        with self.assertNumQueries(5):
+            records = json.loads(JSONRenderer().render(list(iter_order_records(Order.objects.all(), chunk_size=2))))
+        self.assertEqual(records, expected)
+
+    def test_staff_stream(self):
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.client.get('/store/orders/export/').status_code, 403)
+        self.client.force_authenticate(get_user_model().objects.create_user(username='staff', is_staff=True))
+        response = self.client.get(f'/store/orders/export/?payment_status={Order.PAYMENT_STATUS_PENDING}')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines], [self.orders[0].id, self.orders[2].id])
+
+
+class ImageVariantTests(CatalogTestCase):
+    def setUp(self):
+        super().setUp()
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        overrides = override_settings(MEDIA_ROOT=media, STORE_IMAGE_PROCESSING='sync', STORE_IMAGE_WORKERS=1)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def upload(self, color):
+        output = BytesIO()
+        Image.new('RGB', (800, 400), color).save(output, 'PNG')
+        image = ProductImage(product=self.products[0])
+        image.image.save('photo.png', ContentFile(output.getvalue()), save=False)
+        with self.captureOnCommitCallbacks(execute=True):
+            image.save()
+        image.refresh_from_db()
+        return image
+
+    def test_upload_gets_its_variants(self):
+        image = self.upload('red')
+        self.assertEqual(set(image.variants), {'thumbnail', 'medium', 'medium_jpeg'})
+        with default_storage.open(image.variants['thumbnail']) as file:
+            self.assertEqual(Image.open(file).size, (160, 80))
+        # Same picture again: the files are shared, nothing is rendered
+        again = self.upload('red')
+        self.assertEqual(again.variants, image.variants)
+        self.assertEqual(generate_variants(again.id), 0)
+        self.assertNotEqual(self.upload('blue').variants, image.variants)
+
+
+@override_settings(STORE_PRICE_FACET_BUCKETS=[12, 14])
+class FacetTests(CatalogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+
+    def test_counts_follow_the_filters(self):
+        facets = self.client.get('/store/products/?facets=collection,price').json()['facets']
+        self.assertEqual(facets['collection'], [{'id': self.beauty.id, 'title': 'Beauty', 'count': 4},
+                                                {'id': self.toys.id, 'title': 'Toys', 'count': 2}])
+        self.assertEqual([bucket['count'] for bucket in facets['price']], [2, 2, 2])
+        self.assertEqual((facets['price'][1]['min'], facets['price'][2]['max']), (12, None))
+
+        facets = self.client.get('/store/products/?facets=price,collection&unit_price__gt=11&ordering=-unit_price').json()['facets']
+        self.assertEqual([collection['count'] for collection in facets['collection']], [3, 1])
+        self.assertEqual([bucket['count'] for bucket in facets['price']], [0, 2, 2])
+
+    def test_unknown_facet(self):
+        self.assertEqual(self.client.get('/store/products/?facets=color').status_code, 400)
+
+
+class ProductPriceTests(CatalogTestCase):
+    def price(self, product):
+        row = ProductPrice.objects.get(product=product)
+        return row.discounted_price, row.price_with_tax
+
+    def test_promotions_reprice_their_products(self):
+        product = self.products[1]
+        self.assertEqual(self.price(product), (Decimal('11.00'), Decimal('12.10')))
+        small = Promotion.objects.create(description='Small', discount=10)
+        big = Promotion.objects.create(description='Big', discount=50)
+        product.promotions.add(small, big)
+        # The best discount wins, tax stays on the list price
+        self.assertEqual(self.price(product), (Decimal('5.50'), Decimal('12.10')))
+        big.discount = 20
+        big.save()
+        self.assertEqual(self.price(product)[0], Decimal('8.80'))
+        big.delete()
+        self.assertEqual(self.price(product)[0], Decimal('9.90'))
+        product.promotions.remove(small)
+        self.assertEqual(self.price(product)[0], Decimal('11.00'))
+
+    def test_list_price_change(self):
+        product = Product.objects.get(pk=self.products[0].pk)
+        product.unit_price = Decimal('20')
+        product.save()
+        data = APIClient().get(f'/store/products/{product.id}/').json()
+        self.assertEqual((Decimal(str(data['discounted_price'])), Decimal(str(data['price_with_tax']))),
+                         (Decimal('20.00'), Decimal('22.00')))
+
+    def test_recompute_repairs_bulk_writes(self):
+        Product.objects.filter(pk=self.products[0].pk).update(unit_price=30)
+        self.assertEqual(ProductPrice.objects.recompute(Product.objects.filter(pk=self.products[0].pk)), 1)
+        self.assertEqual(self.price(self.products[0])[0], Decimal('30.00'))
+
+
+class CartStoreTests(CatalogTestCase):
+    def setUp(self):
+        super().setUp()
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        caches = dict(settings.CACHES, carts={'BACKEND': 'store.filecache.LocalCartCache', 'LOCATION': location})
+        cached = override_settings(CACHES=caches, STORE_CART_CACHE='carts', STORE_CART_FLUSH_INTERVAL=0,
+                                   STORE_CART_BACKEND='store.carts.CachedCartStore')
+        cached.enable()
+        self.addCleanup(cached.disable)
+        self.client = APIClient()
+
+    def check_store(self, store):
+        cart = store.create()
+        first = store.add_item(cart.id, self.products[0].id, 2)
+        self.assertEqual(store.add_item(cart.id, self.products[0].id, 1).id, first.id)
+        self.assertIsNone(store.set_item(cart.id, self.products[1].id, 5))
+        store.add_item(cart.id, self.products[1].id, 1)
+        self.assertEqual(store.set_item(cart.id, self.products[1].id, 5).quantity, 5)
+        store.add_item(cart.id, self.products[2].id, 1)
+        self.assertTrue(store.remove_item(cart.id, self.products[2].id))
+        self.assertEqual(store.get_item_by_id(cart.id, first.id).quantity, 3)
+        summary = store.get_summary(cart.id)
+        self.assertEqual(summary['item_count'], 8)
+        self.assertEqual(summary['total_price'], Decimal(3 * 10 + 5 * 11))
+        self.assertTrue(store.apply(cart.id, [('add', self.products[1].id, 2), ('set', self.products[3].id, 4)]))
+        self.assertEqual(store.pop(cart.id), {self.products[0].id: 3, self.products[1].id: 7, self.products[3].id: 4})
+        self.assertIsNone(store.get(cart.id))
+        self.assertIsNone(store.add_item(cart.id, self.products[0].id, 1))
+        self.assertIsNone(store.pop(cart.id))
+
+    def test_database_store(self):
+        self.check_store(DatabaseCartStore())
+
+    def test_cached_store(self):
+        store = get_cart_store()
+        self.assertIsInstance(store, CachedCartStore)
+        self.check_store(store)
+
+    def test_quantity_changes_are_written_behind(self):
+        store = get_cart_store()
+        cart = store.create()
+        item = store.add_item(cart.id, self.products[0].id, 2)
+        store.apply(cart.id, [('add', self.products[0].id, 1), ('add', self.products[1].id, 1)])
+        self.assertEqual(CartItem.objects.get(pk=item.id).quantity, 2)
+        store.flush([cart.id])
+        # Upserted, the line keeps its id
+        self.assertEqual(dict(CartItem.objects.filter(cart_id=cart.id).values_list('product_id', 'quantity')),
+                         {self.products[0].id: 3, self.products[1].id: 1})
+        self.assertEqual(CartItem.objects.get(cart_id=cart.id, product_id=self.products[0].id).id, item.id)
+
+    def test_flush_does_not_bring_back_a_popped_cart(self):
+        store = get_cart_store()
+        cart = store.create()
+        store.add_item(cart.id, self.products[0].id, 2)
+        store.apply(cart.id, [('add', self.products[1].id, 1)])
+        self.assertIn(cart.id, store.dirty)
+        self.assertIsNotNone(store.pop(cart.id))
+        # A flusher that listed the cart before the pop
+        self.assertIsNone(store.write_cart(cart.id))
+        self.assertFalse(Cart.objects.filter(pk=cart.id).exists())
+        self.assertIsNone(store.get(cart.id))
+
+    def test_items_by_id_and_by_product(self):
+        cart_id = self.client.post('/store/carts/').data['id']
+        url = f'/store/carts/{cart_id}/items/'
+        response = self.client.post(url, {'product_id': self.products[0].id, 'quantity': 2})
+        self.assertEqual(response.status_code, 201)
+        item_id = response.data['id']
+        self.assertEqual(CartItem.objects.get(pk=item_id).product_id, self.products[0].id)
+
+        response = self.client.patch(f'{url}{item_id}/', {'quantity': 4})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(f'{url}{item_id}/').data['quantity'], 4)
+        response = self.client.patch(f'{url}products/{self.products[0].id}/', {'quantity': 5})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(f'{url}products/{self.products[0].id}/').data['quantity'], 5)
+        self.assertEqual(self.client.get(f'{url}{item_id + 1000}/').status_code, 404)
+        self.assertEqual(self.client.delete(f'{url}products/{self.products[0].id}/').status_code, 204)
+        self.assertEqual(self.client.get(f'{url}{item_id}/').status_code, 404)
+
+    def test_local_cart_cache_add_is_exclusive(self):
+        cache = LocalCartCache(tempfile.mkdtemp(), {})
+        self.addCleanup(shutil.rmtree, cache._dir)
+        self.assertTrue(cache.add('lock', 1, 5))
+        self.assertFalse(cache.add('lock', 2, 5))
+        self.assertEqual(cache.get('lock'), 1)
+        # A lock file left behind by a dead process is taken over
+        path = cache._key_to_file('other') + '.lock'
+        open(path, 'w').close()
+        os.utime(path, (0, 0))
+        self.assertTrue(cache.add('other', 1, 5))
+        self.assertFalse(os.path.exists(path))
+
+
+class BulkCartItemTests(CatalogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.cart = self.make_cart([(self.products[0], 2), (self.products[1], 1)])
+        self.url = f'/store/carts/{self.cart.id}/items/bulk/'
+
+    def test_operations_are_collapsed_and_applied(self):
+        response = self.client.post(self.url, [
+            {'product_id': self.products[0].id, 'quantity': 1},
+            {'product_id': self.products[0].id, 'quantity': 2},
+            {'product_id': self.products[1].id, 'op': 'remove'},
+            {'product_id': self.products[2].id, 'quantity': 5, 'op': 'set'},
+            {'product_id': self.products[2].id, 'quantity': 1},
+        ], format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(dict(CartItem.objects.filter(cart=self.cart).values_list('product_id', 'quantity')),
+                         {self.products[0].id: 5, self.products[2].id: 6})
+        self.assertEqual(response.data['item_count'], 11)
+
+    def test_unknown_products_are_refused(self):
+        response = self.client.post(self.url, [{'product_id': 999999, 'quantity': 1}], format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(CartItem.objects.filter(cart=self.cart).count(), 2)
+
+    def test_quantity_can_not_overflow(self):
+        response = self.client.post(self.url, [{'product_id': self.products[0].id, 'quantity': MAX_QUANTITY}],
+                                    format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('quantity', response.data)
+        response = self.client.post(f'/store/carts/{self.cart.id}/items/',
+                                    {'product_id': self.products[0].id, 'quantity': MAX_QUANTITY - 1})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(CartItem.objects.get(cart=self.cart, product=self.products[0]).quantity, 2)
+        response = self.client.post(f'/store/carts/{self.cart.id}/items/',
+                                    {'product_id': self.products[0].id, 'quantity': MAX_QUANTITY - 2})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['quantity'], MAX_QUANTITY)
+
+
+class CartSweepTests(CatalogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.old = [self.make_cart([(self.products[0], 1)]) for _ in range(5)]
+        self.recent = self.make_cart([(self.products[1], 1)])
+        Cart.objects.filter(pk__in=[cart.pk for cart in self.old]) \
+            .update(updated_at=timezone.now() - timedelta(days=2))
+
+    def test_idle_carts_are_deleted_in_batches(self):
+        stats = sweep_carts(ttl=24 * 60 * 60, batch_size=2, max_batch_size=2, pause_factor=0)
+        self.assertEqual(stats['carts'], 5)
+        self.assertEqual(stats['batches'], 3)
+        self.assertEqual(list(Cart.objects.values_list('pk', flat=True)), [self.recent.pk])
+        self.assertEqual(CartItem.objects.count(), 1)
+
+    def test_command(self):
+        out = StringIO()
+        call_command('sweep_carts', ttl=24 * 60 * 60, max_batches=1, batch_size=3, pause_factor=0, stdout=out)
+        self.assertIn('Deleted 3 carts', out.getvalue())
+        self.assertEqual(Cart.objects.count(), 3)
+
+
+class InventoryTests(CatalogTestCase):
+    def test_reserve_takes_the_stock(self):
+        order = self.make_order([])
+        with transaction.atomic():
+            reserve(order, {self.products[0].id: 3, self.products[1].id: 100})
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).inventory, 97)
+        self.assertEqual(Product.objects.get(pk=self.products[1].pk).inventory, 0)
+        self.assertEqual(InventoryReservation.objects.filter(order=order).count(), 2)
+
+    def test_short_product_takes_nothing(self):
+        order = self.make_order([])
+        with self.assertRaises(InsufficientStock) as raised:
+            with transaction.atomic():
+                reserve(order, {self.products[0].id: 3, self.products[1].id: 101})
+        self.assertEqual(raised.exception.product_ids, [self.products[1].id])
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).inventory, 100)
+        self.assertFalse(InventoryReservation.objects.exists())
+
+    def test_failed_payment_gives_the_stock_back(self):
+        order = self.make_order([])
+        reserve(order, {self.products[0].id: 5})
+        order.payment_status = Order.PAYMENT_STATUS_FAILED
+        settle(order)
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).inventory, 100)
+        self.assertFalse(InventoryReservation.objects.exists())
+
+    def test_sharded_product(self):
+        product = self.products[0]
+        InventoryShard.objects.bulk_create([InventoryShard(product=product, shard=shard, quantity=2) for shard in range(3)])
+        order = self.make_order([])
+        reserve(order, {product.id: 5})
+        self.assertEqual(sum(InventoryShard.objects.filter(product=product).values_list('quantity', flat=True)), 1)
+        with self.assertRaises(InsufficientStock):
+            reserve(order, {product.id: 2})
+
+    def test_shards_are_not_moved_under_pending_reservations(self):
+        product = self.products[0]
+        order = self.make_order([])
+        reserve(order, {product.id: 5})
+        with self.assertRaises(CommandError):
+            call_command('inventory_shards', product.id, split=3, stdout=StringIO())
+        self.assertFalse(InventoryShard.objects.exists())
+
+        order.payment_status = Order.PAYMENT_STATUS_COMPLETE
+        settle(order)
+        version = get_catalog_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('inventory_shards', product.id, split=3, stdout=StringIO())
+        self.assertEqual(sorted(InventoryShard.objects.values_list('quantity', flat=True)), [31, 32, 32])
+        self.assertNotEqual(get_catalog_version(), version)
+
+
+class CheckoutTests(CatalogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_order_is_placed_from_the_cart(self):
+        cart = self.make_cart([(self.products[0], 2), (self.products[1], 1)])
+        response = self.client.post('/store/orders/', {'cart_id': cart.id})
+        self.assertEqual(response.status_code, 200)
+        order = Order.objects.get(pk=response.data['id'])
+        self.assertEqual(dict(order.items.values_list('product_id', 'quantity')),
+                         {self.products[0].id: 2, self.products[1].id: 1})
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).inventory, 98)
+        self.assertFalse(Cart.objects.filter(pk=cart.id).exists())
+        # The cart is gone, a second checkout of it places nothing
+        self.assertEqual(self.client.post('/store/orders/', {'cart_id': cart.id}).status_code, 400)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_failed_checkout_gives_the_cart_back(self):
+        cart = self.make_cart([(self.products[0], 2), (self.products[1], 101)])
+        response = self.client.post('/store/orders/', {'cart_id': cart.id})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(dict(CartItem.objects.filter(cart_id=cart.id).values_list('product_id', 'quantity')),
+                         {self.products[0].id: 2, self.products[1].id: 101})
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).inventory, 100)
+
+
+class OrderSummaryTests(CatalogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_checkout_and_payment_write_the_summary(self):
+        cart = self.make_cart([(self.products[0], 2), (self.products[1], 1)])
+        order_id = self.client.post('/store/orders/', {'cart_id': cart.id}).data['id']
+        summary = OrderSummary.objects.get(order_id=order_id)
+        self.assertEqual(summary.item_count, 3)
+        self.assertEqual(summary.total_amount, Decimal('31.00'))
+
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.patch(f'/store/orders/{order_id}/', {'payment_status': Order.PAYMENT_STATUS_COMPLETE})
+        self.assertEqual(response.status_code, 200)
+        summary.refresh_from_db()
+        self.assertEqual(summary.payment_status, Order.PAYMENT_STATUS_COMPLETE)
+
+    def test_list_is_served_from_the_summaries(self):
+        first = self.make_order([(self.products[0], 1)])
+        second = self.make_order([(self.products[1], 2), (self.products[2], 1)])
+        self.assertEqual(OrderSummary.objects.rebuild(), 2)
+        with self.assertNumQueries(2):
+            response = self.client.get('/store/orders/')
+        self.assertEqual([row['id'] for row in response.data], [second.id, first.id])
+        self.assertEqual(response.data[0]['item_count'], 3)
+        self.assertEqual(response.data[0]['total_amount'], Decimal('34.00'))
+
+    def test_rebuild_command(self):
+        order = self.make_order([(self.products[0], 4)])
+        call_command('rebuild_order_summaries', order.id, stdout=StringIO())
+        self.assertEqual(OrderSummary.objects.get(order=order).total_amount, Decimal('40.00'))
+
+
+class IdempotencyTests(CatalogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.cart = self.make_cart([])
+        self.url = f'/store/carts/{self.cart.id}/items/'
+
+    def test_retry_is_replayed(self):
+        data = {'product_id': self.products[0].id, 'quantity': 2}
+        first = self.client.post(self.url, data, HTTP_IDEMPOTENCY_KEY='add-1')
+        second = self.client.post(self.url, data, HTTP_IDEMPOTENCY_KEY='add-1')
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(second.status_code, 201)
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(CartItem.objects.get(cart=self.cart).quantity, 2)
+
+    def test_key_reused_for_another_body(self):
+        self.client.post(self.url, {'product_id': self.products[0].id, 'quantity': 2}, HTTP_IDEMPOTENCY_KEY='add-1')
+        response = self.client.post(self.url, {'product_id': self.products[0].id, 'quantity': 3},
+                                    HTTP_IDEMPOTENCY_KEY='add-1')
+        self.assertEqual(response.status_code, 422)
+
+    def test_failed_request_releases_the_key(self):
+        self.assertEqual(self.client.post(self.url, {'product_id': 0, 'quantity': 2},
+                                          HTTP_IDEMPOTENCY_KEY='add-1').status_code, 400)
+        response = self.client.post(self.url, {'product_id': self.products[0].id, 'quantity': 2},
+                                    HTTP_IDEMPOTENCY_KEY='add-1')
+        self.assertEqual(response.status_code, 201)
+
+    @override_settings(STORE_CHECKOUT_QUEUE=True)
+    def test_replayed_checkout_keeps_its_location(self):
+        self.client.force_authenticate(self.user)
+        cart = self.make_cart([(self.products[0], 1)])
+        first = self.client.post('/store/orders/', {'cart_id': cart.id}, HTTP_IDEMPOTENCY_KEY='checkout-1')
+        second = self.client.post('/store/orders/', {'cart_id': cart.id}, HTTP_IDEMPOTENCY_KEY='checkout-1')
+        self.assertEqual(first.status_code, 202)
+        self.assertEqual(second.status_code, 202)
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(second['Location'], first['Location'])
+        self.assertEqual(second.json(), first.json())
+
+
+class CheckoutQueueTests(CatalogTestCase):
+    def test_queued_cart_is_frozen(self):
+        cart = self.make_cart([(self.products[0], 2)])
+        job = enqueue(self.customer.id, cart.id)
+        self.assertEqual(job.items, [[self.products[0].id, 2]])
+        self.assertFalse(Cart.objects.filter(pk=cart.id).exists())
+        self.assertIsNone(enqueue(self.customer.id, cart.id))
+
+        self.assertEqual(place_batch(), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, CheckoutJob.STATUS_DONE)
+        self.assertEqual(list(job.order.items.values_list('product_id', 'quantity')), [(self.products[0].id, 2)])
+        summary = OrderSummary.objects.get(order=job.order)
+        self.assertEqual((summary.item_count, summary.total_amount), (2, Decimal(20)))
+
+    def test_failed_job_gives_the_cart_back(self):
+        cart = self.make_cart([(self.products[0], 200)])
+        job = enqueue(self.customer.id, cart.id)
+        other = enqueue(self.customer.id, self.make_cart([(self.products[1], 1)]).id)
+        self.assertEqual(place_batch(), 2)
+        job.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual(job.status, CheckoutJob.STATUS_FAILED)
+        self.assertEqual(other.status, CheckoutJob.STATUS_DONE)
+        self.assertEqual(list(CartItem.objects.filter(cart_id=cart.id).values_list('product_id', 'quantity')),
+                         [(self.products[0].id, 200)])
+
+    def test_cart_survives_a_failed_enqueue(self):
+        cart = self.make_cart([(self.products[0], 2), (self.products[1], 1)])
+        with mock.patch.object(CheckoutJob.objects, 'create', side_effect=DatabaseError('down')):
+            with self.assertRaises(DatabaseError):
+                enqueue(self.customer.id, cart.id)
+        self.assertEqual(dict(CartItem.objects.filter(cart_id=cart.id).values_list('product_id', 'quantity')),
+                         {self.products[0].id: 2, self.products[1].id: 1})
+
+    def test_cached_cart_survives_a_failed_enqueue(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        caches = dict(settings.CACHES, carts={'BACKEND': 'store.filecache.LocalCartCache', 'LOCATION': location})
+        with override_settings(CACHES=caches, STORE_CART_BACKEND='store.carts.CachedCartStore',
+                               STORE_CART_FLUSH_INTERVAL=0):
+            store = get_cart_store()
+            cart = store.create()
+            store.apply(cart.id, [('add', self.products[0].id, 2)])
+            with mock.patch.object(CheckoutJob.objects, 'create', side_effect=DatabaseError('down')):
+                with self.assertRaises(DatabaseError):
+                    enqueue(self.customer.id, cart.id)
+            self.assertEqual(store.pop(cart.id), {self.products[0].id: 2})
+
+    def test_empty_cart_is_not_queued(self):
+        cart = self.make_cart([])
+        self.assertIsNone(enqueue(self.customer.id, cart.id))
+        self.assertTrue(Cart.objects.filter(pk=cart.id).exists())
+
+
+@override_settings(STORE_ROLLUP_LAG=0)
+class RollupTests(CatalogTestCase):
+    def pay(self, order):
+        order.payment_status = Order.PAYMENT_STATUS_COMPLETE
+        order.save()
+        OrderSummary.objects.filter(order=order).update(payment_status=order.payment_status, updated_at=timezone.now())
+
+    def place(self, items):
+        order = self.make_order(items)
+        OrderSummary.objects.rebuild(Order.objects.filter(pk=order.pk))
+        return order
+
+    def test_incremental_runs(self):
+        first = self.place([(self.products[0], 2), (self.products[1], 1)])
+        second = self.place([(self.products[0], 1)])
+        self.pay(first)
+        update_rollups()
+        row = DailyProductSales.objects.get(product=self.products[0])
+        self.assertEqual((row.orders_count, row.quantity, row.revenue), (1, 2, Decimal(20)))
+
+        self.pay(second)
+        update_rollups()
+        update_rollups()
+        row = DailyProductSales.objects.get(product=self.products[0])
+        self.assertEqual((row.orders_count, row.quantity, row.revenue), (2, 3, Decimal(30)))
+        collection = DailyCollectionSales.objects.get(collection=self.toys)
+        self.assertEqual(collection.quantity, 3)
+        customer = MonthlyCustomerSales.objects.get(customer=self.customer)
+        self.assertEqual((customer.orders_count, customer.quantity, customer.revenue), (2, 4, Decimal(41)))
+
+
+class IdSetTests(TestCase):
+    def check(self, left, right):
+        a, b = IdSet(left), IdSet(right)
+        self.assertEqual(list(a & b), sorted(set(left) & set(right)))
+        self.assertEqual(list(a | b), sorted(set(left) | set(right)))
+        self.assertEqual(list(a - b), sorted(set(left) - set(right)))
+        self.assertEqual(len(a), len(set(left)))
+        values = sorted(set(left))
+        if values:
+            self.assertEqual(a[:3], values[:3])
+            self.assertEqual(a[len(values) - 5:], values[-5:])
+            self.assertEqual(a[4090:4100], values[4090:4100])
+        for value in right[:50]:
+            self.assertEqual(value in a, value in set(left))
+
+    def test_sparse_and_dense_chunks(self):
+        rng = random.Random(1)
+        sparse = rng.sample(range(300000), 500)
+        dense = list(range(0, 70000, 2)) + rng.sample(range(70000, 200000), 6000)
+        self.check(sparse, dense)
+        self.check(dense, sparse)
+        self.check(dense, list(range(1, 70000, 3)))
+        self.check([], sparse)
+
+    def test_add_and_discard(self):
+        ids = IdSet(range(5000))
+        ids.add(70000)
+        for value in range(0, 5000, 2):
+            ids.discard(value)
+        self.assertEqual(list(ids), list(range(1, 5000, 2)) + [70000])
@@ -8,6 +8,10 @@ router.register('collections',views.CollectionViewSet)
 router.register('carts',views.CartViewSet,basename='carts')
 router.register('customers',views.CustomerViewSet)
 router.register('orders',views.OrderViewSet,basename='orders')
+router.register('checkouts',views.CheckoutJobViewSet,basename='checkouts')
+router.register('reports/daily-products',views.DailyProductSalesViewSet,basename='daily-product-sales')
+router.register('reports/daily-collections',views.DailyCollectionSalesViewSet,basename='daily-collection-sales')
+router.register('reports/monthly-customers',views.MonthlyCustomerSalesViewSet,basename='monthly-customer-sales')
 
 products_router = routers.NestedDefaultRouter(router,'products',lookup='product')
 products_router.register('reviews',views.ReviewViewSet,basename='product-reviews')
@@ -1,13 +1,16 @@
+from hashlib import md5
 from typing import Any
-from django.db.models import Count
+from django.conf import settings
+from django.db.models import Count, Max, Sum
 from django.shortcuts import get_object_or_404
-from django.http import HttpResponse
+from django.urls import reverse
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated,AllowAny,IsAdminUser,DjangoModelPermissions
 from rest_framework.filters import SearchFilter,OrderingFilter
 from rest_framework.pagination import PageNumberPagination
-from rest_framework.mixins import CreateModelMixin,RetrieveModelMixin,DestroyModelMixin,UpdateModelMixin
+from rest_framework.mixins import CreateModelMixin,ListModelMixin,RetrieveModelMixin,DestroyModelMixin,UpdateModelMixin
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework import status
@@ -16,27 +19,45 @@ from rest_framework.generics import ListCreateAPIView,RetrieveUpdateDestroyAPIVi
 from rest_framework.viewsets import ModelViewSet,GenericViewSet
 
 
-from store.filters import ProductFilter
-from store.pagination import DefaultPagination
+from store.bitmaps import DescendingIds, tag_index
+from store.cache import CatalogCacheMixin
+from store.carts import get_cart_store
+from store.checkout import enqueue
+from store.conditional import ConditionalListMixin, ConditionalRetrieveMixin, timestamp
+from store.fieldsets import SparseQuerysetMixin, parse_list
+from store.exports import iter_order_records, ndjson_lines
+from store.facets import FacetsMixin
+from store.idempotency import IdempotencyMixin
+from store.filters import DailyCollectionSalesFilter, DailyProductSalesFilter, MonthlyCustomerSalesFilter, OrderExportFilter, ProductFilter
+from store.pagination import DefaultPagination, KeysetPaginationMixin
+from store.search import ProductSearchFilter, SearchRankingMixin
 from store.permissions import FullDjangoModelPermission, IsAdminOrReadOnly
-from .models import Cart, CartItem, Customer, Order, OrderItem, Product,Collection, ProductImage,Review
-from .serializers import AddCartItemSerializer, CartItemSerializer, CartSerializer, CreateOrderSerializer, CustomerSerializer, OrderSerializer, ProductImageSerializer, ProductSerializer,CollectionSerializer, ReviewSerializer, UpdateCartItemSerializer, UpdateOrderSerializer
+from .models import Cart, CartItem, CheckoutJob, Customer, DailyCollectionSales, DailyProductSales, MonthlyCustomerSales, Order, OrderItem, OrderSummary, Product,Collection, ProductImage,Review
+from .serializers import AddCartItemSerializer, BulkCartItemSerializer, CartItemSerializer, CartSerializer, CartSummarySerializer, CheckoutJobSerializer, CreateOrderSerializer, CustomerSerializer, DailyCollectionSalesSerializer, DailyProductSalesSerializer, MonthlyCustomerSalesSerializer, OrderSerializer, OrderSummarySerializer, ProductImageSerializer, ProductSerializer,CollectionSerializer, ReviewSerializer, UpdateCartItemSerializer, UpdateOrderSerializer
 
-class ProductViewSet(ModelViewSet):
-    queryset = Product.objects.prefetch_related('images').all()
+class ProductViewSet(ConditionalListMixin,ConditionalRetrieveMixin,CatalogCacheMixin,FacetsMixin,KeysetPaginationMixin,SearchRankingMixin,SparseQuerysetMixin,ModelViewSet):
+    queryset = Product.objects.select_related('price').prefetch_related('images').all()
     serializer_class = ProductSerializer
+    # GET list/detail responses are cached, see store/cache.py
+    cache_endpoint = 'products'
 
     # Generic Filtering(Search by any Field)
     '''
     First create Filter Class 
     Then impliment filtering Logic and then in View set
     '''
-    filter_backends = [DjangoFilterBackend,SearchFilter,OrderingFilter]
+    # ProductSearchFilter answers ?search= from the in-memory index and
+    # SearchRankingMixin pages the results in rank order (store/search.py)
+    filter_backends = [DjangoFilterBackend,ProductSearchFilter,OrderingFilter]
     filterset_class = ProductFilter
     pagination_class = DefaultPagination
     permission_classes = [IsAdminOrReadOnly]
     search_fields = ['title','description']
     ordering_fields = ['unit_price']
+    # ?pagination=cursor switches to keyset pagination (store/pagination.py)
+    keyset_ordering_fields = ['title','unit_price']
+    keyset_default_ordering = 'title'
+    # ?facets=collection,price adds facet counts (store/facets.py)
 
     # Generic Filtering
     # filter_backends = [DjangoFilterBackend]
@@ -52,6 +73,54 @@ class ProductViewSet(ModelViewSet):
 
     def get_serializer_context(self):
         return {'request':self.request}
+
+    # ETag validators, see store/conditional.py
+    def get_list_validator(self, queryset):
+        row = queryset.aggregate(last_update=Max('last_update'),count=Count('pk'))
+        return f"{row['last_update']}:{row['count']}",None
+
+    def get_detail_validator(self, pk):
+        last_update = Product.objects.filter(pk=pk).values_list('last_update',flat=True).first()
+        if last_update is None:
+            return None
+        return str(last_update),timestamp(last_update)
+
+    '''
+    Merchandising pages from the tag / collection bitmaps (store/bitmaps.py)
+    ?tags=red,sale (all of them) ?any_tags=a,b (at least one)
+    ?exclude_tags=c ?collection_id=1,2 (one of them) ?ordering=-id
+    The filtering is done in memory, only the products of the page are
+    read from the database
+    '''
+    @action(detail=False,methods=['get'])
+    def browse(self,request):
+        params = request.query_params
+        try:
+            collections = [int(value) for value in parse_list(params.get('collection_id',''))]
+        except ValueError:
+            return Response({'collection_id':['A comma separated list of ids is required.']},status=status.HTTP_400_BAD_REQUEST)
+        ordering = params.get('ordering','id')
+        if ordering not in ['id','-id']:
+            return Response({'ordering':["Only 'id' and '-id' are supported."]},status=status.HTTP_400_BAD_REQUEST)
+
+        tag_index.ensure_fresh()
+        ids = tag_index.query(
+            all_tags=parse_list(params.get('tags','')),
+            any_tags=parse_list(params.get('any_tags','')),
+            exclude_tags=parse_list(params.get('exclude_tags','')),
+            collections=collections)
+        if ordering == '-id':
+            ids = DescendingIds(ids)
+        paginator = DefaultPagination()
+        page_ids = paginator.paginate_queryset(ids,request,view=self)
+
+        queryset = self.get_queryset().filter(pk__in=page_ids)
+        requested = ProductSerializer.get_requested_fields(request)
+        if requested is not None:
+            queryset = ProductSerializer.optimize_queryset(queryset,requested)
+        products = {product.pk:product for product in queryset}
+        serializer = self.get_serializer([products[pk] for pk in page_ids if pk in products],many=True)
+        return paginator.get_paginated_response(serializer.data)
     
     def destroy(self, request, *args, **kwargs):
         if OrderItem.objects.filter(product_id=kwargs['pk'])>0:
@@ -74,13 +143,25 @@ class ProductImageViewSet(ModelViewSet):
     def get_serializer_context(self):
         return {'product_id':self.kwargs['product_pk']}
     
-class CollectionViewSet(ModelViewSet):
-    queryset = Collection.objects.annotate(products_count=Count('products'))
+class CollectionViewSet(ConditionalListMixin,ConditionalRetrieveMixin,ModelViewSet):
+    # products_count is a stored column now (kept up to date by store.signals)
+    queryset = Collection.objects.all()
     serializer_class = CollectionSerializer
     permission_classes = [IsAdminOrReadOnly]
 
+    # Changes to products_count also move last_update
+    def get_list_validator(self, queryset):
+        row = queryset.aggregate(last_update=Max('last_update'),count=Count('pk'))
+        return f"{row['last_update']}:{row['count']}",None
+
+    def get_detail_validator(self, pk):
+        last_update = Collection.objects.filter(pk=pk).values_list('last_update',flat=True).first()
+        if last_update is None:
+            return None
+        return str(last_update),timestamp(last_update)
+
     def destroy(self, request, *args, **kwargs):
-        if Product.objects.filter(collection_id=kwargs['pk']).count()>0:
+        if self.get_object().products_count>0:
             return Response({'error':'there are some products which blongs to that collection'},status=status.HTTP_405_METHOD_NOT_ALLOWED)
         return super().destroy(request, *args, **kwargs)
 
@@ -92,11 +173,13 @@ class CollectionViewSet(ModelViewSet):
     #     collection.delete()
     #     return Response(status=status.HTTP_204_NO_CONTENT)
 
-class ReviewViewSet(ModelViewSet):
+class ReviewViewSet(KeysetPaginationMixin,ModelViewSet):
     '''Yhan mere paa product_id ki access nai ha is liye mujhe
     get_queryset funtion implement karna ho ga
     queryset = Review.objects.all()'''
     serializer_class = ReviewSerializer
+    keyset_ordering_fields = ['date']
+    keyset_default_ordering = '-date'
     def get_queryset(self):
         return Review.objects.filter(product_id=self.kwargs['product_pk'])
     '''
@@ -106,12 +189,52 @@ class ReviewViewSet(ModelViewSet):
     def get_serializer_context(self):
         return {'product_id':self.kwargs['product_pk']}
 
-class CartViewSet(CreateModelMixin,RetrieveModelMixin,DestroyModelMixin,GenericViewSet):
-    queryset = Cart.objects.prefetch_related('items__product').all()
+'''
+Carts are read and written through the cart store (store/carts.py),
+which may keep them in a cache and write them to the DB later
+'''
+class CartViewSet(ConditionalRetrieveMixin,CreateModelMixin,RetrieveModelMixin,DestroyModelMixin,GenericViewSet):
+    queryset = Cart.objects.all()
     serializer_class = CartSerializer
 
+    def get_detail_validator(self, pk):
+        source = get_cart_store().get_validator(pk)
+        if source is None:
+            return None
+        return md5(source.encode()).hexdigest(),None
+
+    def is_summary(self):
+        return self.action == 'retrieve' and self.request.query_params.get('summary') in ['1','true']
+
+    def get_serializer_class(self):
+        if self.is_summary():
+            return CartSummarySerializer
+        return CartSerializer
+
+    def get_object(self):
+        store = get_cart_store()
+        if self.is_summary():
+            # Totals from one aggregate, the items are not loaded
+            cart = store.get_summary(self.kwargs['pk'])
+        else:
+            # ?fields= without items and totals does not load the items
+            requested = CartSerializer.get_requested_fields(self.request)
+            with_items = requested is None or bool(requested & {'items','item_count','total_price'})
+            cart = store.get(self.kwargs['pk'],items=with_items)
+        if cart is None:
+            raise Http404
+        return cart
+
+    def perform_create(self, serializer):
+        serializer.instance = get_cart_store().create()
+
+    def destroy(self, request, *args, **kwargs):
+        if not get_cart_store().delete(kwargs['pk']):
+            raise Http404
+        return Response(status=status.HTTP_204_NO_CONTENT)
 
-class CartItemViewSet(ModelViewSet):
+
+class CartItemViewSet(IdempotencyMixin,ModelViewSet):
     http_method_names = ['get','post','patch','delete']
     # queryset = CartItem.objects.all()
     # serializer_class = CartItemSerializer
@@ -123,11 +246,68 @@ class CartItemViewSet(ModelViewSet):
         return CartItemSerializer
 
     def get_queryset(self):
-        return CartItem.objects.select_related('product').filter(cart_id = self.kwargs['cart_pk'])
+        cart = get_cart_store().get(self.kwargs['cart_pk'])
+        if cart is None:
+            raise Http404
+        return cart.items.all()
+
+    def get_object(self):
+        store = get_cart_store()
+        try:
+            if 'product_id' in self.kwargs:
+                item = store.get_item(self.kwargs['cart_pk'],int(self.kwargs['product_id']))
+            else:
+                item = store.get_item_by_id(self.kwargs['cart_pk'],int(self.kwargs['pk']))
+        except ValueError:
+            raise Http404
+        if item is None:
+            raise Http404
+        return item
+
+    '''
+    One item per product, so an item can also be addressed by its
+    product: /carts/<cart>/items/products/<product id>/
+    '''
+    @action(detail=False,methods=['get','patch','delete'],url_path=r'products/(?P<product_id>[0-9]+)')
+    def product(self,request,cart_pk=None,product_id=None):
+        if request.method == 'GET':
+            return self.retrieve(request,cart_pk=cart_pk,product_id=product_id)
+        if request.method == 'PATCH':
+            return self.partial_update(request,cart_pk=cart_pk,product_id=product_id)
+        return self.destroy(request,cart_pk=cart_pk,product_id=product_id)
+
+    def perform_destroy(self, instance):
+        get_cart_store().remove_item(instance.cart_id,instance.product_id)
+
+    '''
+    POST [{"product_id": 1, "quantity": 2, "op": "add"}, ...]
+    op is add (default), set or remove. Answers with the updated cart
+    '''
+    @action(detail=False,methods=['post'])
+    def bulk(self,request,cart_pk=None):
+        # Retries with the same Idempotency-Key get the first answer
+        return self.idempotent_response(request,self.apply_bulk,cart_pk=cart_pk)
+
+    def apply_bulk(self,request,cart_pk=None):
+        data = {'items':request.data} if isinstance(request.data,list) else request.data
+        serializer = BulkCartItemSerializer(data=data,context={'cart_id':cart_pk})
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        cart = get_cart_store().get(cart_pk)
+        return Response(CartSerializer(cart,context={'request':request}).data)
 
     def get_serializer_context(self):
         return {'cart_id':self.kwargs['cart_pk']}
     
+class CheckoutJobViewSet(RetrieveModelMixin,GenericViewSet):
+    serializer_class = CheckoutJobSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        if self.request.user.is_staff:
+            return CheckoutJob.objects.all()
+        return CheckoutJob.objects.filter(customer__user_id=self.request.user.id)
+
 class CustomerViewSet(ModelViewSet):
     queryset = Customer.objects.all()
     serializer_class = CustomerSerializer
@@ -154,15 +334,46 @@ class CustomerViewSet(ModelViewSet):
             serializer.save()
             return Response(serializer.data)
 
-class OrderViewSet(ModelViewSet):
+class OrderViewSet(ConditionalRetrieveMixin,IdempotencyMixin,KeysetPaginationMixin,SparseQuerysetMixin,ModelViewSet):
     http_method_names = ['get','post','patch','delete','head','options']
+    # Unpaginated unless ?pagination=cursor is sent
+    keyset_ordering_fields = ['placed_at']
+    keyset_default_ordering = '-placed_at'
+    conditional_private = True
+
+    def get_detail_validator(self, pk):
+        row = self.get_queryset().filter(pk=pk).aggregate(
+            id=Max('id'),
+            payment_status=Max('payment_status'),
+            # Not items=, an aggregate alias can not shadow the relation
+            items_count=Count('items'),
+            quantity=Sum('items__quantity'),
+            products_last_update=Max('items__product__last_update'))
+        if row['id'] is None:
+            return None
+        return ':'.join(str(value) for value in row.values()),None
     # queryset = Order.objects.prefetch_related('items__product').all()
     # serializer_class = OrderSerializer
     # permission_classes = [IsAuthenticated]
     def get_permissions(self):
-        if self.request.method in ['PATCH','DELETE']:
+        if self.request.method in ['PATCH','DELETE'] or self.action == 'export':
             return [IsAdminUser()]
         return [IsAuthenticated()]
+
+    '''
+    Staff export, one JSON order per line. Streams in batches so memory
+    stays flat and the first line goes out before the table is read.
+    Filters: ?placed_at__gte= ?placed_at__lte= ?payment_status=
+    '''
+    @action(detail=False,methods=['get'])
+    def export(self,request):
+        filterset = OrderExportFilter(request.query_params,queryset=Order.objects.all())
+        if not filterset.is_valid():
+            return Response(filterset.errors,status=status.HTTP_400_BAD_REQUEST)
+        lines = ndjson_lines(iter_order_records(filterset.qs))
+        response = StreamingHttpResponse(lines,content_type='application/x-ndjson')
+        response['Content-Disposition'] = 'attachment; filename="orders.ndjson"'
+        return response
         
     '''
     Hmare pass Response main sirf card id return kar rha tha
@@ -170,8 +381,23 @@ class OrderViewSet(ModelViewSet):
     create method ko overwrite kia haa
     '''
     def create(self, request, *args, **kwargs):
-        serializer = CreateOrderSerializer(data=request.data,context={'user_id':self.request.user.id})
+        # Retried checkouts with the same Idempotency-Key are answered
+        # from the stored response (store/idempotency.py)
+        return self.idempotent_response(request,self.place_order)
+
+    def place_order(self, request):
+        customer_id = Customer.objects.id_for_user(request.user)
+        serializer = CreateOrderSerializer(data=request.data,context={'user_id':request.user.id,'customer_id':customer_id})
         serializer.is_valid(raise_exception=True)
+        # Queued checkout: a worker places the order, the client polls
+        # the job (store/checkout.py)
+        if getattr(settings,'STORE_CHECKOUT_QUEUE',False):
+            job = enqueue(customer_id,serializer.validated_data['cart_id'])
+            if job is None:
+                return Response({'cart_id':['Cart is empty or was already checked out']},status=status.HTTP_400_BAD_REQUEST)
+            url = request.build_absolute_uri(reverse('checkouts-detail',kwargs={'pk':job.id}))
+            data = dict(CheckoutJobSerializer(job).data,url=url)
+            return Response(data,status=status.HTTP_202_ACCEPTED,headers={'Location':url})
         order = serializer.save()
         serializer = OrderSerializer(order)
         return Response(serializer.data)
@@ -182,20 +408,71 @@ class OrderViewSet(ModelViewSet):
             return CreateOrderSerializer
         elif self.request.method == 'PATCH':
             return UpdateOrderSerializer
+        elif self.action == 'list':
+            return OrderSummarySerializer
         return OrderSerializer
 
 
 
     def get_queryset(self):
+        # Lists come from the OrderSummary read model, one indexed query
+        # without the items, the detail view loads the full order
+        if self.action == 'list':
+            queryset = OrderSummary.objects.order_by('-placed_at','-order')
+        else:
+            # ?fields= without items drops this prefetch (SparseQuerysetMixin)
+            queryset = Order.objects.prefetch_related('items__product')
         user = self.request.user
         if user.is_staff:
-            return Order.objects.all()
-        customer_id = Customer.objects.only('id').get(user_id=user)
-        return Order.objects.filter(customer_id=customer_id)
+            return queryset.all()
+        return queryset.filter(customer_id=Customer.objects.id_for_user(user))
+
+
 
 
 
 
+'''
+Staff dashboards, read from the sales rollup tables (store/rollups.py)
+instead of aggregating the order history. Rows are filtered by date
+range, ?totals=1 sums the range per product/collection/customer,
+best selling first
+'''
+class SalesRollupViewSet(ListModelMixin,GenericViewSet):
+    permission_classes = [IsAdminUser]
+    filter_backends = [DjangoFilterBackend]
+    pagination_class = DefaultPagination
+    totals_field = None
+
+    def list(self, request, *args, **kwargs):
+        if not request.query_params.get('totals'):
+            return super().list(request,*args,**kwargs)
+        queryset = self.filter_queryset(self.get_queryset()).order_by() \
+            .values(self.totals_field) \
+            .annotate(orders_count=Sum('orders_count'),quantity=Sum('quantity'),revenue=Sum('revenue')) \
+            .order_by('-revenue',self.totals_field)
+        page = self.paginate_queryset(queryset)
+        return self.get_paginated_response(page)
+
+class DailyProductSalesViewSet(SalesRollupViewSet):
+    queryset = DailyProductSales.objects.order_by('-date','-revenue')
+    serializer_class = DailyProductSalesSerializer
+    filterset_class = DailyProductSalesFilter
+    totals_field = 'product_id'
+
+class DailyCollectionSalesViewSet(SalesRollupViewSet):
+    queryset = DailyCollectionSales.objects.order_by('-date','-revenue')
+    serializer_class = DailyCollectionSalesSerializer
+    filterset_class = DailyCollectionSalesFilter
+    totals_field = 'collection_id'
+
+class MonthlyCustomerSalesViewSet(SalesRollupViewSet):
+    queryset = MonthlyCustomerSales.objects.order_by('-month','-revenue')
+    serializer_class = MonthlyCustomerSalesSerializer
+    filterset_class = MonthlyCustomerSalesFilter
+    totals_field = 'customer_id'
+
+
 
 
 # class ProductList(ListCreateAPIView):
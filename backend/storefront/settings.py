@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 
 from datetime import timedelta
 import os
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -144,7 +145,8 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 REST_FRAMEWORK = {
     'COERCE_DECIMAL_TO_STRING' : False,
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        # Users come from the token claims (core/authentication.py)
+        'core.authentication.ClaimsJWTAuthentication',
     ),
     # 'DEFAULT_PAGINATION_CLASS':'rest_framework.pagination.PageNumberPagination',
     # 'PAGE_SIZE':10
@@ -161,9 +163,129 @@ DJOSER = {
 SIMPLE_JWT = {
    'AUTH_HEADER_TYPES': ('JWT',),
    "ACCESS_TOKEN_LIFETIME": timedelta(days=1),
+   # customer_id, membership and staff flags go into the tokens
+   "TOKEN_OBTAIN_SERIALIZER": "core.serializers.ClaimsTokenObtainPairSerializer",
+   "TOKEN_REFRESH_SERIALIZER": "core.serializers.ClaimsTokenRefreshSerializer",
 }
 
+# Seconds the current token claims are cached (see core/authentication.py).
+# Only with a shared CORE_CLAIMS_CACHE, otherwise (and with None) they are
+# read from the database on every request. 'default' is a LocMemCache, so
+# out of the box nothing is cached: point this at a Redis cache shared by
+# the workers to cache the claims
+CORE_CLAIMS_CACHE = 'default'
+CORE_CLAIMS_CACHE_TTL = 60
+
 AUTH_USER_MODEL = 'core.User'
+
+# Use a shared cache (Redis/Memcached) in local_settings for production,
+# the catalog version counter has to be the same for every worker
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Cart server for CachedCartStore, shared by all the workers. Carts
+    # must not be evicted before they are written to the database, so
+    # no culling. Out of the box a local stand-in: one file per cart in
+    # shared memory (/dev/shm), seen by every worker of this host
+    'carts': {
+        'BACKEND': 'store.filecache.LocalCartCache',
+        'LOCATION': os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+                                 'storefront-carts'),
+        'TIMEOUT': None,
+    },
+    # Production, more than one host (Redis: maxmemory-policy noeviction)
+    # 'carts': {
+    #     'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+    #     'LOCATION': 'redis://127.0.0.1:6379/1',
+    # },
+}
+
+# Cache used for product list/detail responses and the catalog version
+STORE_CATALOG_CACHE = 'default'
+STORE_CATALOG_CACHE_TIMEOUT = 5 * 60
+
+# Product search index, written by 'manage.py rebuild_search_index' and
+# loaded by every worker on the first search. None builds it from the DB
+STORE_SEARCH_INDEX_PATH = None
+STORE_SEARCH_MAX_DESCRIPTION_TOKENS = 500
+# Matches a search returns, best first (store/search.py)
+STORE_SEARCH_MAX_RESULTS = 500
+
+# Catalog change log the in-process indexes catch up from (store/changes.py).
+# Holes in its ids are asked for again for STORE_CATALOG_CHANGE_GAP_TIMEOUT
+# seconds (the longest a catalog write transaction may take), rows older
+# than STORE_CATALOG_CHANGE_RETENTION seconds are deleted by
+# 'manage.py purge_catalog_changes'. With a per process catalog cache the
+# log is polled every STORE_CATALOG_CHANGE_POLL_INTERVAL seconds
+STORE_CATALOG_CHANGE_GAP_TIMEOUT = 10 * 60
+STORE_CATALOG_CHANGE_RETENTION = 7 * 24 * 60 * 60
+STORE_CATALOG_CHANGE_POLL_INTERVAL = 2
+
+# Tag / collection bitmaps behind /store/products/browse/, built in the
+# background when a web worker starts (storefront/wsgi.py). False builds
+# them on the first browse request instead
+STORE_TAG_INDEX_WARMUP = True
+
+# Precompiled read path for the product/cart/order serializers (store/compiled.py)
+STORE_COMPILED_SERIALIZERS = True
+
+# Cart storage (store/carts.py): 'store.carts.CachedCartStore' keeps carts
+# in STORE_CART_CACHE (has to be shared by all the workers, the 'carts'
+# cache above) and writes changed ones to the database every
+# STORE_CART_FLUSH_INTERVAL seconds and at checkout.
+# 'store.carts.DatabaseCartStore' writes every change directly
+STORE_CART_BACKEND = 'store.carts.CachedCartStore'
+STORE_CART_CACHE = 'carts'
+STORE_CART_CACHE_TIMEOUT = 7 * 24 * 60 * 60
+STORE_CART_FLUSH_INTERVAL = 2
+
+# Carts idle for STORE_CART_TTL seconds are deleted by 'manage.py
+# sweep_carts', or every STORE_CART_SWEEP_INTERVAL seconds by a thread
+# in the web process (None: only the command, the thread also needs a
+# shared default cache)
+STORE_CART_TTL = 30 * 24 * 60 * 60
+STORE_CART_SWEEP_INTERVAL = None
+
+# Stock reserved by an unpaid order goes back after this many seconds
+# ('manage.py release_reservations', see store/inventory.py)
+STORE_RESERVATION_TTL = 30 * 60
+
+# Queued checkout: POST /store/orders/ answers 202 with a job to poll
+# and 'manage.py run_checkout_workers' places the orders in batches
+# (see store/checkout.py)
+STORE_CHECKOUT_QUEUE = False
+STORE_CHECKOUT_BATCH_SIZE = 50
+STORE_CHECKOUT_POLL_INTERVAL = 0.5
+
+# Sales rollups ('manage.py update_sales_rollups') stop this many
+# seconds before now so transactions still committing are not skipped
+STORE_ROLLUP_LAG = 60
+
+# POSTs sent with an Idempotency-Key header keep their response this
+# many seconds, a duplicate of a running request waits up to
+# STORE_IDEMPOTENCY_WAIT seconds for it (see store/idempotency.py)
+STORE_IDEMPOTENCY_TTL = 24 * 60 * 60
+STORE_IDEMPOTENCY_WAIT = 10
+STORE_IDEMPOTENCY_LOCK_TIMEOUT = 60
+
+# Tax added on top of the discounted price (store.models.ProductPrice)
+STORE_TAX_RATE = '0.10'
+
+# Upper bounds of the price buckets of ?facets=price (store/facets.py)
+STORE_PRICE_FACET_BUCKETS = [25, 50, 100, 250]
+
+# Resized product image variants (store/imaging.py), rendered in a
+# process pool of STORE_IMAGE_WORKERS processes (None: one per CPU).
+# 'sync' renders inline instead of in the background
+STORE_IMAGE_VARIANTS = {
+    'thumbnail': {'width': 160, 'height': 160, 'format': 'WEBP', 'quality': 80},
+    'medium': {'width': 640, 'height': 640, 'format': 'WEBP', 'quality': 82},
+    'medium_jpeg': {'width': 640, 'height': 640, 'format': 'JPEG', 'quality': 85},
+}
+STORE_IMAGE_WORKERS = None
+STORE_IMAGE_PROCESSING = 'background'
+
 try:
     from local_settings import *
     
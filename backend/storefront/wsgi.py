@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'storefront.settings')
 
 application = get_wsgi_application()
+
+# Tag browsing index, see store/bitmaps.py
+from store.bitmaps import start_warm_up
+
+start_warm_up()
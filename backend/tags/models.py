@@ -13,6 +13,37 @@ class TaggedItemManager(models.Manager):
                 object_id = obj_id
         )
 
+    def get_tags_for_many(self,obj_type,obj_ids):
+        '''
+        {object_id: [Tag]} for all the objects in one query, objects
+        without tags are left out. get_for_model() is served from the
+        ContentType cache after the first call
+        '''
+        obj_ids = list(obj_ids)
+        if not obj_ids:
+            return {}
+        content_type = ContentType.objects.get_for_model(obj_type)
+        items = self.select_related('tag') \
+            .filter(content_type=content_type,object_id__in=obj_ids) \
+            .order_by('tag__label','tag_id')
+        tags = {}
+        for item in items:
+            tags.setdefault(item.object_id,[]).append(item.tag)
+        return tags
+
+    def prefetch_tags(self,objects,to_attr='tags'):
+        '''
+        Like prefetch_related() for tags: evaluates the queryset (or
+        takes a list of instances of one model) and sets to_attr on
+        every object to its list of tags. Returns the objects as a list
+        '''
+        objects = list(objects)
+        if objects:
+            tags = self.get_tags_for_many(type(objects[0]),[obj.pk for obj in objects])
+            for obj in objects:
+                setattr(obj,to_attr,tags.get(obj.pk,[]))
+        return objects
+
 
 class Tag(models.Model):
     label = models.CharField(max_length=255)
@@ -25,4 +56,10 @@ class TaggedItem(models.Model):
     tag = models.ForeignKey(Tag,on_delete=models.CASCADE)
     content_type = models.ForeignKey(ContentType,models.CASCADE)
     object_id = models.PositiveIntegerField()
-    content_object = GenericForeignKey()
\ No newline at end of file
+    content_object = GenericForeignKey()
+
+    class Meta:
+        # Tags of one or many objects (get_tags_for / get_tags_for_many)
+        indexes = [
+            models.Index(fields=['content_type','object_id']),
+        ]
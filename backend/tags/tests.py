@@ -1,3 +1,36 @@
 from django.test import TestCase
 
-# Create your tests here.
+from store.models import Collection, Product
+from store.serializers import ProductSerializer
+from tags.models import Tag, TaggedItem
+
+
+class TaggedItemManagerTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        collection = Collection.objects.create(title='Toys')
+        cls.products = [
+            Product.objects.create(title=f'Product {i}', slug=f'product-{i}', description='', unit_price=10,
+                                   inventory=10, collection=collection)
+            for i in range(3)]
+        cls.sale = Tag.objects.create(label='sale')
+        cls.new = Tag.objects.create(label='new')
+        for product, tag in [(cls.products[0], cls.sale), (cls.products[0], cls.new), (cls.products[1], cls.sale)]:
+            TaggedItem.objects.create(tag=tag, content_object=product)
+
+    def test_tags_of_many_objects_in_one_query(self):
+        with self.assertNumQueries(1):
+            tags = TaggedItem.objects.get_tags_for_many(Product, [product.pk for product in self.products])
+        # Ordered by label, untagged objects left out
+        self.assertEqual(tags, {self.products[0].pk: [self.new, self.sale], self.products[1].pk: [self.sale]})
+        self.assertEqual(TaggedItem.objects.get_tags_for_many(Product, []), {})
+
+    def test_prefetch_tags(self):
+        products = TaggedItem.objects.prefetch_tags(Product.objects.order_by('pk'))
+        self.assertEqual([product.tags for product in products], [[self.new, self.sale], [self.sale], []])
+
+    def test_product_list_loads_the_tags_once(self):
+        products = list(Product.objects.select_related('price').prefetch_related('images').order_by('pk'))
+        with self.assertNumQueries(1):
+            data = ProductSerializer(products, many=True).data
+        self.assertEqual([row['tags'] for row in data], [['new', 'sale'], ['sale'], []])